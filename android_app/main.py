@@ -20,6 +20,8 @@ import pygame
 import requests
 import tempfile
 import shutil
+import os
+import time
 import agorartc
 
 if platform == 'android':
@@ -28,6 +30,30 @@ if platform == 'android':
 
 BASE_URL = 'https://messenger-with-app.onrender.com'
 AGORA_APP_ID = "96619c27fbeb4332b25e1413e8f3ce9f"
+MESSAGES_PAGE_SIZE = 50
+UPLOAD_MAX_RETRIES = 5
+# Кэш скачанных голосовых сообщений
+AUDIO_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'messenger_audio_cache')
+CALL_HANGUP_REASONS = {
+    'no_answer': "Нет ответа.",
+    'disconnected': "Связь с собеседником потеряна.",
+    'answered_elsewhere': "Звонок принят на другом устройстве.",
+    'declined': "Звонок отклонён на другом устройстве."
+}
+
+WAVEFORM_BARS = '▁▂▃▄▅▆▇█'
+
+# Подпись голосового сообщения из метаданных сервера: длительность и форма волны, файл не скачивается
+def format_audio_label(duration, waveform, width=16):
+    parts = []
+    if duration is not None:
+        seconds = int(round(duration))
+        parts.append(f"{seconds // 60}:{seconds % 60:02d}")
+    if waveform:
+        step = max(1, len(waveform) // width)
+        peaks = [max(waveform[i:i + step]) for i in range(0, len(waveform), step)][:width]
+        parts.append(''.join(WAVEFORM_BARS[min(len(WAVEFORM_BARS) - 1, peak * len(WAVEFORM_BARS) // 256)] for peak in peaks))
+    return ' '.join(parts)
 
 class LoginScreen(Screen):
     pass
@@ -42,6 +68,11 @@ class MessengerApp(App):
     selected_chat = ObjectProperty(None)
     is_recording = False
     audio_frames = []
+    messages_cursor = None # before_id для подгрузки более старых сообщений
+    loading_older_messages = False
+    sync_cursor = None # курсор журнала изменений сервера (/sync)
+    socket_connected_once = False
+    room_seq = 0 # номер последнего увиденного события открытого чата
 
     # Call state
     rtc_engine = None
@@ -90,8 +121,13 @@ class MessengerApp(App):
             app.token = result['token']
             app.user_id = result['user']['id']
             app.username = result['user']['username']
-            app.connect_socketio()
-            app.load_chats()
+            # Курсор берём до загрузки чатов: при переподключении догружается только разница
+            def on_cursor(sync_result):
+                app.sync_cursor = sync_result.get('cursor') if isinstance(sync_result, dict) else None
+                app.socket_connected_once = False
+                app.connect_socketio()
+                app.load_chats()
+            app._api_request('/sync', on_success=on_cursor, on_failure=on_cursor)
 
         def on_login_failure(error):
             print(f"Login failed: {error}")
@@ -112,39 +148,44 @@ class MessengerApp(App):
         if chat_screen and hasattr(chat_screen, 'chats_list'):
             self.update_chat_list_display(chat_screen.chats_list)
 
-    def update_chat_list_display(self, chats, online_ids=None):
+    def update_chat_list_display(self, chats):
         chat_screen = self.sm.get_screen('chat')
         if chat_screen:
             chat_screen.chats_list = chats
             data = []
             for i, chat in enumerate(chats):
                 user = chat['with_user']
-                status = " (в сети)" if online_ids and user['id'] in online_ids else ""
-                data.append({'text': f"{user['username']}{status}", 'on_press': lambda i=i: self.select_chat(i)})
+                status = " (в сети)" if user.get('online') else ""
+                unread = f" [{chat['unread_count']}]" if chat.get('unread_count') else ""
+                text = f"{user['username']}{status}{unread}"
+                last_message = chat.get('last_message')
+                if last_message:
+                    preview = "Голосовое сообщение" if last_message.get('is_audio') else last_message['content']
+                    text += f"\n{preview[:30]}"
+                data.append({'text': text, 'on_press': lambda i=i: self.select_chat(i)})
             chat_screen.ids.chats_rv.data = data
             chat_screen.ids.chats_rv.refresh_from_data()
 
     def load_chats(self):
-        def on_online_users_loaded(online_ids):
-            def on_chats_loaded(chats):
-                try:
-                    chat_screen = self.sm.get_screen('chat')
-                    if chat_screen:
-                        print(f"chat_screen: {chat_screen}")
-                        print(f"chat_screen.ids: {chat_screen.ids}")
-
-                        def switch_to_chat_screen(dt):
-                            self.sm.current = 'chat'
-                            self.on_chat_screen_kv_post()
-
-                        Clock.schedule_once(switch_to_chat_screen, 0)
-                        self.update_chat_list_display(chats, online_ids)
-                    else:
-                        print("Error: 'chat' screen not found.")
-                except Exception as e:
-                    print(f"Error in on_chats_loaded: {e}")
-            self._api_request('/chats', on_success=on_chats_loaded)
-        self._api_request('/users/online', on_success=on_online_users_loaded)
+        # Список чатов приходит одним запросом вместе со статусом, последним сообщением и непрочитанными
+        def on_chats_loaded(chats):
+            try:
+                chat_screen = self.sm.get_screen('chat')
+                if chat_screen:
+                    print(f"chat_screen: {chat_screen}")
+                    print(f"chat_screen.ids: {chat_screen.ids}")
+
+                    def switch_to_chat_screen(dt):
+                        self.sm.current = 'chat'
+                        self.on_chat_screen_kv_post()
+
+                    Clock.schedule_once(switch_to_chat_screen, 0)
+                    self.update_chat_list_display(chats)
+                else:
+                    print("Error: 'chat' screen not found.")
+            except Exception as e:
+                print(f"Error in on_chats_loaded: {e}")
+        self._api_request('/chats', on_success=on_chats_loaded)
 
     def select_chat(self, index):
         chat_screen = self.sm.get_screen('chat')
@@ -154,21 +195,87 @@ class MessengerApp(App):
         self.load_messages()
 
     def load_messages(self):
+        # Сначала загружаем только самую новую страницу, старые подгружаются при прокрутке вверх
+        self.messages_cursor = None
         def on_load_success(result):
-            self.update_messages_display(result)
-            self.sio.emit('join', {'room': self.selected_chat['chat_id']})
-        self._api_request(f"/chats/{self.selected_chat['chat_id']}/messages", on_success=on_load_success)
+            self.messages_cursor = result.get('next_cursor')
+            self.room_seq = max((msg.get('seq') or 0 for msg in result['messages']), default=0)
+            self.update_messages_display(result['messages'])
+            # С last_seq сервер дошлёт то, что пришло между загрузкой страницы и входом в комнату
+            self.sio.emit('join', {'room': self.selected_chat['chat_id'], 'last_seq': self.room_seq})
+        self._api_request(f"/chats/{self.selected_chat['chat_id']}/messages?limit={MESSAGES_PAGE_SIZE}", on_success=on_load_success)
+
+    def on_messages_scroll(self, scroll_y):
+        # scroll_y == 1 - список прокручен до самого верха
+        if scroll_y >= 1 and self.messages_cursor and not self.loading_older_messages and self.selected_chat:
+            self.load_older_messages()
+
+    def load_older_messages(self):
+        self.loading_older_messages = True
+        chat_id = self.selected_chat['chat_id']
+
+        def on_success(result):
+            self.loading_older_messages = False
+            if not self.selected_chat or self.selected_chat['chat_id'] != chat_id:
+                return
+            self.messages_cursor = result.get('next_cursor')
+            self.prepend_messages_display(result['messages'])
+
+        def on_failure(error):
+            self.loading_older_messages = False
+
+        self._api_request(f"/chats/{chat_id}/messages?before_id={self.messages_cursor}&limit={MESSAGES_PAGE_SIZE}",
+                          on_success=on_success, on_failure=on_failure)
+
+    # Голосовые кэшируются локально: повторное воспроизведение проверяет файл по ETag (If-None-Match)
+    # и не скачивает его заново, оборванная загрузка продолжается с места обрыва (Range + If-Range)
+    def fetch_audio(self, url):
+        os.makedirs(AUDIO_CACHE_DIR, exist_ok=True)
+        name = os.path.splitext(os.path.basename(url))[0]
+        meta_path = os.path.join(AUDIO_CACHE_DIR, name + '.json')
+        part_path = os.path.join(AUDIO_CACHE_DIR, name + '.part')
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            meta = {}
+
+        headers = {}
+        if meta.get('path') and os.path.exists(meta['path']):
+            headers['If-None-Match'] = meta['etag']
+        elif meta.get('etag') and os.path.exists(part_path):
+            headers['Range'] = f'bytes={os.path.getsize(part_path)}-'
+            headers['If-Range'] = meta['etag']
+
+        response = requests.get(f'{BASE_URL}{url}', headers=headers, stream=True, timeout=30)
+        if response.status_code == 304:
+            return meta['path']
+        if response.status_code not in (200, 206):
+            return None
+
+        # Пока файл не скачан целиком, в метаданных только ETag - для докачки
+        if meta.get('path') and os.path.exists(meta['path']):
+            os.remove(meta['path'])
+        meta = {'etag': response.headers.get('ETag')}
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+        with open(part_path, 'ab' if response.status_code == 206 else 'wb') as f:
+            shutil.copyfileobj(response.raw, f)
+
+        # После перекодирования на сервере приходит Opus/OGG вместо WAV
+        suffix = '.ogg' if 'ogg' in response.headers.get('Content-Type', '') else '.wav'
+        meta['path'] = os.path.join(AUDIO_CACHE_DIR, name + suffix)
+        os.replace(part_path, meta['path'])
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+        return meta['path']
 
     def play_audio(self, url):
         def _play():
             try:
-                full_url = f'{BASE_URL}{url}'
-                response = requests.get(full_url, stream=True)
-                if response.status_code == 200:
-                    with tempfile.NamedTemporaryFile(delete=False, suffix='.wav') as tmp_file:
-                        shutil.copyfileobj(response.raw, tmp_file)
-                        tmp_filename = tmp_file.name
-                    pygame.mixer.music.load(tmp_filename)
+                audio_path = self.fetch_audio(url)
+                if audio_path:
+                    pygame.mixer.music.load(audio_path)
                     pygame.mixer.music.play()
                 else:
                     self._show_popup_threadsafe("Ошибка", "Не удалось загрузить аудиофайл.")
@@ -176,9 +283,7 @@ class MessengerApp(App):
                 self._show_popup_threadsafe("Ошибка воспроизведения", str(e))
         threading.Thread(target=_play).start()
 
-    @mainthread
-    def update_messages_display(self, messages):
-        chat_screen = self.sm.get_screen('chat')
+    def _message_items(self, messages):
         try:
             decoded_token = jwt.decode(self.token, options={"verify_signature": False})
             current_user_id = decoded_token['user_id']
@@ -193,24 +298,88 @@ class MessengerApp(App):
                 'message_text': msg['content'], 
                 'is_audio': msg.get('is_audio', False),
                 'audio_url': msg['content'] if msg.get('is_audio') else '',
+                'audio_label': format_audio_label(msg.get('audio_duration'), msg.get('audio_waveform')),
                 'halign': halign,
                 'message_id': msg.get('id')
             })
-        chat_screen.ids.messages_rv.data = data
+        return data
+
+    @mainthread
+    def update_messages_display(self, messages):
+        chat_screen = self.sm.get_screen('chat')
+        chat_screen.ids.messages_rv.data = self._message_items(messages)
+        chat_screen.ids.messages_rv.scroll_y = 0
+
+    @mainthread
+    def prepend_messages_display(self, messages):
+        messages_rv = self.sm.get_screen('chat').ids.messages_rv
+        messages_rv.data = self._message_items(messages) + messages_rv.data
 
     def delete_message(self, message_id):
         if message_id == -1: return
         self._api_request(f'/messages/delete/{message_id}', method='DELETE')
 
+    # После переподключения запрашиваем только изменения с момента последней синхронизации
+    # (сообщения и удаления, пропущенные, пока сокет был отключён), а не всю историю заново
+    def catch_up(self):
+        if self.sync_cursor is None:
+            return
+        self._api_request(f'/sync?since={self.sync_cursor}', on_success=self.apply_sync)
+
+    @mainthread
+    def apply_sync(self, result):
+        self.sync_cursor = result['cursor']
+        if result['reset']:
+            # Журнал на сервере уже обрезан - перезагружаем всё
+            self._api_request('/chats', on_success=self.update_chat_list_display)
+            if self.selected_chat:
+                self.load_messages()
+            return
+        messages_rv = self.sm.get_screen('chat').ids.messages_rv
+        if self.selected_chat:
+            known_ids = {item.get('message_id') for item in messages_rv.data}
+            new_messages = [msg for msg in result['messages']
+                            if msg['chat_id'] == self.selected_chat['chat_id'] and msg['id'] not in known_ids]
+            messages_rv.data = messages_rv.data + self._message_items(new_messages)
+        for deleted in result['deleted_messages']:
+            self.remove_message_item(deleted['message_id'])
+        if result['has_more']:
+            self.catch_up()
+            return
+        if result['messages'] or result['deleted_messages'] or result['chats']:
+            self._api_request('/chats', on_success=self.update_chat_list_display)
+        # Комнаты сокета после переподключения пустые - входим в открытый чат заново
+        if self.selected_chat:
+            self.sio.emit('join', {'room': self.selected_chat['chat_id'], 'last_seq': self.room_seq})
+
+    def note_room_seq(self, data):
+        if self.selected_chat and data.get('chat_id') == self.selected_chat['chat_id'] and data.get('seq'):
+            self.room_seq = max(self.room_seq, data['seq'])
+
+    def remove_message_item(self, message_id):
+        chat_screen = self.sm.get_screen('chat')
+        for item in chat_screen.ids.messages_rv.data:
+            if item.get('message_id') == message_id:
+                chat_screen.ids.messages_rv.data.remove(item)
+                break
+
     def setup_socketio_handlers(self):
+        @self.sio.on('connect')
+        def on_connect():
+            if self.socket_connected_once:
+                self.catch_up()
+            self.socket_connected_once = True
+
         @self.sio.on('message_deleted')
         def on_message_deleted(data):
-            message_id = data.get('message_id')
-            chat_screen = self.sm.get_screen('chat')
-            for item in chat_screen.ids.messages_rv.data:
-                if item.get('message_id') == message_id:
-                    chat_screen.ids.messages_rv.data.remove(item)
-                    break
+            self.note_room_seq(data)
+            self.remove_message_item(data.get('message_id'))
+
+        @self.sio.on('resync')
+        def on_resync(data):
+            # Пропущенные события уже не восстановить - перезагружаем историю открытого чата
+            if self.selected_chat and data.get('room') == self.selected_chat['chat_id']:
+                self.load_messages()
 
         @self.sio.on('incoming_call')
         @mainthread
@@ -241,9 +410,16 @@ class MessengerApp(App):
         @self.sio.on('call_hangup')
         @mainthread
         def on_call_hangup(data):
-            print("Call hung up by other party.")
-            self.hang_up()
-            self.show_popup("Вызов завершен", "Вызов был завершен другой стороной.")
+            print(f"Call hung up: {data.get('reason')}")
+            self.close_call()
+            self.show_popup("Вызов завершен", CALL_HANGUP_REASONS.get(data.get('reason'), "Вызов был завершен другой стороной."))
+
+        @self.sio.on('rate_limited')
+        def on_rate_limited(data):
+            # Сервер отклонил событие: слишком часто. Повторять можно через retry_after секунд
+            print(f"Rate limited: {data.get('event')}, retry after {data.get('retry_after')}s")
+            if data.get('event') == 'send_message':
+                self._show_popup_threadsafe("Слишком часто", "Сообщение не отправлено, подождите немного.")
 
         @self.sio.on('call_error')
         @mainthread
@@ -256,6 +432,13 @@ class MessengerApp(App):
         @self.sio.on('message')
         def on_message(data):
             if isinstance(data, dict) and self.selected_chat:
+                if data.get('chat_id') != self.selected_chat['chat_id']:
+                    return
+                self.note_room_seq(data)
+                # Сообщение могло уже прийти через догоняющую синхронизацию
+                messages_rv = self.sm.get_screen('chat').ids.messages_rv
+                if any(item.get('message_id') == data.get('id') for item in messages_rv.data):
+                    return
                 try:
                     decoded_token = jwt.decode(self.token, options={"verify_signature": False})
                     current_user_id = decoded_token['user_id']
@@ -267,6 +450,7 @@ class MessengerApp(App):
                     'message_text': data.get('content'), 
                     'is_audio': data.get('is_audio', False),
                     'audio_url': data.get('content') if data.get('is_audio') else '',
+                    'audio_label': format_audio_label(data.get('audio_duration'), data.get('audio_waveform')),
                     'halign': halign,
                     'message_id': data.get('id')
                 })
@@ -275,7 +459,7 @@ class MessengerApp(App):
         chat_screen = self.sm.get_screen('chat')
         message_text = chat_screen.ids.message_input.text
         if message_text and self.selected_chat:
-            self.sio.emit('send_message', {'room': self.selected_chat['chat_id'], 'content': message_text, 'token': self.token})
+            self.sio.emit('send_message', {'room': self.selected_chat['chat_id'], 'content': message_text})
             chat_screen.ids.message_input.text = ''
 
     def toggle_recording(self):
@@ -317,29 +501,75 @@ class MessengerApp(App):
 
     def upload_and_send_audio(self, filename):
         def _upload():
-            headers = {'x-access-token': self.token}
-            with open(filename, 'rb') as f:
-                files = {'file': (filename, f, 'audio/wav')}
-                try:
-                    response = requests.post(f'{BASE_URL}/upload/audio', files=files, headers=headers)
-                    if response.status_code == 201:
-                        file_path = response.json().get('file_path')
-                        if file_path and self.selected_chat:
-                            chat_id = self.selected_chat['chat_id']
-                            self.sio.emit('send_message', {'room': chat_id, 'content': file_path, 'token': self.token, 'is_audio': True})
-                    else:
-                        self._show_popup_threadsafe("Ошибка загрузки", response.json().get('message'))
-                except requests.exceptions.RequestException as e:
-                    self._show_popup_threadsafe("Ошибка сети", str(e))
+            try:
+                file_path = self.upload_audio_file(filename)
+                if file_path and self.selected_chat:
+                    chat_id = self.selected_chat['chat_id']
+                    self.sio.emit('send_message', {'room': chat_id, 'content': file_path, 'is_audio': True})
+            except RuntimeError as e:
+                self._show_popup_threadsafe("Ошибка загрузки", str(e))
+            except requests.exceptions.RequestException as e:
+                self._show_popup_threadsafe("Ошибка сети", str(e))
         threading.Thread(target=_upload).start()
 
+    def upload_audio_file(self, filename):
+        # Загрузка по частям: при обрыве связи продолжаем с того места, где остановился сервер
+        headers = {'x-access-token': self.token}
+        size = os.path.getsize(filename)
+        response = requests.post(f'{BASE_URL}/upload/audio/init', json={'size': size}, headers=headers, timeout=30)
+        if response.status_code != 201:
+            raise RuntimeError(response.json().get('message'))
+        upload = response.json()
+        upload_url = f"{BASE_URL}/upload/audio/{upload['upload_id']}"
+        chunk_size = upload['chunk_size']
+
+        offset = 0
+        retries = 0
+        with open(filename, 'rb') as f:
+            while offset is None or offset < size:
+                try:
+                    if offset is None:
+                        response = requests.get(upload_url, headers=headers, timeout=30)
+                        response.raise_for_status()
+                        offset = response.json()['offset']
+                        continue
+                    f.seek(offset)
+                    response = requests.put(upload_url, params={'offset': offset}, data=f.read(chunk_size),
+                                            headers={**headers, 'Content-Type': 'application/octet-stream'}, timeout=30)
+                    if response.status_code not in (200, 409):
+                        raise RuntimeError(response.json().get('message'))
+                    offset = response.json()['offset']
+                    retries = 0
+                except requests.exceptions.RequestException:
+                    retries += 1
+                    if retries > UPLOAD_MAX_RETRIES:
+                        raise
+                    time.sleep(retries)
+                    offset = None # спросим у сервера, сколько байт дошло
+
+        # 503 - сервер не смог сохранить файл, но загрузка цела и /complete можно повторить
+        for attempt in range(1, UPLOAD_MAX_RETRIES + 2):
+            try:
+                response = requests.post(f'{upload_url}/complete', headers=headers, timeout=30)
+            except requests.exceptions.RequestException:
+                if attempt > UPLOAD_MAX_RETRIES:
+                    raise
+            else:
+                if response.status_code != 503 or attempt > UPLOAD_MAX_RETRIES:
+                    break
+            time.sleep(attempt)
+        if response.status_code != 201:
+            raise RuntimeError(response.json().get('message'))
+        return response.json().get('file_path')
+
     @mainthread
     def _show_popup_threadsafe(self, title, text):
         self.show_popup(title, text)
 
     def connect_socketio(self):
         try:
-            self.sio.connect(f'{BASE_URL}?token={self.token}')
+            # Только websocket: соединение не зависит от того, на какой воркер попадёт каждый HTTP-запрос
+            self.sio.connect(f'{BASE_URL}?token={self.token}', transports=['websocket'])
         except Exception as e:
             print(f"SocketIO connection error: {e}")
 
@@ -359,7 +589,8 @@ class MessengerApp(App):
             on_success=self.show_search_results
         )
 
-    def show_search_results(self, results):
+    def show_search_results(self, result):
+        results = result.get('users', [])
         if not results:
             self.show_popup("Поиск", "Пользователи не найдены.")
             return
@@ -457,6 +688,15 @@ class MessengerApp(App):
         self.sm.get_screen('chat').ids.call_button.text = "Завершить"
         self.current_call_info = {'otherUserId': caller_id}
 
+    # Звонок завершён сервером (собеседник, таймаут, обрыв связи): сообщать серверу не нужно
+    @mainthread
+    def close_call(self):
+        self.current_call_info = {}
+        if self.incoming_call_popup:
+            self.incoming_call_popup.dismiss()
+            self.incoming_call_popup = None
+        self.hang_up()
+
     @mainthread
     def hang_up(self):
         if not self.in_call:
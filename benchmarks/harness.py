@@ -0,0 +1,95 @@
+# Общие помощники бенчмарков: запуск pc_app.server на локальной SQLite и заполнение данными через REST.
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import jwt
+import requests
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# Лимиты частоты socket-событий подняты, чтобы замерять сам путь сообщения, а не ограничитель
+BENCH_RATE_LIMITS = 'send_message=100000/100000,join=1000/1000'
+BENCH_RATE_LIMIT_ENV = {'SOCKET_RATE_LIMITS': BENCH_RATE_LIMITS, 'SOCKET_USER_RATE_LIMITS': BENCH_RATE_LIMITS}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class ServerProcess:
+    # Сервер в отдельном процессе: схема создаётся миграциями (flask db upgrade), как при деплое
+    def __init__(self, env=None, port=None):
+        self.port = port or free_port()
+        self.base_url = f'http://127.0.0.1:{self.port}'
+        self.db_path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+        self.env = os.environ.copy()
+        self.env.update({
+            'DATABASE_URL': 'sqlite:///' + self.db_path,
+            'FLASK_APP': 'pc_app/server.py',
+            'PYTHONUNBUFFERED': '1'
+        })
+        self.env.update(env or {})
+        self.proc = None
+
+    def start(self, timeout=30):
+        subprocess.run([sys.executable, '-m', 'flask', 'db', 'upgrade'], cwd=ROOT, env=self.env, check=True,
+                       stdout=subprocess.DEVNULL)
+        code = f"from pc_app.server import app, socketio; socketio.run(app, host='127.0.0.1', port={self.port})"
+        self.proc = subprocess.Popen([sys.executable, '-c', code], cwd=ROOT, env=self.env,
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f'server exited with code {self.proc.returncode}')
+            try:
+                if requests.get(self.base_url + '/', timeout=1).status_code == 200:
+                    return self
+            except requests.exceptions.ConnectionError:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError('server did not start in time')
+
+    def stop(self):
+        if self.proc and self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def register_user(base_url, username, password='bench-password'):
+    requests.post(f'{base_url}/register', json={'username': username, 'password': password}).raise_for_status()
+    response = requests.post(f'{base_url}/login', json={'username': username, 'password': password})
+    response.raise_for_status()
+    token = response.json()['token']
+    user_id = jwt.decode(token, options={"verify_signature": False})['user_id']
+    return {'id': user_id, 'username': username, 'token': token}
+
+
+def create_chat(base_url, user, other):
+    headers = {'x-access-token': user['token']}
+    requests.post(f'{base_url}/contacts/add', json={'contact_id': other['id']}, headers=headers)
+    requests.post(f'{base_url}/contacts/add', json={'contact_id': user['id']}, headers={'x-access-token': other['token']})
+    response = requests.post(f'{base_url}/chats/create', json={'contact_id': other['id']}, headers=headers)
+    response.raise_for_status()
+    return response.json()['chat_id']
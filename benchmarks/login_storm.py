@@ -0,0 +1,104 @@
+# Задержка доставки сообщений через сокет во время массовых логинов.
+#
+# Запуск (из корня репозитория):
+#   python benchmarks/login_storm.py --logins 16 --duration 10
+#
+# Сначала замеряется задержка send_message -> message без нагрузки, затем то же самое,
+# пока несколько потоков непрерывно вызывают /login (pbkdf2 на сервере).
+# Если хеширование блокирует цикл событий, задержка во второй фазе растёт на порядки.
+import argparse
+import os
+import sys
+import threading
+import time
+
+import requests
+import socketio
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from harness import ServerProcess, register_user, create_chat, percentile, BENCH_RATE_LIMIT_ENV
+
+
+def measure_latency(sender, chat_id, received, duration, interval=0.02):
+    latencies = []
+    deadline = time.time() + duration
+    seq = 0
+    while time.time() < deadline:
+        seq += 1
+        event = threading.Event()
+        received[str(seq)] = (event, time.perf_counter())
+        sender.emit('send_message', {'room': chat_id, 'content': str(seq)})
+        if event.wait(5):
+            latencies.append(received.pop(str(seq))[1] * 1000)
+        else:
+            received.pop(str(seq), None)
+        time.sleep(interval)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Socket latency during a login storm')
+    parser.add_argument('--logins', type=int, default=16, help='concurrent login threads')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per phase')
+    args = parser.parse_args()
+
+    # Замер отправляет 50 сообщений в секунду - больше лимита send_message по умолчанию
+    with ServerProcess(env=BENCH_RATE_LIMIT_ENV) as server:
+        alice = register_user(server.base_url, 'storm_alice')
+        bob = register_user(server.base_url, 'storm_bob')
+        storm_user = register_user(server.base_url, 'storm_user')
+        chat_id = create_chat(server.base_url, alice, bob)
+
+        received = {}
+
+        sender = socketio.Client()
+        receiver = socketio.Client()
+
+        @receiver.on('message')
+        def on_message(data):
+            if isinstance(data, dict) and data.get('content') in received:
+                event, sent_at = received[data['content']]
+                received[data['content']] = (event, time.perf_counter() - sent_at)
+                event.set()
+
+        sender.connect(f"{server.base_url}?token={alice['token']}", transports=['websocket'])
+        receiver.connect(f"{server.base_url}?token={bob['token']}", transports=['websocket'])
+        sender.emit('join', {'room': chat_id})
+        receiver.emit('join', {'room': chat_id})
+        time.sleep(0.5)
+
+        idle = measure_latency(sender, chat_id, received, args.duration)
+
+        stop = threading.Event()
+        login_count = [0]
+        rejected = [0]
+
+        def storm():
+            session = requests.Session()
+            while not stop.is_set():
+                response = session.post(f'{server.base_url}/login',
+                                        json={'username': storm_user['username'], 'password': 'bench-password'})
+                if response.status_code == 503:
+                    rejected[0] += 1
+                else:
+                    login_count[0] += 1
+
+        threads = [threading.Thread(target=storm, daemon=True) for _ in range(args.logins)]
+        for thread in threads:
+            thread.start()
+        loaded = measure_latency(sender, chat_id, received, args.duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        sender.disconnect()
+        receiver.disconnect()
+
+    print(f'{"phase":<14} {"samples":>8} {"p50 ms":>8} {"p95 ms":>8} {"max ms":>8}')
+    for name, values in (('idle', idle), ('login storm', loaded)):
+        print(f'{name:<14} {len(values):>8} {percentile(values, 50):>8.1f} {percentile(values, 95):>8.1f} {max(values or [0]):>8.1f}')
+    print(f'logins: {login_count[0]} ({login_count[0] / args.duration:.1f}/s), rejected with 503: {rejected[0]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# Бенчмарк записи сообщений: прямой коммит на каждое сообщение против write-behind с групповыми коммитами.
+#
+# Запуск (из корня репозитория):
+#   python benchmarks/message_persistence.py --messages 5000
+#   DATABASE_URL=postgresql://... python benchmarks/message_persistence.py
+#
+# Замеряется путь, который проходит handle_send_message: запись + денормализованные поля чата.
+# Для write-behind время включает финальный сброс очереди, т.е. все сообщения действительно в БД.
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark message persistence')
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--interval', type=float, default=0.05)
+    args = parser.parse_args()
+
+    if not os.environ.get('DATABASE_URL'):
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'persistence_bench.db')
+
+    import eventlet
+    from flask_migrate import upgrade
+    from pc_app import server
+    from pc_app.server import app, db, User, Chat, ChatReadCursor, Message
+
+    with app.app_context():
+        upgrade(directory=os.path.join(ROOT, 'migrations'))
+        alice = User(username='bench_alice', username_lower='bench_alice', password='x')
+        bob = User(username='bench_bob', username_lower='bench_bob', password='x')
+        db.session.add_all([alice, bob])
+        db.session.flush()
+        chat = Chat(user1_id=min(alice.id, bob.id), user2_id=max(alice.id, bob.id))
+        db.session.add(chat)
+        db.session.flush()
+        db.session.add_all([ChatReadCursor(chat_id=chat.id, user_id=alice.id), ChatReadCursor(chat_id=chat.id, user_id=bob.id)])
+        db.session.commit()
+
+        start = time.perf_counter()
+        for i in range(args.messages):
+            server.persist_message(chat, alice.id, f'direct {i}', False)
+        direct = time.perf_counter() - start
+
+        writer = server.MessageWriteBehind(args.batch_size, args.interval)
+        start = time.perf_counter()
+        for i in range(args.messages):
+            writer.enqueue(chat.id, alice.id, f'batched {i}', False)
+            # Как между событиями сокета: даём фоновому сбросу шанс выполниться
+            eventlet.sleep(0)
+        writer.flush()
+        batched = time.perf_counter() - start
+
+        stored = Message.query.filter_by(chat_id=chat.id).count()
+        print(f'database:            {db.engine.url.render_as_string(hide_password=True)}')
+        print(f'messages stored:     {stored} (expected {2 * args.messages})')
+        print(f'direct commits:      {args.messages / direct:10.1f} msg/s')
+        print(f'write-behind:        {args.messages / batched:10.1f} msg/s  ({writer.batches} group commits)')
+        print(f'speedup:             {direct / batched:10.1f}x')
+
+
+if __name__ == '__main__':
+    main()
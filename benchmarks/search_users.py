@@ -0,0 +1,85 @@
+# Бенчмарк поиска пользователей /users/search на базе с большим числом пользователей.
+#
+# Запуск (из корня репозитория):
+#   python benchmarks/search_users.py --users 1000000
+#
+# Схема создаётся миграциями, поэтому используются те же индексы, что и в продакшене.
+# Для сравнения замеряется и старый запрос ILIKE '%q%' без ограничения.
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+SYLLABLES = ['al', 'ex', 'ma', 'ri', 'ko', 'sa', 'sha', 'ni', 'ta', 'dy', 'mi', 'ra', 'ole', 'gor', 'va', 'lia']
+QUERIES = ['al', 'ale', 'alex', 'kosa', 'sha', 'rira1', 'xma', 'gorva12']
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def seed_users(db, User, count, batch_size=50000):
+    rnd = random.Random(42)
+    inserted = 0
+    while inserted < count:
+        rows = []
+        for i in range(inserted, min(count, inserted + batch_size)):
+            name = ''.join(rnd.choice(SYLLABLES) for _ in range(rnd.randint(2, 3))) + str(i)
+            rows.append({'username': name, 'username_lower': name.lower(), 'password': 'x'})
+        db.session.execute(User.__table__.insert(), rows)
+        db.session.commit()
+        inserted += len(rows)
+        print(f'  seeded {inserted}/{count}', file=sys.stderr)
+
+
+def measure(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark /users/search')
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--db', help='path to the SQLite database (default: temporary file)')
+    parser.add_argument('--skip-legacy', action='store_true', help="don't measure the old ILIKE '%%q%%' query")
+    args = parser.parse_args()
+
+    db_path = args.db or os.path.join(tempfile.mkdtemp(), 'search_bench.db')
+    fresh = not os.path.exists(db_path)
+    os.environ['DATABASE_URL'] = 'sqlite:///' + db_path
+
+    from flask_migrate import upgrade
+    from pc_app.server import app, db, User
+
+    with app.app_context():
+        upgrade(directory=os.path.join(ROOT, 'migrations'))
+        if fresh:
+            print(f'Seeding {args.users} users into {db_path}', file=sys.stderr)
+            seed_users(db, User, args.users)
+
+        client = app.test_client()
+        print(f'{"query":<10} {"search p50 ms":>14} {"search p95 ms":>14} {"legacy p50 ms":>14} {"legacy rows":>12}')
+        for q in QUERIES:
+            search = measure(lambda: client.get('/users/search', query_string={'username': q}), args.repeat)
+            legacy_p50, legacy_rows = '-', '-'
+            if not args.skip_legacy:
+                legacy = measure(lambda: User.query.filter(User.username.ilike(f'%{q}%')).all(), max(1, args.repeat // 4))
+                legacy_p50 = f'{statistics.median(legacy):.2f}'
+                legacy_rows = User.query.filter(User.username.ilike(f'%{q}%')).count()
+            print(f'{q:<10} {statistics.median(search):>14.2f} {percentile(search, 95):>14.2f} {legacy_p50:>14} {legacy_rows:>12}')
+
+
+if __name__ == '__main__':
+    main()
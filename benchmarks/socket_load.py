@@ -0,0 +1,172 @@
+# Нагрузочный тест пути сообщений через Socket.IO: пропускная способность и задержка доставки.
+#
+# Запуск (из корня репозитория):
+#   python benchmarks/socket_load.py --pairs 20 --messages 50
+#   python benchmarks/socket_load.py --write-behind --json result.json --max-p95-ms 200   # в CI
+#
+# Сервер запускается на чистой SQLite, создаются пары пользователей с контактами и чатом.
+# Каждый пользователь - отдельное соединение socketio.Client: join в свой чат, затем оба участника
+# пары одновременно отправляют --messages сообщений. Задержка - от emit('send_message') до получения
+# события message собеседником (отправитель и получатель в одном процессе, часы общие).
+# Лимиты частоты на сервере подняты, чтобы замерять сам путь сообщения, а не ограничитель.
+# Код выхода 1, если сообщения потерялись или p95 больше --max-p95-ms.
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+import socketio
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from harness import ServerProcess, register_user, create_chat, percentile, BENCH_RATE_LIMIT_ENV
+
+
+class LoadClient:
+    def __init__(self, base_url, user, chat_id, stats):
+        self.user = user
+        self.chat_id = chat_id
+        self.stats = stats
+        self.joined = threading.Event()
+        self.sio = socketio.Client()
+        self.sio.on('message', self.on_message)
+        self.sio.on('rate_limited', self.on_rate_limited)
+        self.sio.connect(f"{base_url}?token={user['token']}", transports=['websocket'])
+
+    def on_message(self, data):
+        # content: bench:<id отправителя>:<номер>:<время отправки>
+        parts = data.get('content', '').split(':') if isinstance(data, dict) else []
+        if len(parts) != 4 or parts[0] != 'bench':
+            return
+        if parts[2] == '0':
+            # Пробник (см. join): собственный вернулся из комнаты - значит чат подключён
+            if int(parts[1]) == self.user['id']:
+                self.joined.set()
+            return
+        if int(parts[1]) == self.user['id']:
+            return
+        self.stats.record(time.perf_counter() - float(parts[3]))
+
+    def on_rate_limited(self, data):
+        self.stats.note_rate_limited()
+
+    def join(self, timeout=10):
+        # Сообщение-пробник подтверждает, что join обработан до начала замера
+        self.sio.emit('join', {'room': self.chat_id})
+        deadline = time.time() + timeout
+        while not self.joined.is_set() and time.time() < deadline:
+            self.sio.emit('send_message', {'room': self.chat_id, 'content': f"bench:{self.user['id']}:0:0"})
+            self.joined.wait(0.5)
+        if not self.joined.is_set():
+            raise RuntimeError(f"user {self.user['username']} could not join chat {self.chat_id}")
+
+    def send_all(self, count, interval, start_barrier):
+        start_barrier.wait()
+        for i in range(1, count + 1):
+            self.sio.emit('send_message', {'room': self.chat_id,
+                                           'content': f"bench:{self.user['id']}:{i}:{time.perf_counter():.9f}"})
+            if interval:
+                time.sleep(interval)
+
+    def close(self):
+        self.sio.disconnect()
+
+
+class LatencyStats:
+    def __init__(self):
+        self.latencies = []
+        self.rate_limited = 0
+        self.first_sent = None
+        self.last_received = None
+        self._lock = threading.Lock()
+
+    def record(self, latency):
+        with self._lock:
+            self.latencies.append(latency * 1000)
+            self.last_received = time.perf_counter()
+
+    def note_rate_limited(self):
+        with self._lock:
+            self.rate_limited += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Socket.IO messaging load test')
+    parser.add_argument('--pairs', type=int, default=10, help='chats; each has two connected users')
+    parser.add_argument('--messages', type=int, default=50, help='messages sent by each user')
+    parser.add_argument('--rate', type=float, default=0, help='messages per second per user (0 - as fast as possible)')
+    parser.add_argument('--write-behind', action='store_true', help='run the server with MESSAGE_WRITE_BEHIND=1')
+    parser.add_argument('--timeout', type=float, default=60.0, help='seconds to wait for deliveries')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--max-p95-ms', type=float, help='fail if p95 latency is above this value')
+    args = parser.parse_args()
+
+    env = dict(BENCH_RATE_LIMIT_ENV)
+    if args.write_behind:
+        env['MESSAGE_WRITE_BEHIND'] = '1'
+
+    stats = LatencyStats()
+    clients = []
+    with ServerProcess(env=env) as server:
+        for i in range(args.pairs):
+            alice = register_user(server.base_url, f'load_{i}_a')
+            bob = register_user(server.base_url, f'load_{i}_b')
+            chat_id = create_chat(server.base_url, alice, bob)
+            clients.append(LoadClient(server.base_url, alice, chat_id, stats))
+            clients.append(LoadClient(server.base_url, bob, chat_id, stats))
+        for client in clients:
+            client.join()
+
+        expected = len(clients) * args.messages
+        interval = 1 / args.rate if args.rate else 0
+        start_barrier = threading.Barrier(len(clients) + 1)
+        threads = [threading.Thread(target=client.send_all, args=(args.messages, interval, start_barrier), daemon=True)
+                   for client in clients]
+        for thread in threads:
+            thread.start()
+        start_barrier.wait()
+        stats.first_sent = time.perf_counter()
+        for thread in threads:
+            thread.join()
+
+        deadline = time.time() + args.timeout
+        while len(stats.latencies) < expected and time.time() < deadline:
+            time.sleep(0.1)
+
+        for client in clients:
+            client.close()
+
+    received = len(stats.latencies)
+    elapsed = (stats.last_received or stats.first_sent) - stats.first_sent
+    result = {
+        'clients': len(clients),
+        'write_behind': args.write_behind,
+        'expected': expected,
+        'received': received,
+        'rate_limited': stats.rate_limited,
+        'messages_per_second': received / elapsed if elapsed > 0 else 0.0,
+        'p50_ms': percentile(stats.latencies, 50),
+        'p95_ms': percentile(stats.latencies, 95),
+        'p99_ms': percentile(stats.latencies, 99),
+        'max_ms': max(stats.latencies or [0])
+    }
+
+    print(f"clients:       {result['clients']} ({args.pairs} chats, write-behind: {'on' if args.write_behind else 'off'})")
+    print(f"delivered:     {received}/{expected}  (rate limited: {stats.rate_limited})")
+    print(f"throughput:    {result['messages_per_second']:.1f} msg/s")
+    print(f"latency ms:    p50 {result['p50_ms']:.1f}  p95 {result['p95_ms']:.1f}  "
+          f"p99 {result['p99_ms']:.1f}  max {result['max_ms']:.1f}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+
+    failed = received < expected
+    if args.max_p95_ms is not None and not result['p95_ms'] <= args.max_p95_ms:
+        print(f"p95 {result['p95_ms']:.1f} ms is above the limit of {args.max_p95_ms} ms")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""initial schema
+
+Revision ID: 0001
+Revises: 
+Create Date: 2026-10-18 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Таблицы могли быть созданы раньше через db.create_all(), поэтому создаём только недостающие
+    existing = set(sa.inspect(op.get_bind()).get_table_names())
+
+    if 'user' not in existing:
+        op.create_table('user',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('username', sa.String(length=80), nullable=False),
+            sa.Column('password', sa.String(length=120), nullable=False),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('username')
+        )
+    if 'contact' not in existing:
+        op.create_table('contact',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('user_id', sa.Integer(), nullable=False),
+            sa.Column('contact_id', sa.Integer(), nullable=False),
+            sa.ForeignKeyConstraint(['contact_id'], ['user.id'], ),
+            sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('user_id', 'contact_id', name='_user_contact_uc')
+        )
+    if 'chat' not in existing:
+        op.create_table('chat',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('user1_id', sa.Integer(), nullable=False),
+            sa.Column('user2_id', sa.Integer(), nullable=False),
+            sa.ForeignKeyConstraint(['user1_id'], ['user.id'], ),
+            sa.ForeignKeyConstraint(['user2_id'], ['user.id'], ),
+            sa.PrimaryKeyConstraint('id')
+        )
+    if 'message' not in existing:
+        op.create_table('message',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('chat_id', sa.Integer(), nullable=False),
+            sa.Column('sender_id', sa.Integer(), nullable=False),
+            sa.Column('content', sa.Text(), nullable=False),
+            sa.Column('timestamp', sa.DateTime(), nullable=False),
+            sa.Column('is_audio', sa.Boolean(), nullable=False),
+            sa.ForeignKeyConstraint(['chat_id'], ['chat.id'], ),
+            sa.ForeignKeyConstraint(['sender_id'], ['user.id'], ),
+            sa.PrimaryKeyConstraint('id')
+        )
+
+
+def downgrade():
+    op.drop_table('message')
+    op.drop_table('chat')
+    op.drop_table('contact')
+    op.drop_table('user')
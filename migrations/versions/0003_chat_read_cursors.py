@@ -0,0 +1,48 @@
+"""chat read cursors and denormalized last message
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 09:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('chat', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('last_message_id', sa.Integer(), nullable=True))
+
+    op.create_table('chat_read_cursor',
+        sa.Column('chat_id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('last_read_message_id', sa.Integer(), nullable=False),
+        sa.Column('unread_count', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['chat_id'], ['chat.id'], ),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('chat_id', 'user_id')
+    )
+
+    # Существующая история считается прочитанной
+    op.execute(
+        "UPDATE chat SET last_message_id = "
+        "(SELECT MAX(message.id) FROM message WHERE message.chat_id = chat.id)"
+    )
+    for member_column in ('user1_id', 'user2_id'):
+        op.execute(
+            "INSERT INTO chat_read_cursor (chat_id, user_id, last_read_message_id, unread_count) "
+            f"SELECT id, {member_column}, COALESCE(last_message_id, 0), 0 FROM chat"
+        )
+
+
+def downgrade():
+    op.drop_table('chat_read_cursor')
+    with op.batch_alter_table('chat', schema=None) as batch_op:
+        batch_op.drop_column('last_message_id')
@@ -0,0 +1,38 @@
+"""lowercase username column with search indexes
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 09:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('username_lower', sa.String(length=80), nullable=True))
+
+    op.execute('UPDATE "user" SET username_lower = LOWER(username)')
+
+    # Префиксный поиск - диапазон username_lower >= q AND username_lower < q || U+10FFFF по обычному btree,
+    # тот же индекс отдаёт строки уже в порядке ORDER BY username_lower. Подстрока на Postgres - по триграммам.
+    op.execute('CREATE INDEX ix_user_username_lower ON "user" (username_lower)')
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        op.execute('CREATE INDEX ix_user_username_lower_trgm ON "user" USING gin (username_lower gin_trgm_ops)')
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('DROP INDEX ix_user_username_lower_trgm')
+    op.execute('DROP INDEX ix_user_username_lower')
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('username_lower')
@@ -0,0 +1,37 @@
+"""precomputed voice message duration and waveform
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18 12:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('blob', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('duration', sa.Float(), nullable=True))
+        batch_op.add_column(sa.Column('waveform', sa.Text(), nullable=True))
+
+    # У старых сообщений метаданных нет, клиенты показывают их без длительности
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('audio_duration', sa.Float(), nullable=True))
+        batch_op.add_column(sa.Column('audio_waveform', sa.Text(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.drop_column('audio_waveform')
+        batch_op.drop_column('audio_duration')
+
+    with op.batch_alter_table('blob', schema=None) as batch_op:
+        batch_op.drop_column('waveform')
+        batch_op.drop_column('duration')
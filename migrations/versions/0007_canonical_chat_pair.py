@@ -0,0 +1,70 @@
+"""canonical ordered chat pair with unique constraint
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18 13:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0007'
+down_revision = '0006'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    bind = op.get_bind()
+
+    # Пара участников упорядочивается: user1_id < user2_id (в SET используются старые значения строки)
+    op.execute('UPDATE chat SET user1_id = user2_id, user2_id = user1_id WHERE user1_id > user2_id')
+
+    # Дубликаты одной пары сливаются в чат с наименьшим id
+    duplicates = bind.execute(sa.text(
+        'SELECT user1_id, user2_id, MIN(id) FROM chat GROUP BY user1_id, user2_id HAVING COUNT(*) > 1'
+    )).fetchall()
+    for user1_id, user2_id, keep_id in duplicates:
+        params = {'user1_id': user1_id, 'user2_id': user2_id, 'keep_id': keep_id}
+        merged_ids = [row[0] for row in bind.execute(sa.text(
+            'SELECT id FROM chat WHERE user1_id = :user1_id AND user2_id = :user2_id AND id != :keep_id'
+        ), params)]
+        for merged_id in merged_ids:
+            merge = {'keep_id': keep_id, 'merged_id': merged_id}
+            bind.execute(sa.text('UPDATE message SET chat_id = :keep_id WHERE chat_id = :merged_id'), merge)
+            # Курсор прочтения оставшегося чата - самый дальний из курсоров сливаемых чатов
+            for user_id, last_read in bind.execute(sa.text(
+                'SELECT user_id, last_read_message_id FROM chat_read_cursor WHERE chat_id = :merged_id'
+            ), merge).fetchall():
+                bind.execute(sa.text(
+                    'UPDATE chat_read_cursor SET last_read_message_id = :last_read '
+                    'WHERE chat_id = :keep_id AND user_id = :user_id AND last_read_message_id < :last_read'
+                ), dict(merge, user_id=user_id, last_read=last_read))
+            bind.execute(sa.text('DELETE FROM chat_read_cursor WHERE chat_id = :merged_id'), merge)
+            bind.execute(sa.text('DELETE FROM chat WHERE id = :merged_id'), merge)
+
+        # Денормализованные поля пересчитываются по объединённой истории
+        bind.execute(sa.text(
+            'UPDATE chat SET last_message_id = (SELECT MAX(id) FROM message WHERE message.chat_id = chat.id) '
+            'WHERE id = :keep_id'
+        ), params)
+        bind.execute(sa.text(
+            'UPDATE chat_read_cursor SET unread_count = ('
+            'SELECT COUNT(*) FROM message WHERE message.chat_id = chat_read_cursor.chat_id '
+            'AND message.sender_id != chat_read_cursor.user_id '
+            'AND message.id > chat_read_cursor.last_read_message_id) '
+            'WHERE chat_id = :keep_id'
+        ), params)
+
+    with op.batch_alter_table('chat', schema=None) as batch_op:
+        batch_op.create_unique_constraint('uq_chat_user_pair', ['user1_id', 'user2_id'])
+        batch_op.create_index('ix_chat_user2_id', ['user2_id'], unique=False)
+
+
+def downgrade():
+    # Слияние дубликатов и порядок пары не откатываются
+    with op.batch_alter_table('chat', schema=None) as batch_op:
+        batch_op.drop_index('ix_chat_user2_id')
+        batch_op.drop_constraint('uq_chat_user_pair', type_='unique')
@@ -0,0 +1,41 @@
+"""per-chat event sequence numbers
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0009'
+down_revision = '0008'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Нумерация начинается с нуля: у старых сообщений номера нет, для них работает /sync и полная загрузка
+    with op.batch_alter_table('chat', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('last_seq', sa.Integer(), nullable=False, server_default='0'))
+
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('seq', sa.Integer(), nullable=True))
+
+    with op.batch_alter_table('change_log', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('seq', sa.Integer(), nullable=True))
+        batch_op.create_index('ix_change_log_chat_id_seq', ['chat_id', 'seq'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('change_log', schema=None) as batch_op:
+        batch_op.drop_index('ix_change_log_chat_id_seq')
+        batch_op.drop_column('seq')
+
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.drop_column('seq')
+
+    with op.batch_alter_table('chat', schema=None) as batch_op:
+        batch_op.drop_column('last_seq')
@@ -0,0 +1,151 @@
+# Обработка голосовых сообщений на сервере.
+import os
+import shutil
+import subprocess
+import time
+import wave
+
+import eventlet
+import numpy as np
+from eventlet.queue import LightQueue, Full
+
+TRANSCODED_AUDIO_EXT = '.ogg'
+TRANSCODED_AUDIO_MIMETYPE = 'audio/ogg'
+WAVEFORM_PEAKS = 64
+
+
+# Длительность (секунды) и огибающая записи: WAVEFORM_PEAKS пиков 0..255, нормированных по максимуму.
+# Считается один раз при загрузке, клиенты показывают длину и форму волны, не скачивая файл.
+def analyze_wav(path, peaks=WAVEFORM_PEAKS):
+    with wave.open(path, 'rb') as wav:
+        channels = wav.getnchannels()
+        width = wav.getsampwidth()
+        rate = wav.getframerate()
+        frames = wav.getnframes()
+        data = wav.readframes(frames)
+    # У обрезанного файла данных меньше, чем в заголовке, и они могут кончаться посреди кадра:
+    # неполный кадр отбрасываем, длительность считаем по тому, что есть
+    frame_size = width * channels
+    frames = min(frames, len(data) // frame_size) if frame_size else 0
+    data = data[:frames * frame_size]
+    duration = frames / rate if rate else 0.0
+
+    dtype = {1: np.uint8, 2: '<i2', 4: '<i4'}.get(width)
+    if dtype is None or not frames:
+        return duration, []
+    samples = np.frombuffer(data, dtype=dtype).astype(np.float32)
+    if width == 1:
+        samples -= 128 # 8-битный WAV беззнаковый
+    # Амплитуда кадра - максимум по каналам
+    amplitude = np.abs(samples).reshape(-1, channels).max(axis=1)
+
+    count = min(peaks, len(amplitude))
+    edges = np.linspace(0, len(amplitude), count + 1).astype(np.int64)[:-1]
+    values = np.maximum.reduceat(amplitude, edges)
+    top = values.max()
+    if top > 0:
+        values = values * (255 / top)
+    return duration, values.round().astype(int).tolist()
+
+
+# Фоновое перекодирование WAV (PCM 44.1 кГц) в Opus/OGG.
+# Каждый воркер запускает отдельный процесс ffmpeg, т.е. фактически это пул процессов;
+# subprocess после eventlet.monkey_patch() не блокирует цикл событий, пока ffmpeg работает.
+# Очередь ограничена: если она заполнена, файл остаётся в WAV.
+class AudioTranscoder:
+    def __init__(self, workers, max_queue, ffmpeg='ffmpeg', bitrate='24k'):
+        self.ffmpeg = shutil.which(ffmpeg)
+        self.workers = workers
+        self.bitrate = bitrate
+        self._queue = LightQueue(max_queue)
+        self._started = False
+        self.completed = 0
+        self.failed = 0
+        self.skipped = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self.transcode_time_total = 0.0
+        if not self.ffmpeg:
+            print(f"ffmpeg ({ffmpeg}) не найден, голосовые сообщения хранятся без сжатия")
+
+    @property
+    def enabled(self):
+        return self.ffmpeg is not None
+
+    def submit(self, wav_path):
+        if not self.enabled:
+            return False
+        if not self._started:
+            self._started = True
+            for _ in range(self.workers):
+                eventlet.spawn(self._worker)
+        try:
+            self._queue.put_nowait((wav_path, time.time()))
+        except Full:
+            self.skipped += 1
+            return False
+        return True
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _worker(self):
+        while True:
+            wav_path, queued_at = self._queue.get()
+            try:
+                self._transcode(wav_path, time.time() - queued_at)
+            except Exception as e:
+                self.failed += 1
+                print(f"Transcoding error for {wav_path}: {e}")
+
+    def _transcode(self, wav_path, queue_wait):
+        if not os.path.exists(wav_path):
+            return
+        output_path = os.path.splitext(wav_path)[0] + TRANSCODED_AUDIO_EXT
+        tmp_path = output_path + '.tmp'
+        start = time.time()
+        result = subprocess.run(
+            [self.ffmpeg, '-nostdin', '-loglevel', 'error', '-y', '-i', wav_path,
+             '-c:a', 'libopus', '-b:a', self.bitrate, '-ac', '1', '-application', 'voip',
+             '-f', 'ogg', tmp_path],
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+        )
+        elapsed = time.time() - start
+        if result.returncode != 0:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            self.failed += 1
+            print(f"ffmpeg failed for {wav_path}: {result.stderr.decode(errors='replace').strip()}")
+            return
+
+        # Сжатая версия появляется атомарно, и только после этого удаляется исходный WAV
+        os.replace(tmp_path, output_path)
+        size_in = os.path.getsize(wav_path)
+        size_out = os.path.getsize(output_path)
+        os.remove(wav_path)
+
+        self.completed += 1
+        self.bytes_in += size_in
+        self.bytes_out += size_out
+        self.queue_wait_total += queue_wait
+        self.queue_wait_max = max(self.queue_wait_max, queue_wait)
+        self.transcode_time_total += elapsed
+        print(f"Transcoded {os.path.basename(wav_path)}: {size_in} -> {size_out} bytes "
+              f"({size_out / size_in:.1%}), queued {queue_wait:.2f}s, ffmpeg {elapsed:.2f}s")
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'pending': self.pending(),
+            'completed': self.completed,
+            'failed': self.failed,
+            'skipped': self.skipped,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'size_ratio': self.bytes_out / self.bytes_in if self.bytes_in else None,
+            'queue_wait_avg': self.queue_wait_total / self.completed if self.completed else None,
+            'queue_wait_max': self.queue_wait_max,
+            'transcode_time_avg': self.transcode_time_total / self.completed if self.completed else None
+        }
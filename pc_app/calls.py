@@ -0,0 +1,174 @@
+# Сессии звонков: одна машина состояний для всех событий сигнализации.
+#
+#   ringing --accept--> active --end--> (ended)
+#   ringing --decline--> (declined)
+#   ringing --end (звонящий)--> (cancelled)
+#   ringing --CALL_RING_TIMEOUT--> (missed)
+#   любое --отключение устройства участника--> (dropped)
+#
+# Сессии хранятся в общем состоянии (state.mapping), рядом индекс user_id -> call_id,
+# поэтому звонок пользователя находится за O(1), а у одного пользователя не больше одного звонка.
+# Проверка и изменение сессии выполняются под блокировкой state.lock, общей для всех воркеров:
+# иначе два воркера могут одновременно пропустить проверку "занят" или вернуть удалённую сессию.
+# Завершённые сессии сразу удаляются; зависшие (например, воркер с таймером упал) удаляются
+# после max_duration (ещё не отвеченные - после двойного ring_timeout) при обращении к ним
+# или при периодическом обходе всех сессий.
+import time
+import uuid
+from contextlib import contextmanager
+
+from pc_app.state import LockTimeout
+
+RINGING = 'ringing'
+ACTIVE = 'active'
+SWEEP_INTERVAL = 60 # секунды между обходами всех сессий
+
+
+class CallError(Exception):
+    pass
+
+
+class CallManager:
+    def __init__(self, sessions, by_user, lock, notify, spawn_after, ring_timeout, max_duration):
+        self.sessions = sessions # {call_id: session}
+        self.by_user = by_user # {user_id: call_id} - и звонящий, и вызываемый
+        self.lock = lock # state.lock(...): звонки в каждый момент меняет только один воркер
+        self.notify = notify # notify(user_id, event, payload)
+        self.spawn_after = spawn_after # spawn_after(seconds, func, *args)
+        self.ring_timeout = ring_timeout
+        self.max_duration = max_duration
+        self._last_sweep = 0.0
+        self.outcomes = {}
+        self.setup_count = 0
+        self.setup_time_total = 0.0
+        self.setup_time_max = 0.0
+
+    def session_for(self, user_id):
+        call_id = self.by_user.get(user_id)
+        if call_id is None:
+            return None
+        session = self.sessions.get(call_id)
+        if session is None or self._expired(session, time.time()):
+            self._remove(call_id, session, 'expired', user_id)
+            return None
+        return session
+
+    def _expired(self, session, now):
+        limit = self.ring_timeout * 2 if session['state'] == RINGING else self.max_duration
+        return now - session['created_at'] > limit
+
+    def sweep(self):
+        # Обход по возрасту находит и сессии, на которые уже не указывает индекс by_user
+        now = time.time()
+        for call_id, session in list(self.sessions.items()):
+            if self._expired(session, now):
+                self._remove(call_id, session, 'expired')
+
+    @contextmanager
+    def _locked(self):
+        try:
+            with self.lock:
+                yield
+        except LockTimeout:
+            raise CallError('Сервер занят, повторите попытку')
+
+    def start(self, caller_id, caller_sid, callee_id, channel_name, **extra):
+        if caller_id == callee_id:
+            raise CallError('Нельзя позвонить самому себе')
+        with self._locked():
+            if time.time() - self._last_sweep > SWEEP_INTERVAL:
+                self._last_sweep = time.time()
+                self.sweep()
+            if self.session_for(caller_id):
+                raise CallError('У вас уже есть активный звонок')
+            if self.session_for(callee_id):
+                self._count('busy')
+                raise CallError('Абонент занят')
+            session = dict(extra, call_id=uuid.uuid4().hex, caller_id=caller_id, callee_id=callee_id,
+                           channel_name=channel_name, state=RINGING, created_at=time.time(),
+                           caller_sid=caller_sid, callee_sid=None)
+            self.sessions[session['call_id']] = session
+            self.by_user[caller_id] = session['call_id']
+            self.by_user[callee_id] = session['call_id']
+        self.spawn_after(self.ring_timeout, self._ring_timeout, session['call_id'])
+        return session
+
+    def accept(self, callee_id, callee_sid):
+        with self._locked():
+            session = self.session_for(callee_id)
+            if not session or session['callee_id'] != callee_id or session['state'] != RINGING:
+                raise CallError('Нет входящего звонка')
+            session['state'] = ACTIVE
+            session['callee_sid'] = callee_sid
+            session['answered_at'] = time.time()
+            self.sessions[session['call_id']] = session # в Redis значение нужно записать целиком
+        setup_time = session['answered_at'] - session['created_at']
+        self.setup_count += 1
+        self.setup_time_total += setup_time
+        self.setup_time_max = max(self.setup_time_max, setup_time)
+        self._count('answered')
+        return session
+
+    def decline(self, callee_id):
+        with self._locked():
+            session = self.session_for(callee_id)
+            if not session or session['callee_id'] != callee_id or session['state'] != RINGING:
+                raise CallError('Нет входящего звонка')
+            self._remove(session['call_id'], session, 'declined')
+        return session
+
+    def end(self, user_id):
+        # Возвращает (сессия, id собеседника)
+        with self._locked():
+            session = self.session_for(user_id)
+            if not session:
+                raise CallError('Нет активного звонка')
+            outcome = 'ended' if session['state'] == ACTIVE else 'cancelled'
+            self._remove(session['call_id'], session, outcome)
+        return session, self.other_party(session, user_id)
+
+    def disconnect(self, user_id, sid, went_offline):
+        # Звонок завершается, если отключилось устройство, на котором он идёт,
+        # или у пользователя не осталось устройств
+        with self._locked():
+            session = self.session_for(user_id)
+            if not session or not (went_offline or sid in (session['caller_sid'], session['callee_sid'])):
+                return None, None
+            self._remove(session['call_id'], session, 'dropped')
+        return session, self.other_party(session, user_id)
+
+    def other_party(self, session, user_id):
+        return session['callee_id'] if session['caller_id'] == user_id else session['caller_id']
+
+    def _ring_timeout(self, call_id):
+        try:
+            with self._locked():
+                session = self.sessions.get(call_id)
+                if not session or session['state'] != RINGING:
+                    return
+                self._remove(call_id, session, 'missed')
+        except CallError:
+            # Блокировку держит другой воркер - попробуем позже
+            self.spawn_after(1, self._ring_timeout, call_id)
+            return
+        for user_id in (session['caller_id'], session['callee_id']):
+            self.notify(user_id, 'call_hangup', {'callId': call_id, 'reason': 'no_answer'})
+
+    def _remove(self, call_id, session, outcome, user_id=None):
+        self.sessions.pop(call_id, None)
+        members = (session['caller_id'], session['callee_id']) if session else (user_id,)
+        for member_id in members:
+            if self.by_user.get(member_id) == call_id:
+                self.by_user.pop(member_id, None)
+        self._count(outcome)
+
+    def _count(self, outcome):
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    def stats(self):
+        return {
+            'active': len(self.sessions),
+            'outcomes': dict(self.outcomes),
+            'setup_time_avg': self.setup_time_total / self.setup_count if self.setup_count else None,
+            'setup_time_max': self.setup_time_max
+        }
@@ -9,12 +9,39 @@ import wave
 import pygame
 import tempfile
 import shutil
+import os
+import json
+import time
 import agorartc
 
 # It's recommended to move App ID to an environment variable
 AGORA_APP_ID = "96619c27fbeb4332b25e1413e8f3ce9f"
 
 BASE_URL = 'https://messenger-with-app.onrender.com'
+MESSAGES_PAGE_SIZE = 50
+UPLOAD_MAX_RETRIES = 5
+# Кэш скачанных голосовых сообщений
+AUDIO_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'messenger_audio_cache')
+CALL_HANGUP_REASONS = {
+    'no_answer': "Нет ответа.",
+    'disconnected': "Связь с собеседником потеряна.",
+    'answered_elsewhere': "Звонок принят на другом устройстве.",
+    'declined': "Звонок отклонён на другом устройстве."
+}
+
+WAVEFORM_BARS = '▁▂▃▄▅▆▇█'
+
+# Подпись голосового сообщения из метаданных сервера: длительность и форма волны, файл не скачивается
+def format_audio_label(duration, waveform, width=16):
+    parts = []
+    if duration is not None:
+        seconds = int(round(duration))
+        parts.append(f"{seconds // 60}:{seconds % 60:02d}")
+    if waveform:
+        step = max(1, len(waveform) // width)
+        peaks = [max(waveform[i:i + step]) for i in range(0, len(waveform), step)][:width]
+        parts.append(''.join(WAVEFORM_BARS[min(len(WAVEFORM_BARS) - 1, peak * len(WAVEFORM_BARS) // 256)] for peak in peaks))
+    return ' '.join(parts)
 
 class MessengerApp:
     def __init__(self, root):
@@ -30,7 +57,12 @@ class MessengerApp:
         self.token = None
         self.current_username = None
         self.sio = socketio.Client()
-        self.message_widgets = {} # {message_id: widget}
+        self.message_widgets = {} # {message_id: text mark}
+        self.messages_cursor = None # before_id для подгрузки более старых сообщений
+        self.loading_older_messages = False
+        self.sync_cursor = None # курсор журнала изменений сервера (/sync)
+        self.socket_connected_once = False
+        self.room_seq = 0 # номер последнего увиденного события открытого чата
         pygame.mixer.init() # Initialize pygame mixer for playback
 
         # Call state variables
@@ -65,6 +97,9 @@ class MessengerApp:
             if response.status_code == 200:
                 self.token = response.json().get('token')
                 self.current_username = username
+                # Курсор берём до загрузки чатов: при переподключении догружается только разница
+                self.sync_cursor = self.fetch_sync_cursor()
+                self.socket_connected_once = False
                 self.connect_socketio()
                 self.setup_main_window()
             else:
@@ -118,6 +153,7 @@ class MessengerApp:
 
         self.chat_window = scrolledtext.ScrolledText(chat_frame, state='disabled', bg=self.SECONDARY_COLOR, fg=self.TEXT_COLOR, insertbackground=self.TEXT_COLOR)
         self.chat_window.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        self.chat_window.configure(yscrollcommand=self.on_chat_scroll)
         self.chat_window.tag_config('sent', justify='right', background='#4f545c') # Darker sent bubble
         self.chat_window.tag_config('received', justify='left', background='#3a3d42') # Darker received bubble
 
@@ -138,20 +174,16 @@ class MessengerApp:
 
     def load_chats(self):
         headers = {'x-access-token': self.token}
-        # Загружаем онлайн пользователей
-        online_response = requests.get(f'{BASE_URL}/users/online', headers=headers)
-        online_user_ids = online_response.json() if online_response.status_code == 200 else []
-
-        # Загружаем чаты
+        # Список чатов приходит одним запросом вместе со статусом, последним сообщением и непрочитанными
         chats_response = requests.get(f'{BASE_URL}/chats', headers=headers)
         if chats_response.status_code == 200:
             self.chats = chats_response.json()
             self.chats_listbox.delete(0, tk.END)
             for chat in self.chats:
                 username = chat['with_user']['username']
-                user_id = chat['with_user']['id']
-                status = "● " if user_id in online_user_ids else ""
-                self.chats_listbox.insert(tk.END, f"{status}{username}")
+                status = "● " if chat['with_user'].get('online') else ""
+                unread = f" ({chat['unread_count']})" if chat.get('unread_count') else ""
+                self.chats_listbox.insert(tk.END, f"{status}{username}{unread}")
                 if status:
                     self.chats_listbox.itemconfig(tk.END, {'fg': 'green'})
         else:
@@ -169,35 +201,67 @@ class MessengerApp:
     def load_messages(self):
         chat_id = self.selected_chat['chat_id']
         headers = {'x-access-token': self.token}
-        response = requests.get(f'{BASE_URL}/chats/{chat_id}/messages', headers=headers)
+        # Сначала загружаем только самую новую страницу, старые подгружаются при прокрутке вверх
+        response = requests.get(f'{BASE_URL}/chats/{chat_id}/messages', params={'limit': MESSAGES_PAGE_SIZE}, headers=headers)
         self.chat_window.config(state='normal')
         self.chat_window.delete(1.0, tk.END)
         self.message_widgets = {}
+        self.messages_cursor = None
         if response.status_code == 200:
-            messages = response.json()
-            for msg in messages:
-                tag = 'sent' if msg['sender'] == self.current_username else 'received'
-                if msg.get('is_audio'):
-                    self.add_audio_message_widget(msg, tag)
-                else:
-                    self.add_text_message_widget(msg, tag)
+            page = response.json()
+            self.messages_cursor = page.get('next_cursor')
+            for msg in page['messages']:
+                self.add_message_widget(msg)
+            self.room_seq = max((msg.get('seq') or 0 for msg in page['messages']), default=0)
+        else:
+            self.room_seq = 0
         self.chat_window.config(state='disabled')
-        # Join socket.io room
-        self.sio.emit('join', {'room': chat_id, 'username': self.current_username})
+        self.chat_window.yview(tk.END)
+        # Join socket.io room. С last_seq сервер дошлёт то, что пришло между загрузкой страницы и входом в комнату
+        self.sio.emit('join', {'room': chat_id, 'username': self.current_username, 'last_seq': self.room_seq})
+
+    def load_older_messages(self):
+        if self.loading_older_messages or not self.messages_cursor or not hasattr(self, 'selected_chat'):
+            return
+        self.loading_older_messages = True
+        try:
+            chat_id = self.selected_chat['chat_id']
+            headers = {'x-access-token': self.token}
+            response = requests.get(f'{BASE_URL}/chats/{chat_id}/messages',
+                                    params={'before_id': self.messages_cursor, 'limit': MESSAGES_PAGE_SIZE}, headers=headers)
+            if response.status_code != 200 or chat_id != self.selected_chat['chat_id']:
+                return
+            page = response.json()
+            self.messages_cursor = page.get('next_cursor')
+            # Вставляем в начало от новых к старым, чтобы сохранить порядок
+            anchor = self.chat_window.index('@0,0')
+            for msg in reversed(page['messages']):
+                self.add_message_widget(msg, index='1.0')
+            self.chat_window.see(f"{anchor} +{len(page['messages'])} lines")
+        finally:
+            self.loading_older_messages = False
+
+    def on_chat_scroll(self, first, last):
+        self.chat_window.vbar.set(first, last)
+        if float(first) <= 0.0 and self.messages_cursor and not self.loading_older_messages:
+            self.root.after_idle(self.load_older_messages)
 
     def send_message(self):
         message = self.message_entry.get()
         if message and hasattr(self, 'selected_chat'):
             chat_id = self.selected_chat['chat_id']
-            self.sio.emit('send_message', {'room': chat_id, 'content': message, 'token': self.token})
+            self.sio.emit('send_message', {'room': chat_id, 'content': message})
             self.message_entry.delete(0, tk.END)
 
     def search_user_dialog(self):
         query = simpledialog.askstring("Поиск", "Введите имя пользователя для поиска:")
         if query:
             headers = {'x-access-token': self.token}
-            response = requests.get(f'{BASE_URL}/users/search?username={query}', headers=headers)
-            users = response.json()
+            response = requests.get(f'{BASE_URL}/users/search', params={'username': query}, headers=headers)
+            if response.status_code != 200:
+                messagebox.showerror("Поиск", response.json().get('message'))
+                return
+            users = response.json()['users']
             # Simple display, can be improved with a custom dialog
             user_info = "\n".join([f"ID: {u['id']}, Имя: {u['username']}" for u in users])
             result = messagebox.askyesno("Результаты поиска", f"{user_info}\n\nДобавить первого пользователя в контакты?")
@@ -233,34 +297,101 @@ class MessengerApp:
 
     def connect_socketio(self):
         try:
-            self.sio.connect(f'{BASE_URL}?token={self.token}')
+            # Только websocket: соединение не зависит от того, на какой воркер попадёт каждый HTTP-запрос
+            self.sio.connect(f'{BASE_URL}?token={self.token}', transports=['websocket'])
         except socketio.exceptions.ConnectionError as e:
             messagebox.showerror("Ошибка WebSocket", f"Не удалось подключиться к серверу чата: {e}")
 
+    def fetch_sync_cursor(self):
+        headers = {'x-access-token': self.token}
+        try:
+            response = requests.get(f'{BASE_URL}/sync', headers=headers)
+            if response.status_code == 200:
+                return response.json()['cursor']
+        except requests.exceptions.ConnectionError:
+            pass
+        return None
+
+    # После переподключения запрашиваем только изменения с момента последней синхронизации
+    # (сообщения и удаления, пропущенные, пока сокет был отключён), а не всю историю заново
+    def catch_up(self):
+        if self.sync_cursor is None:
+            return
+        headers = {'x-access-token': self.token}
+        changed = False
+        while True:
+            response = requests.get(f'{BASE_URL}/sync', params={'since': self.sync_cursor}, headers=headers)
+            if response.status_code != 200:
+                return
+            result = response.json()
+            self.sync_cursor = result['cursor']
+            if result['reset']:
+                # Журнал на сервере уже обрезан - перезагружаем всё
+                self.load_chats()
+                if hasattr(self, 'selected_chat'):
+                    self.load_messages()
+                return
+            selected_chat_id = self.selected_chat['chat_id'] if hasattr(self, 'selected_chat') else None
+            for msg in result['messages']:
+                if msg['chat_id'] == selected_chat_id and msg['id'] not in self.message_widgets:
+                    self.add_message_widget(msg)
+            for deleted in result['deleted_messages']:
+                self.remove_message_widget(deleted['message_id'])
+            changed = changed or bool(result['messages'] or result['deleted_messages'] or result['chats'])
+            if not result['has_more']:
+                break
+        if changed:
+            self.chat_window.yview(tk.END)
+            self.load_chats()
+        # Комнаты сокета после переподключения пустые - входим в открытый чат заново
+        if hasattr(self, 'selected_chat'):
+            self.sio.emit('join', {'room': self.selected_chat['chat_id'], 'username': self.current_username,
+                                   'last_seq': self.room_seq})
+
+    def note_room_seq(self, data):
+        if hasattr(self, 'selected_chat') and data.get('chat_id') == self.selected_chat['chat_id'] and data.get('seq'):
+            self.room_seq = max(self.room_seq, data['seq'])
+
+    def remove_message_widget(self, message_id):
+        if message_id in self.message_widgets:
+            self.chat_window.config(state='normal')
+            # A bit tricky to remove a widget, let's just replace it with a placeholder
+            # For a real app, a custom widget list would be better.
+            mark = self.message_widgets.pop(message_id)
+            self.chat_window.delete(mark, f"{mark} +1 lines")
+            self.chat_window.insert(mark, "[Сообщение удалено]\n")
+            self.chat_window.config(state='disabled')
+
     def setup_socketio_handlers(self):
+        @self.sio.on('connect')
+        def on_connect():
+            if self.socket_connected_once:
+                self.root.after(0, self.catch_up)
+            self.socket_connected_once = True
+
         @self.sio.on('message_deleted')
         def on_message_deleted(data):
-            message_id = data.get('message_id')
-            if message_id in self.message_widgets:
-                self.chat_window.config(state='normal')
-                # A bit tricky to remove a widget, let's just replace it with a placeholder
-                # For a real app, a custom widget list would be better.
-                self.chat_window.delete(self.message_widgets[message_id][0], self.message_widgets[message_id][1])
-                self.chat_window.insert(self.message_widgets[message_id][0], "[Сообщение удалено]\n")
-                self.chat_window.config(state='disabled')
+            self.note_room_seq(data)
+            self.remove_message_widget(data.get('message_id'))
 
         @self.sio.on('message')
         def on_message(data):
-            if isinstance(data, dict) and hasattr(self, 'selected_chat'):
-                self.chat_window.config(state='normal')
-                tag = 'sent' if data['sender'] == self.current_username else 'received'
-                if data.get('is_audio'):
-                    self.add_audio_message_widget(data, tag)
-                else:
-                    self.chat_window.insert(tk.END, f"{data['sender']}: {data['content']}\n", tag)
-                self.chat_window.config(state='disabled')
+            # id запоминаются (message_widgets), поэтому сообщение не задвоится при догоняющей синхронизации
+            if not isinstance(data, dict) or not hasattr(self, 'selected_chat'):
+                return
+            if data.get('chat_id') != self.selected_chat['chat_id']:
+                return
+            self.note_room_seq(data)
+            if data.get('id') not in self.message_widgets:
+                self.add_message_widget(data)
                 self.chat_window.yview(tk.END)
 
+        @self.sio.on('resync')
+        def on_resync(data):
+            # Пропущенные события уже не восстановить - перезагружаем историю открытого чата
+            if hasattr(self, 'selected_chat') and data.get('room') == self.selected_chat['chat_id']:
+                self.root.after(0, self.load_messages)
+
         @self.sio.on('incoming_call')
         def on_incoming_call(data):
             self.current_call_info = {
@@ -295,17 +426,43 @@ class MessengerApp:
 
         @self.sio.on('call_hangup')
         def on_call_hangup(data):
-            self.root.after(0, lambda: messagebox.showinfo("Звонок", "Звонок завершен другой стороной."))
-            self.root.after(0, self.hang_up)
+            text = CALL_HANGUP_REASONS.get(data.get('reason'), "Звонок завершен другой стороной.")
+            self.root.after(0, lambda: messagebox.showinfo("Звонок", text))
+            self.root.after(0, self.close_call)
+
+        @self.sio.on('rate_limited')
+        def on_rate_limited(data):
+            # Сервер отклонил событие: слишком часто. Повторять можно через retry_after секунд
+            print(f"Rate limited: {data.get('event')}, retry after {data.get('retry_after')}s")
+            if data.get('event') == 'send_message':
+                self.root.after(0, lambda: messagebox.showwarning("Слишком часто", "Сообщение не отправлено, подождите немного."))
 
         @self.sio.on('call_error')
         def on_call_error(data):
             self.root.after(0, lambda: messagebox.showerror("Ошибка звонка", data.get('message', "Произошла ошибка во время звонка.")))
             self.root.after(0, self.hang_up)
 
-    def add_text_message_widget(self, msg, tag):
+    def add_message_widget(self, msg, index=tk.END):
+        tag = 'sent' if msg['sender'] == self.current_username else 'received'
+        if msg.get('is_audio'):
+            self.add_audio_message_widget(msg, tag, index)
+        else:
+            self.add_text_message_widget(msg, tag, index)
+
+    def place_message_widget(self, msg, container, index):
+        # Каждое сообщение занимает одну строку: виджет + перевод строки.
+        # Начало строки запоминаем меткой - в отличие от индекса она сдвигается,
+        # когда сверху подгружается более старая история.
+        if index == tk.END:
+            index = self.chat_window.index('end-1c')
+        self.chat_window.window_create(index, window=container)
+        self.chat_window.insert(f'{index} +1c', '\n')
+        mark = f"msg_{msg['id']}"
+        self.chat_window.mark_set(mark, index)
+        self.message_widgets[msg['id']] = mark
+
+    def add_text_message_widget(self, msg, tag, index=tk.END):
         self.chat_window.config(state='normal')
-        start_index = self.chat_window.index(tk.END)
         
         container = tk.Frame(self.chat_window, bg=self.chat_window.tag_cget(tag, 'background'))
         
@@ -318,20 +475,17 @@ class MessengerApp:
                                    bg='red', fg='white', relief=tk.FLAT, width=2)
             del_button.pack(side=tk.RIGHT)
         
-        self.chat_window.window_create(tk.END, window=container)
-        self.chat_window.insert(tk.END, '\n')
-        end_index = self.chat_window.index(tk.END)
-        self.message_widgets[msg['id']] = (start_index, end_index)
+        self.place_message_widget(msg, container, index)
         self.chat_window.config(state='disabled')
 
-    def add_audio_message_widget(self, msg, tag):
+    def add_audio_message_widget(self, msg, tag, index=tk.END):
         self.chat_window.config(state='normal')
-        start_index = self.chat_window.index(tk.END)
 
         container = tk.Frame(self.chat_window, bg=self.chat_window.tag_cget(tag, 'background'))
         label = tk.Label(container, text=f"{msg['sender']}:", bg=self.chat_window.tag_cget(tag, 'background'), fg=self.TEXT_COLOR)
         label.pack(side=tk.LEFT)
-        play_button = tk.Button(container, text="▶ Воспроизвести", 
+        audio_label = format_audio_label(msg.get('audio_duration'), msg.get('audio_waveform'))
+        play_button = tk.Button(container, text=f"▶ {audio_label}" if audio_label else "▶ Воспроизвести", 
                                 command=lambda url=msg['content']: self.play_audio(url), 
                                 bg=self.PRIMARY_COLOR, fg=self.TEXT_COLOR, relief=tk.FLAT)
         play_button.pack(side=tk.LEFT, padx=5)
@@ -341,10 +495,7 @@ class MessengerApp:
                                    bg='red', fg='white', relief=tk.FLAT, width=2)
             del_button.pack(side=tk.RIGHT)
 
-        self.chat_window.window_create(tk.END, window=container)
-        self.chat_window.insert(tk.END, '\n') # Newline after the widget
-        end_index = self.chat_window.index(tk.END)
-        self.message_widgets[msg['id']] = (start_index, end_index)
+        self.place_message_widget(msg, container, index) # Newline after the widget
         self.chat_window.config(state='disabled')
 
     def delete_message(self, message_id):
@@ -353,19 +504,55 @@ class MessengerApp:
         if response.status_code != 200:
             messagebox.showerror("Ошибка удаления", response.json().get('message'))
 
+    # Голосовые кэшируются локально: повторное воспроизведение проверяет файл по ETag (If-None-Match)
+    # и не скачивает его заново, оборванная загрузка продолжается с места обрыва (Range + If-Range)
+    def fetch_audio(self, url):
+        os.makedirs(AUDIO_CACHE_DIR, exist_ok=True)
+        name = os.path.splitext(os.path.basename(url))[0]
+        meta_path = os.path.join(AUDIO_CACHE_DIR, name + '.json')
+        part_path = os.path.join(AUDIO_CACHE_DIR, name + '.part')
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            meta = {}
+
+        headers = {}
+        if meta.get('path') and os.path.exists(meta['path']):
+            headers['If-None-Match'] = meta['etag']
+        elif meta.get('etag') and os.path.exists(part_path):
+            headers['Range'] = f'bytes={os.path.getsize(part_path)}-'
+            headers['If-Range'] = meta['etag']
+
+        response = requests.get(f'{BASE_URL}{url}', headers=headers, stream=True, timeout=30)
+        if response.status_code == 304:
+            return meta['path']
+        if response.status_code not in (200, 206):
+            return None
+
+        # Пока файл не скачан целиком, в метаданных только ETag - для докачки
+        if meta.get('path') and os.path.exists(meta['path']):
+            os.remove(meta['path'])
+        meta = {'etag': response.headers.get('ETag')}
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+        with open(part_path, 'ab' if response.status_code == 206 else 'wb') as f:
+            shutil.copyfileobj(response.raw, f)
+
+        # После перекодирования на сервере приходит Opus/OGG вместо WAV
+        suffix = '.ogg' if 'ogg' in response.headers.get('Content-Type', '') else '.wav'
+        meta['path'] = os.path.join(AUDIO_CACHE_DIR, name + suffix)
+        os.replace(part_path, meta['path'])
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+        return meta['path']
+
     def play_audio(self, url):
         try:
-            full_url = f'{BASE_URL}{url}'
-            print(f"Attempting to download audio from: {full_url}")
-            response = requests.get(full_url, stream=True)
-            print(f"Audio download response status: {response.status_code}")
-            if response.status_code == 200:
-                # Save to a temporary file before playing
-                with tempfile.NamedTemporaryFile(delete=False, suffix='.wav') as tmp_file:
-                    shutil.copyfileobj(response.raw, tmp_file)
-                    tmp_filename = tmp_file.name
-                
-                pygame.mixer.music.load(tmp_filename)
+            print(f"Attempting to load audio from: {BASE_URL}{url}")
+            audio_path = self.fetch_audio(url)
+            if audio_path:
+                pygame.mixer.music.load(audio_path)
                 pygame.mixer.music.play()
             else:
                 messagebox.showerror("Ошибка", "Не удалось загрузить аудиофайл.")
@@ -409,18 +596,64 @@ class MessengerApp:
         self.upload_and_send_audio(temp_filename)
 
     def upload_and_send_audio(self, filename):
+        try:
+            file_path = self.upload_audio_file(filename)
+        except (requests.exceptions.RequestException, RuntimeError) as e:
+            messagebox.showerror("Ошибка загрузки", str(e))
+            return
+        if file_path and hasattr(self, 'selected_chat'):
+            chat_id = self.selected_chat['chat_id']
+            self.sio.emit('send_message', {'room': chat_id, 'content': file_path, 'is_audio': True})
+
+    def upload_audio_file(self, filename):
+        # Загрузка по частям: при обрыве связи продолжаем с того места, где остановился сервер
         headers = {'x-access-token': self.token}
+        size = os.path.getsize(filename)
+        response = requests.post(f'{BASE_URL}/upload/audio/init', json={'size': size}, headers=headers, timeout=30)
+        if response.status_code != 201:
+            raise RuntimeError(response.json().get('message'))
+        upload = response.json()
+        upload_url = f"{BASE_URL}/upload/audio/{upload['upload_id']}"
+        chunk_size = upload['chunk_size']
+
+        offset = 0
+        retries = 0
         with open(filename, 'rb') as f:
-            files = {'file': (filename, f, 'audio/wav')}
-            response = requests.post(f'{BASE_URL}/upload/audio', files=files, headers=headers)
-        
-        if response.status_code == 201:
-            file_path = response.json().get('file_path')
-            if file_path and hasattr(self, 'selected_chat'):
-                chat_id = self.selected_chat['chat_id']
-                self.sio.emit('send_message', {'room': chat_id, 'content': file_path, 'token': self.token, 'is_audio': True})
-        else:
-            messagebox.showerror("Ошибка загрузки", response.json().get('message'))
+            while offset is None or offset < size:
+                try:
+                    if offset is None:
+                        response = requests.get(upload_url, headers=headers, timeout=30)
+                        response.raise_for_status()
+                        offset = response.json()['offset']
+                        continue
+                    f.seek(offset)
+                    response = requests.put(upload_url, params={'offset': offset}, data=f.read(chunk_size),
+                                            headers={**headers, 'Content-Type': 'application/octet-stream'}, timeout=30)
+                    if response.status_code not in (200, 409):
+                        raise RuntimeError(response.json().get('message'))
+                    offset = response.json()['offset']
+                    retries = 0
+                except requests.exceptions.RequestException:
+                    retries += 1
+                    if retries > UPLOAD_MAX_RETRIES:
+                        raise
+                    time.sleep(retries)
+                    offset = None # спросим у сервера, сколько байт дошло
+
+        # 503 - сервер не смог сохранить файл, но загрузка цела и /complete можно повторить
+        for attempt in range(1, UPLOAD_MAX_RETRIES + 2):
+            try:
+                response = requests.post(f'{upload_url}/complete', headers=headers, timeout=30)
+            except requests.exceptions.RequestException:
+                if attempt > UPLOAD_MAX_RETRIES:
+                    raise
+            else:
+                if response.status_code != 503 or attempt > UPLOAD_MAX_RETRIES:
+                    break
+            time.sleep(attempt)
+        if response.status_code != 201:
+            raise RuntimeError(response.json().get('message'))
+        return response.json().get('file_path')
 
     # --- Agora Event Handler ---
     class AgoraEventHandler(agorartc.RtcEngineEventHandlerBase):
@@ -486,6 +719,14 @@ class MessengerApp:
         self.call_button.config(text="❌")
         self.current_call_info = {'otherUserId': caller_id, 'channelName': channel_name}
 
+    # Звонок завершён сервером (собеседник, таймаут, обрыв связи): сообщать серверу не нужно
+    def close_call(self):
+        self.current_call_info = {}
+        if self.incoming_call_window:
+            self.incoming_call_window.destroy()
+            self.incoming_call_window = None
+        self.hang_up()
+
     def hang_up(self):
         if not self.in_call:
             return
@@ -0,0 +1,85 @@
+# Обнаружение блокировок цикла событий eventlet.
+# Зелёный поток засыпает на interval и замеряет, насколько позже он проснулся (задержка планирования).
+# Отдельный настоящий поток ОС следит, когда зелёный поток просыпался последний раз: если цикл
+# не переключался дольше block_threshold, печатается стек кода, который сейчас занимает цикл.
+import sys
+import time
+import traceback
+
+import eventlet
+from eventlet import patcher
+
+# Модули до monkey_patch: сторожу нужен поток ОС, а не green thread
+_real_threading = patcher.original('threading')
+_real_thread = patcher.original('_thread')
+_real_sleep = patcher.original('time').sleep
+
+
+class LoopLagMonitor:
+    def __init__(self, interval, block_threshold, on_lag=None):
+        self.interval = interval
+        self.block_threshold = block_threshold
+        self.on_lag = on_lag # on_lag(секунды) после каждого замера
+        self._started = False
+        self._loop_thread_id = None
+        self._heartbeat = time.monotonic()
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.blocked = 0
+        self.last_block = None
+
+    def start(self):
+        # Запускается из цикла событий при первом запросе: при импорте (flask db upgrade и т.п.)
+        # цикл не работает, и сторож принял бы это за блокировку
+        if self._started:
+            return
+        self._started = True
+        self._loop_thread_id = _real_thread.get_ident()
+        self._heartbeat = time.monotonic()
+        eventlet.spawn(self._tick)
+        _real_threading.Thread(target=self._watch, name='loop-lag-watchdog', daemon=True).start()
+
+    def _tick(self):
+        while True:
+            started = time.monotonic()
+            eventlet.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - started - self.interval)
+            self._heartbeat = now
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            if self.on_lag:
+                self.on_lag(lag)
+
+    def _watch(self):
+        reported = None
+        while True:
+            _real_sleep(self.block_threshold / 2)
+            heartbeat = self._heartbeat
+            stalled = time.monotonic() - heartbeat - self.interval
+            # Одна блокировка печатается один раз, даже если длится несколько проверок
+            if stalled < self.block_threshold or heartbeat == reported:
+                continue
+            reported = heartbeat
+            # Все зелёные потоки работают в одном потоке ОС, его текущий кадр - виновник блокировки
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = ''.join(traceback.format_stack(frame)) if frame else ''
+            self.blocked += 1
+            # Стек только в лог: stats() отдаётся наружу через /stats без авторизации
+            self.last_block = {'at': time.time(), 'stalled': round(stalled, 3)}
+            print(f"Event loop blocked for {stalled:.2f}s:\n{stack}")
+
+    def current_lag(self):
+        # Пока цикл заблокирован, last_lag ещё не обновился - учитываем время с последнего пробуждения
+        if not self._started:
+            return 0.0
+        return max(self.last_lag, time.monotonic() - self._heartbeat - self.interval)
+
+    def stats(self):
+        return {
+            'running': self._started,
+            'lag': round(self.current_lag(), 4),
+            'max_lag': round(self.max_lag, 4),
+            'blocked': self.blocked,
+            'last_block': self.last_block
+        }
@@ -0,0 +1,136 @@
+# Метрики в текстовом формате Prometheus (/metrics). Без внешних зависимостей:
+# счётчики и гистограммы - словари в памяти процесса, датчики (gauge) вычисляются при запросе.
+# Каждый воркер отдаёт свои значения, Prometheus собирает их по отдельности.
+import threading
+
+# Границы корзин гистограмм задержки, секунды
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    items = ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                     for name, value in labels)
+    return '{' + items + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        return [(self.name, key, value) for key, value in list(self._values.items())]
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._values = {} # {labels: [счётчики корзин..., sum, count]}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            # Счётчик только одной корзины; накопительные значения считаются при выводе
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[i] += 1
+                    break
+            entry[-2] += value
+            entry[-1] += 1
+
+    def samples(self):
+        result = []
+        with self._lock:
+            values = [(key, list(entry)) for key, entry in self._values.items()]
+        for key, entry in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, entry):
+                cumulative += count
+                result.append((self.name + '_bucket', key + (('le', _format_value(float(bound))),), cumulative))
+            result.append((self.name + '_bucket', key + (('le', '+Inf'),), entry[-1]))
+            result.append((self.name + '_sum', key, entry[-2]))
+            result.append((self.name + '_count', key, entry[-1]))
+        return result
+
+
+# Значение вычисляется функцией в момент запроса /metrics: число или {метки: значение}
+class Gauge:
+    type = 'gauge'
+
+    def __init__(self, name, help, func, label=None):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.label = label
+
+    def samples(self):
+        value = self.func()
+        if isinstance(value, dict):
+            return [(self.name, ((self.label, label_value),), v) for label_value, v in value.items()]
+        return [(self.name, (), value)]
+
+
+# Монотонный итог, который уже считает другой объект (например, LoopLagMonitor.blocked):
+# вычисляется при запросе, как Gauge, но отдаётся с типом counter, чтобы работали rate()/increase()
+class CallbackCounter(Gauge):
+    type = 'counter'
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help):
+        return self._register(Counter(name, help))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help, buckets))
+
+    def gauge(self, name, help, func, label=None):
+        return self._register(Gauge(name, help, func, label))
+
+    def callback_counter(self, name, help, func, label=None):
+        return self._register(CallbackCounter(name, help, func, label))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                print(f"Metric {metric.name} failed: {e}")
+                continue
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, value in samples:
+                lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
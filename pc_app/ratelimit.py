@@ -0,0 +1,100 @@
+# Ограничение частоты socket-событий: token bucket на каждое соединение (sid) и на пользователя
+# (все его устройства вместе) для каждого типа события. Состояние в памяти процесса.
+import threading
+import time
+from collections import OrderedDict
+
+
+# Лимиты задаются строкой "событие=скорость/запас,...", например "send_message=5/20,join=2/10":
+# скорость - событий в секунду, запас - сколько событий можно отправить подряд
+def parse_limits(spec, defaults=None):
+    limits = dict(defaults or {})
+    for item in (spec or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        event, value = item.split('=', 1)
+        rate, burst = value.split('/', 1)
+        limits[event.strip()] = (float(rate), float(burst))
+    return limits
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def retry_after(self):
+        return (1 - self.tokens) / self.rate if self.rate > 0 else None
+
+
+class SocketRateLimiter:
+    def __init__(self, sid_limits, user_limits, max_buckets=100000):
+        self.sid_limits = sid_limits
+        self.user_limits = user_limits
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict() # {(scope, key, event): TokenBucket}
+        self._sid_keys = {} # {sid: set(ключей бакетов)} - удаляются при отключении
+        self._lock = threading.Lock()
+        self.allowed = {}
+        self.throttled = {} # все события сверх лимита
+        self.coalesced = {} # из них отброшены молча (повтор идемпотентного события)
+
+    def _bucket(self, scope, key, event, limit, now):
+        bucket_key = (scope, key, event)
+        bucket = self._buckets.get(bucket_key)
+        if bucket is None:
+            bucket = self._buckets[bucket_key] = TokenBucket(limit[0], limit[1], now)
+            if scope == 'sid':
+                self._sid_keys.setdefault(key, set()).add(bucket_key)
+            while len(self._buckets) > self.max_buckets:
+                evicted_key, _ = self._buckets.popitem(last=False)
+                if evicted_key[0] == 'sid':
+                    self._sid_keys.get(evicted_key[1], set()).discard(evicted_key)
+        else:
+            self._buckets.move_to_end(bucket_key)
+        return bucket
+
+    def check(self, event, sid, user_id):
+        # 0 - событие разрешено, иначе через сколько секунд можно повторить.
+        # Жетон списывается, только если его хватает в обоих бакетах.
+        now = time.monotonic()
+        with self._lock:
+            buckets = []
+            for scope, key, limits in (('sid', sid, self.sid_limits), ('user', user_id, self.user_limits)):
+                limit = limits.get(event)
+                if limit:
+                    buckets.append(self._bucket(scope, key, event, limit, now))
+            for bucket in buckets:
+                if bucket.refill(now) < 1:
+                    self.throttled[event] = self.throttled.get(event, 0) + 1
+                    return bucket.retry_after() or 1.0
+            for bucket in buckets:
+                bucket.tokens -= 1
+            self.allowed[event] = self.allowed.get(event, 0) + 1
+            return 0
+
+    def note_coalesced(self, event):
+        self.coalesced[event] = self.coalesced.get(event, 0) + 1
+
+    def forget_sid(self, sid):
+        with self._lock:
+            for bucket_key in self._sid_keys.pop(sid, ()):
+                self._buckets.pop(bucket_key, None)
+
+    def stats(self):
+        return {
+            'buckets': len(self._buckets),
+            'allowed': dict(self.allowed),
+            'throttled': dict(self.throttled),
+            'coalesced': dict(self.coalesced)
+        }
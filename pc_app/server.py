@@ -4,38 +4,115 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')
 
 import eventlet
 eventlet.monkey_patch()
-from flask import Flask, request, jsonify
-from flask_socketio import SocketIO, join_room, leave_room, send, emit
-from flask import request
+from eventlet import tpool
+from flask import Flask, request, jsonify, send_from_directory, abort, g, has_app_context
+from flask_socketio import SocketIO, join_room, leave_room, send, emit, rooms
+from flask import request, session
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
+from sqlalchemy import event as sa_event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.utils import safe_join
 import jwt
 from datetime import datetime, timedelta
 from functools import wraps
+from collections import OrderedDict, deque, namedtuple
 from agora_token_builder import RtcTokenBuilder
+from pc_app.state import create_state_backend
+from pc_app.calls import CallManager, CallError
+from pc_app.ratelimit import SocketRateLimiter, parse_limits
+from pc_app.audio import AudioTranscoder, analyze_wav, TRANSCODED_AUDIO_EXT, TRANSCODED_AUDIO_MIMETYPE
+from pc_app.metrics import MetricsRegistry
+from pc_app.sqlprofile import QueryProfiler
+from pc_app.loopmonitor import LoopLagMonitor
+import atexit
+import hashlib
+import json
+import threading
 import time
+import uuid
+import wave
 
 # Настройка пути к базе данных
 basedir = os.path.abspath(os.path.dirname(__file__))
+# Голосовые сообщения хранятся по хешу содержимого: uploads/ab/cd/abcd....wav (см. blob_path)
 UPLOAD_FOLDER = os.path.join(basedir, 'uploads')
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
-
-def generate_agora_token(channel_name, uid, role=1):
-    app_id = "96619c27fbeb4332b25e1413e8f3ce9f"
-    app_certificate = "c2e4b2ce1cc0491fb2719573ceecbeff"
+# Незавершённые загрузки по частям: <upload_id>.part (данные) и <upload_id>.json (метаданные).
+# Каталог вне UPLOAD_FOLDER, чтобы недокачанные файлы не раздавались как статика.
+PARTIAL_UPLOAD_FOLDER = os.path.join(basedir, 'uploads_partial')
+if not os.path.exists(PARTIAL_UPLOAD_FOLDER):
+    os.makedirs(PARTIAL_UPLOAD_FOLDER)
+
+# Agora RTC: данные проекта задаются окружением
+AGORA_APP_ID = os.environ.get('AGORA_APP_ID')
+AGORA_APP_CERTIFICATE = os.environ.get('AGORA_APP_CERTIFICATE')
+AGORA_TOKEN_TTL = int(os.environ.get('AGORA_TOKEN_TTL', 3600)) # секунды
+# Токен из кэша выдаётся, только если ему осталось жить не меньше этого времени (длительность звонка)
+AGORA_TOKEN_MIN_REMAINING = int(os.environ.get('AGORA_TOKEN_MIN_REMAINING', 900))
+AGORA_TOKEN_CACHE_SIZE = int(os.environ.get('AGORA_TOKEN_CACHE_SIZE', 10000))
+# Звонки: сколько ждать ответа и через сколько считать сессию зависшей
+CALL_RING_TIMEOUT = int(os.environ.get('CALL_RING_TIMEOUT', 45)) # секунды
+CALL_MAX_DURATION = int(os.environ.get('CALL_MAX_DURATION', 6 * 3600))
+
+def generate_agora_token(channel_name, uid, role=1, expires_at=None):
+    app_id = AGORA_APP_ID
+    app_certificate = AGORA_APP_CERTIFICATE
     if not app_id or not app_certificate:
         print("AGORA_APP_ID или AGORA_APP_CERTIFICATE не установлены")
         return None
-    expiration_time_in_seconds = 3600
-    current_timestamp = int(time.time())
-    privilege_expired_ts = current_timestamp + expiration_time_in_seconds
+    privilege_expired_ts = expires_at or int(time.time()) + AGORA_TOKEN_TTL
 
     token = RtcTokenBuilder.buildTokenWithUid(app_id, app_certificate, channel_name, uid, role, privilege_expired_ts)
     return token
 
-app = Flask(__name__, static_url_path='/uploads', static_folder=UPLOAD_FOLDER)
+# LRU-кэш токенов Agora по (канал, uid, роль): пока токен действителен достаточно долго,
+# повторный запрос (повторный звонок, /agora/token) получает тот же токен без генерации
+class AgoraTokenCache:
+    def __init__(self, maxsize, ttl, min_remaining):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.min_remaining = min_remaining
+        self._entries = OrderedDict() # {(channel_name, uid, role): (token, expires_at)}
+        self._lock = threading.Lock()
+        self.generated = 0
+        self.reused = 0
+
+    def get(self, channel_name, uid, role=1):
+        key = (channel_name, uid, role)
+        now = int(time.time())
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] - now >= self.min_remaining:
+                self._entries.move_to_end(key)
+                self.reused += 1
+                return entry[0]
+
+        expires_at = now + self.ttl
+        token = generate_agora_token(channel_name, uid, role, expires_at)
+        if not token:
+            return None
+        with self._lock:
+            self.generated += 1
+            self._entries[key] = (token, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return token
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'generated': self.generated,
+            'reused': self.reused # генераций удалось избежать
+        }
+
+agora_tokens = AgoraTokenCache(AGORA_TOKEN_CACHE_SIZE, AGORA_TOKEN_TTL, AGORA_TOKEN_MIN_REMAINING)
+
+app = Flask(__name__)
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['SECRET_KEY'] = 'secret!'
@@ -53,16 +130,299 @@ db = SQLAlchemy(app)
 with app.app_context():
     db.create_all()
 
-migrate = Migrate(app, db)
-socketio = SocketIO(app)
+migrate = Migrate(app, db, render_as_batch=True)
+
+# Для нескольких воркеров/узлов: очередь сообщений Socket.IO (например, redis://...),
+# через которую рассылки в комнаты доходят до клиентов на любом воркере,
+# и общее хранилище состояния (по умолчанию тот же Redis)
+SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+STATE_BACKEND_URL = os.environ.get('STATE_BACKEND_URL', SOCKETIO_MESSAGE_QUEUE)
+
+socketio = SocketIO(app, message_queue=SOCKETIO_MESSAGE_QUEUE)
+state = create_state_backend(STATE_BACKEND_URL)
+
+online_users = state.presence() # {user_id: set(sid)}, {sid: user_id}
+
+# --- Метрики (/metrics) ---
+# Задержка считается по шаблону маршрута (/messages/<int:chat_id>), а не по URL,
+# чтобы число рядов не росло с числом чатов и пользователей
+metrics = MetricsRegistry()
+http_request_duration = metrics.histogram('http_request_duration_seconds', 'Время обработки REST-запроса')
+socket_event_duration = metrics.histogram('socketio_event_duration_seconds', 'Время обработки socket-события')
+db_queries_total = metrics.counter('db_queries_total', 'Число SQL-запросов к базе')
+upload_bytes_total = metrics.counter('upload_bytes_total', 'Принято байт голосовых сообщений')
+
+# Профилирование SQL (включается SQL_PROFILING=1): число запросов и время в БД
+# на каждый REST-запрос и socket-событие, лог запросов дольше SLOW_QUERY_MS.
+# Запрос, сделавший больше SQL_QUERY_COUNT_WARN обращений к базе, тоже попадает в лог (признак N+1).
+# В режиме отладки ответ получает заголовок Server-Timing (видно во вкладке Network браузера).
+SQL_PROFILING = os.environ.get('SQL_PROFILING') == '1'
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+SQL_QUERY_COUNT_WARN = int(os.environ.get('SQL_QUERY_COUNT_WARN', 30))
+db_queries_per_request = metrics.histogram('db_queries_per_request', 'SQL-запросов на REST-запрос или socket-событие',
+                                           buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+db_time_per_request = metrics.histogram('db_time_per_request_seconds', 'Время в БД на REST-запрос или socket-событие')
+
+def current_sql_profile():
+    return g.get('sql_profile') if has_app_context() else None
+
+def sql_profile_label():
+    return g.get('sql_profile_label', 'background') if has_app_context() else 'background'
+
+sql_profiler = QueryProfiler(SLOW_QUERY_MS / 1000, current_sql_profile, sql_profile_label)
+if SQL_PROFILING:
+    sql_profiler.install(Engine)
+
+def start_sql_profile(label):
+    if SQL_PROFILING:
+        g.sql_profile = QueryProfiler.new_stats()
+        g.sql_profile_label = label
+
+def finish_sql_profile(endpoint):
+    stats = g.pop('sql_profile', None)
+    if stats is None:
+        return None
+    db_queries_per_request.observe(stats['count'], endpoint=endpoint)
+    db_time_per_request.observe(stats['time'], endpoint=endpoint)
+    if stats['count'] > SQL_QUERY_COUNT_WARN:
+        print(f"Too many queries [{g.get('sql_profile_label')}]: {stats['count']} queries, {stats['time'] * 1000:.1f} ms")
+    return stats
+
+# Задержка цикла событий eventlet: замер каждые LOOP_LAG_INTERVAL секунд, стек блокирующего
+# кода печатается, если цикл не переключался дольше LOOP_BLOCK_THRESHOLD.
+# /healthz отвечает 503, пока задержка больше HEALTHZ_MAX_LOOP_LAG или недоступна база.
+LOOP_LAG_INTERVAL = float(os.environ.get('LOOP_LAG_INTERVAL', 0.1)) # секунды
+LOOP_BLOCK_THRESHOLD = float(os.environ.get('LOOP_BLOCK_THRESHOLD', 0.5))
+HEALTHZ_MAX_LOOP_LAG = float(os.environ.get('HEALTHZ_MAX_LOOP_LAG', 1.0))
+event_loop_lag = metrics.histogram('event_loop_lag_seconds', 'Задержка планирования цикла событий')
+loop_monitor = LoopLagMonitor(LOOP_LAG_INTERVAL, LOOP_BLOCK_THRESHOLD, on_lag=event_loop_lag.observe)
+
+@app.before_request
+def start_request_timer():
+    loop_monitor.start()
+    g.request_started = time.perf_counter()
+    start_sql_profile(f'{request.method} {request.url_rule.rule if request.url_rule else request.path}')
+
+@app.after_request
+def observe_request_duration(response):
+    started = g.pop('request_started', None)
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    if started is not None:
+        elapsed = time.perf_counter() - started
+        http_request_duration.observe(elapsed, method=request.method, endpoint=endpoint, status=response.status_code)
+    sql_stats = finish_sql_profile(endpoint)
+    if sql_stats is not None and app.debug:
+        timings = [f'db;dur={sql_stats["time"] * 1000:.1f};desc="{sql_stats["count"]} queries"']
+        if started is not None:
+            timings.append(f'total;dur={elapsed * 1000:.1f}')
+        response.headers['Server-Timing'] = ', '.join(timings)
+    return response
+
+# after_request не вызывается, если необработанное исключение пробрасывается дальше
+# (PROPAGATE_EXCEPTIONS, режим отладки) или упал другой обработчик after_request:
+# такие запросы учитываются здесь со статусом 500, иначе они выпадают из метрик ошибок
+@app.teardown_request
+def observe_failed_request(exc):
+    started = g.pop('request_started', None)
+    if started is None:
+        return
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    http_request_duration.observe(time.perf_counter() - started, method=request.method, endpoint=endpoint, status=500)
+    finish_sql_profile(endpoint)
+
+# Слушатель на классе Engine: считаются запросы всех подключений, в том числе из миграций
+@sa_event.listens_for(Engine, 'before_cursor_execute')
+def count_db_query(conn, cursor, statement, parameters, context, executemany):
+    db_queries_total.inc(operation=statement.lstrip()[:6].upper())
+
+# Личная комната пользователя: в ней все его устройства, сюда отправляются адресные события
+def user_room(user_id):
+    return f'user_{user_id}'
+
+# Постраничная загрузка истории сообщений
+MESSAGES_PAGE_SIZE = 50
+MESSAGES_PAGE_MAX = 200
+# Длина превью последнего сообщения в списке чатов
+LAST_MESSAGE_PREVIEW_LENGTH = 100
+# Поиск пользователей
+SEARCH_MIN_QUERY_LENGTH = 2
+SEARCH_PAGE_SIZE = 20
+SEARCH_PAGE_MAX = 50
+SEARCH_PREFIX_UPPER_BOUND = '\U0010ffff' # максимальный символ Unicode: q + он больше любой строки с префиксом q
+# Журнал изменений для /sync: размер страницы и срок хранения записей
+SYNC_PAGE_SIZE = 500
+CHANGE_LOG_TTL = int(os.environ.get('CHANGE_LOG_TTL', 30 * 24 * 3600)) # секунды
+CHANGE_LOG_PRUNE_INTERVAL = 3600
+# Курсор /sync не заходит за записи моложе этого окна (секунды), см. sync_watermark
+SYNC_CURSOR_GRACE = float(os.environ.get('SYNC_CURSOR_GRACE', 5))
+# Повтор пропущенных событий комнаты при повторном join с last_seq: сколько последних событий
+# каждой комнаты держать в памяти и общий бюджет памяти на все комнаты (остальное - из БД).
+# Запись с коротким текстом занимает ~0.6 КБ, голосовое с формой волны ~1 КБ, плюс сам текст
+# (кириллица - 2 байта на символ), т.е. 16 МБ по умолчанию - это порядка 15-25 тысяч событий.
+REPLAY_RING_SIZE = int(os.environ.get('REPLAY_RING_SIZE', 100))
+REPLAY_MAX_BYTES = int(os.environ.get('REPLAY_MAX_BYTES', 16 * 1024 * 1024))
+# Больший промежуток из журнала не досылается (один join не должен выгружать всю историю):
+# клиент получает resync и перезагружает чат страницами
+REPLAY_MAX_GAP = SYNC_PAGE_SIZE
+# Загрузка аудио по частям
+UPLOAD_CHUNK_SIZE = 256 * 1024 # рекомендуемый клиентам размер части
+UPLOAD_STREAM_BUFFER = 64 * 1024 # часть пишется на диск блоками, не буферизуется целиком
+MAX_AUDIO_UPLOAD_SIZE = int(os.environ.get('MAX_AUDIO_UPLOAD_SIZE', 50 * 1024 * 1024))
+PARTIAL_UPLOAD_TTL = 24 * 3600 # брошенные загрузки удаляются через сутки
+# Загруженный, но так и не отправленный файл (ни одной ссылки) удаляется через то же время
+ORPHAN_BLOB_TTL = PARTIAL_UPLOAD_TTL
+# Отдача /uploads. Файл отдаётся через wsgi.file_wrapper (gunicorn использует sendfile).
+# Если перед приложением стоит nginx, файлы может отдавать он сам: UPLOADS_ACCEL_REDIRECT задаёт
+# internal-location, отображённый на UPLOAD_FOLDER (например, /protected_uploads/).
+# USE_X_SENDFILE=1 - то же самое через заголовок X-Sendfile (Apache, lighttpd).
+UPLOADS_ACCEL_REDIRECT = os.environ.get('UPLOADS_ACCEL_REDIRECT')
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
+UPLOAD_CACHE_MAX_AGE = 365 * 24 * 3600 # сжатый файл по hash-ссылке больше не меняется
+# Фоновое сжатие голосовых сообщений в Opus (нужен ffmpeg с libopus)
+TRANSCODE_WORKERS = int(os.environ.get('TRANSCODE_WORKERS', 2))
+TRANSCODE_MAX_QUEUE = int(os.environ.get('TRANSCODE_MAX_QUEUE', 100))
+TRANSCODE_BITRATE = os.environ.get('TRANSCODE_BITRATE', '24k')
+FFMPEG_BINARY = os.environ.get('FFMPEG_BINARY', 'ffmpeg')
+# Отложенная пакетная запись сообщений (write-behind), по умолчанию выключена.
+# Сообщение получает id и рассылается сразу, а в БД попадает групповым коммитом,
+# когда в очереди набралось MESSAGE_BATCH_SIZE сообщений или прошло MESSAGE_BATCH_INTERVAL секунд.
+# Гарантии: при штатной остановке очередь сбрасывается в БД; при падении процесса
+# теряются сообщения, разосланные за последние MESSAGE_BATCH_INTERVAL секунд.
+# id выдаёт общий счётчик (в Redis он переживает перезапуск). Пока write-behind был выключен,
+# прямые вставки могли занять id впереди счётчика, поэтому при старте и после ошибки записи
+# счётчик подтягивается к MAX(id). Сообщения, уже разосланные с занятым id, при этом теряются.
+MESSAGE_WRITE_BEHIND = os.environ.get('MESSAGE_WRITE_BEHIND') == '1'
+MESSAGE_BATCH_SIZE = int(os.environ.get('MESSAGE_BATCH_SIZE', 100))
+MESSAGE_BATCH_INTERVAL = float(os.environ.get('MESSAGE_BATCH_INTERVAL', 0.05))
+# Хеширование паролей: сколько операций может ждать пула потоков (размер пула - EVENTLET_THREADPOOL_SIZE)
+PASSWORD_HASH_MAX_PENDING = int(os.environ.get('PASSWORD_HASH_MAX_PENDING', 32))
+# Ограничение частоты socket-событий: "событие=скорость/запас,..." (см. pc_app/ratelimit.py).
+# Лимит соединения защищает от одного зациклившегося клиента, лимит пользователя - от множества его устройств.
+SOCKET_RATE_LIMITS = parse_limits(os.environ.get('SOCKET_RATE_LIMITS'), {
+    'send_message': (5, 20),
+    'join': (2, 10),
+    'call_request': (0.2, 3),
+    'call_accepted': (1, 5),
+    'call_declined': (1, 5),
+    'call_ended': (1, 5)
+})
+SOCKET_USER_RATE_LIMITS = parse_limits(os.environ.get('SOCKET_USER_RATE_LIMITS'), {
+    'send_message': (10, 40),
+    'join': (5, 20),
+    'call_request': (0.2, 5)
+})
+# Кэш проверенных токенов
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 10000))
+TOKEN_CACHE_TTL = int(os.environ.get('TOKEN_CACHE_TTL', 300)) # секунды
+
+# Пользователь, прошедший проверку токена (достаточно id и имени, объект из БД не нужен)
+AuthenticatedUser = namedtuple('AuthenticatedUser', ['id', 'username'])
+
+# LRU-кэш: токен -> пользователь. Запись живёт не дольше TTL и не дольше exp самого токена.
+class TokenCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict() # {token: (user, expires_at)}
+        self._tokens_by_user = {} # {user_id: set(tokens)}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, token):
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry and entry[1] > time.time():
+                self._entries.move_to_end(token)
+                self.hits += 1
+                return entry[0]
+            if entry:
+                self._remove(token)
+            self.misses += 1
+            return None
+
+    def put(self, token, user, exp):
+        expires_at = min(exp, time.time() + self.ttl)
+        with self._lock:
+            if token in self._entries:
+                self._remove(token)
+            self._entries[token] = (user, expires_at)
+            self._tokens_by_user.setdefault(user.id, set()).add(token)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate_token(self, token):
+        with self._lock:
+            if token in self._entries:
+                self._remove(token)
+                self.invalidations += 1
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            for token in list(self._tokens_by_user.get(user_id, ())):
+                self._remove(token)
+                self.invalidations += 1
+
+    def _remove(self, token):
+        user, _ = self._entries.pop(token)
+        tokens = self._tokens_by_user.get(user.id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_user[user.id]
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations
+        }
+
+token_cache = TokenCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL)
+transcoder = AudioTranscoder(TRANSCODE_WORKERS, TRANSCODE_MAX_QUEUE, FFMPEG_BINARY, TRANSCODE_BITRATE)
+
+class PasswordHasherBusy(Exception):
+    pass
+
+# pbkdf2 выполняется в настоящих потоках ОС (eventlet.tpool), поэтому не блокирует
+# цикл событий и доставку сообщений. Очередь ограничена: при переполнении запрос
+# сразу отклоняется, а не копится бесконечно.
+class PasswordHasher:
+    def __init__(self, max_pending):
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self.rejected = 0
+
+    def _run(self, func, *args, **kwargs):
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            raise PasswordHasherBusy()
+        try:
+            return tpool.execute(func, *args, **kwargs)
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, method='pbkdf2:sha256')
+
+    def check(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
 
-online_users = {} # {user_id: sid}
+password_hasher = PasswordHasher(PASSWORD_HASH_MAX_PENDING)
 
 # Модель пользователя
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
     password = db.Column(db.String(120), nullable=False)
+    # Имя в нижнем регистре для индексированного поиска по префиксу
+    username_lower = db.Column(db.String(80), nullable=True)
+
+    # На Postgres дополнительно есть триграммный индекс (см. миграцию)
+    __table_args__ = (
+        db.Index('ix_user_username_lower', 'username_lower'),
+    )
 
 # Модель для хранения контактов пользователей
 class Contact(db.Model):
@@ -73,11 +433,38 @@ class Contact(db.Model):
     # Уникальное ограничение, чтобы нельзя было добавить одного и того же контакта дважды
     __table_args__ = (db.UniqueConstraint('user_id', 'contact_id', name='_user_contact_uc'),)
 
-# Модель чата
+# Модель чата. Пара участников хранится упорядоченной: user1_id < user2_id (см. chat_pair),
+# поэтому чат двух пользователей ищется по одному уникальному индексу
 class Chat(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user1_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     user2_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    # Денормализованная ссылка на последнее сообщение для списка чатов
+    last_message_id = db.Column(db.Integer, nullable=True)
+    # Последний выданный номер события чата (сообщение или удаление), см. next_chat_seq
+    last_seq = db.Column(db.Integer, default=0, nullable=False)
+
+    # Уникальный индекс по паре покрывает и поиск по user1_id; для списка чатов нужен ещё индекс по user2_id
+    __table_args__ = (
+        db.UniqueConstraint('user1_id', 'user2_id', name='uq_chat_user_pair'),
+        db.Index('ix_chat_user2_id', 'user2_id'),
+    )
+
+def chat_pair(user_id, other_id):
+    return min(user_id, other_id), max(user_id, other_id)
+
+# Изменение или удаление пользователя делает его закэшированные токены недействительными
+@db.event.listens_for(User, 'after_update')
+@db.event.listens_for(User, 'after_delete')
+def invalidate_user_tokens(mapper, connection, target):
+    token_cache.invalidate_user(target.id)
+
+# Курсор прочтения участника чата и денормализованный счётчик непрочитанных
+class ChatReadCursor(db.Model):
+    chat_id = db.Column(db.Integer, db.ForeignKey('chat.id'), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    last_read_message_id = db.Column(db.Integer, default=0, nullable=False)
+    unread_count = db.Column(db.Integer, default=0, nullable=False)
 
 # Модель сообщения
 class Message(db.Model):
@@ -87,6 +474,320 @@ class Message(db.Model):
     content = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
     is_audio = db.Column(db.Boolean, default=False, nullable=False)
+    # Метаданные голосового сообщения, копируются из Blob при отправке (пики - JSON-список)
+    audio_duration = db.Column(db.Float, nullable=True)
+    audio_waveform = db.Column(db.Text, nullable=True)
+    # Номер события в чате, по нему клиент догоняет пропущенное (join с last_seq)
+    seq = db.Column(db.Integer, nullable=True)
+
+    # Индекс для постраничной выборки истории чата по курсору (chat_id, id)
+    __table_args__ = (db.Index('ix_message_chat_id_id', 'chat_id', 'id'),)
+
+# Загруженный файл, адресуемый по sha256 содержимого. ref_count - число сообщений,
+# ссылающихся на файл: одинаковые загрузки и пересылки хранятся в одном экземпляре
+class Blob(db.Model):
+    hash = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.Integer, nullable=False)
+    ref_count = db.Column(db.Integer, default=0, nullable=False)
+    uploaded_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    # Длительность и пики (JSON) считаются один раз при загрузке, см. analyze_wav
+    duration = db.Column(db.Float, nullable=True)
+    waveform = db.Column(db.Text, nullable=True)
+
+# Журнал изменений пользователя для догоняющей синхронизации (/sync).
+# id растёт монотонно и служит курсором; на каждое событие пишется строка для каждого участника чата.
+CHANGE_MESSAGE = 'message'
+CHANGE_MESSAGE_DELETED = 'message_deleted'
+CHANGE_CHAT_CREATED = 'chat_created'
+
+class ChangeLog(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    kind = db.Column(db.String(20), nullable=False)
+    chat_id = db.Column(db.Integer, nullable=False)
+    message_id = db.Column(db.Integer, nullable=True)
+    seq = db.Column(db.Integer, nullable=True) # номер события в чате (для сообщений и удалений)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_change_log_user_id_id', 'user_id', 'id'),
+        db.Index('ix_change_log_chat_id_seq', 'chat_id', 'seq'),
+    )
+
+def chat_change_rows(chat_id, member_ids, kind, message_id=None, seq=None):
+    return [{'user_id': user_id, 'kind': kind, 'chat_id': chat_id, 'message_id': message_id, 'seq': seq}
+            for user_id in member_ids]
+
+# Записи добавляются в текущую транзакцию, вместе с самим изменением
+def record_changes(rows):
+    if rows:
+        db.session.execute(ChangeLog.__table__.insert(), rows)
+
+def serialize_message(msg, sender_username):
+    return {
+        'id': msg.id,
+        'chat_id': msg.chat_id,
+        'seq': msg.seq,
+        'sender': sender_username,
+        'sender_id': msg.sender_id,
+        'content': msg.content,
+        'is_audio': msg.is_audio,
+        'audio_duration': msg.audio_duration,
+        'audio_waveform': json.loads(msg.audio_waveform) if msg.audio_waveform else None,
+        'timestamp': msg.timestamp.isoformat()
+    }
+
+# --- Номера событий чата и повтор пропущенного ---
+# Каждое сообщение и удаление получает следующий номер в своём чате (общий счётчик для всех воркеров,
+# продолжает Chat.last_seq). Клиент запоминает последний увиденный номер и передаёт его в join.
+
+def _chat_seq_seed(chat_id):
+    return lambda: db.session.query(Chat.last_seq).filter(Chat.id == chat_id).scalar() or 0
+
+def next_chat_seq(chat_id):
+    return state.counter(f'chat_seq:{chat_id}').next(_chat_seq_seed(chat_id))
+
+def current_chat_seq(chat_id):
+    return state.counter(f'chat_seq:{chat_id}').current(_chat_seq_seed(chat_id))
+
+# Номера выдаются раньше, чем записываются, и могут прийти в БД не по порядку
+def store_chat_seq(chat_id, seq):
+    Chat.query.filter(Chat.id == chat_id, Chat.last_seq < seq) \
+        .update({Chat.last_seq: seq}, synchronize_session=False)
+
+# Последние события каждой комнаты в памяти процесса. Пропущенное отдаётся отсюда,
+# только если буфер покрывает промежуток целиком, иначе - из журнала изменений в БД
+# (буфер переполнился, процесс перезапускался или событие разослал другой воркер).
+class ReplayRing:
+    ENTRY_OVERHEAD = 1024 # байт на запись без текста, с запасом (см. REPLAY_MAX_BYTES)
+
+    def __init__(self, size, max_bytes):
+        self.size = size
+        self.max_bytes = max_bytes
+        self._rooms = OrderedDict() # {chat_id: deque((seq, event, payload, cost))}
+        self._lock = threading.Lock()
+        self.bytes = 0 # оценка занятой памяти
+        self.entries = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _cost(self, payload):
+        content = payload.get('content')
+        return self.ENTRY_OVERHEAD + (2 * len(content) if isinstance(content, str) else 0)
+
+    def _drop_oldest(self, ring):
+        self.bytes -= ring.popleft()[3]
+        self.entries -= 1
+
+    def append(self, chat_id, seq, event, payload):
+        cost = self._cost(payload)
+        with self._lock:
+            ring = self._rooms.get(chat_id)
+            if ring is None:
+                ring = self._rooms[chat_id] = deque()
+            else:
+                self._rooms.move_to_end(chat_id)
+            if len(ring) >= self.size:
+                self._drop_oldest(ring)
+            ring.append((seq, event, payload, cost))
+            self.bytes += cost
+            self.entries += 1
+            # Сверх бюджета вытесняются давно не активные комнаты целиком, в последней - старые события
+            while self.bytes > self.max_bytes and self._rooms:
+                oldest_id, oldest = next(iter(self._rooms.items()))
+                if oldest_id == chat_id:
+                    self._drop_oldest(oldest)
+                    if not oldest:
+                        del self._rooms[oldest_id]
+                    continue
+                del self._rooms[oldest_id]
+                self.bytes -= sum(entry[3] for entry in oldest)
+                self.entries -= len(oldest)
+
+    def since(self, chat_id, last_seq, current_seq):
+        with self._lock:
+            entries = sorted((entry for entry in self._rooms.get(chat_id, ()) if entry[0] > last_seq), key=lambda entry: entry[0])
+        if [entry[0] for entry in entries] != list(range(last_seq + 1, current_seq + 1)):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return [(event, payload) for _, event, payload, _ in entries]
+
+    def stats(self):
+        return {'rooms': len(self._rooms), 'entries': self.entries, 'bytes': self.bytes,
+                'hits': self.hits, 'misses': self.misses}
+
+replay_ring = ReplayRing(REPLAY_RING_SIZE, REPLAY_MAX_BYTES)
+
+# Прямая запись: одно сообщение - один коммит
+def persist_message(chat, sender_id, content, is_audio, audio_duration=None, audio_waveform=None, seq=None):
+    new_message = Message(chat_id=chat.id, sender_id=sender_id, content=content, is_audio=is_audio,
+                          audio_duration=audio_duration, audio_waveform=audio_waveform, seq=seq)
+    db.session.add(new_message)
+    db.session.flush()
+    chat.last_message_id = new_message.id
+    if seq:
+        store_chat_seq(chat.id, seq)
+    ChatReadCursor.query.filter(ChatReadCursor.chat_id == chat.id, ChatReadCursor.user_id != sender_id) \
+        .update({ChatReadCursor.unread_count: ChatReadCursor.unread_count + 1}, synchronize_session=False)
+    record_changes(chat_change_rows(chat.id, (chat.user1_id, chat.user2_id), CHANGE_MESSAGE, new_message.id, seq))
+    db.session.commit()
+    return new_message
+
+# Отложенная пакетная запись (см. MESSAGE_WRITE_BEHIND)
+class MessageWriteBehind:
+    def __init__(self, batch_size, interval):
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue = [] # строки для вставки в таблицу message
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._ids = state.counter('message_id')
+        self._seeded = False
+        self._started = False
+        self.flushed = 0
+        self.batches = 0
+
+    def _max_message_id(self):
+        return db.session.query(db.func.max(Message.id)).scalar() or 0
+
+    def _reseed_ids(self):
+        self._ids.advance_to(self._max_message_id())
+
+    def enqueue(self, chat_id, sender_id, content, is_audio, audio_duration=None, audio_waveform=None, seq=None):
+        # id выдаётся сразу из общего счётчика, который продолжает нумерацию после max(id) в БД
+        if not self._seeded:
+            self._reseed_ids()
+            self._seeded = True
+        message_id = self._ids.next(self._max_message_id)
+        new_message = Message(id=message_id, chat_id=chat_id, sender_id=sender_id, content=content,
+                              is_audio=is_audio, audio_duration=audio_duration, audio_waveform=audio_waveform,
+                              seq=seq, timestamp=datetime.utcnow())
+        with self._lock:
+            self._queue.append({
+                'id': new_message.id,
+                'chat_id': chat_id,
+                'sender_id': sender_id,
+                'content': content,
+                'is_audio': is_audio,
+                'audio_duration': audio_duration,
+                'audio_waveform': audio_waveform,
+                'seq': seq,
+                'timestamp': new_message.timestamp
+            })
+            full = len(self._queue) >= self.batch_size
+            if not self._started:
+                self._started = True
+                socketio.start_background_task(self._run)
+        if full:
+            self._wakeup.set()
+        return new_message
+
+    def pending(self):
+        return len(self._queue)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                with app.app_context():
+                    self.flush()
+            except Exception as e:
+                print(f"Message flush error: {e}")
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                batch, self._queue = self._queue, []
+            if not batch:
+                return 0
+            try:
+                self._write(batch)
+            except Exception as e:
+                # Пачка целиком не записалась - пишем по одному, чтобы одна плохая строка не блокировала остальные
+                db.session.rollback()
+                print(f"Batch insert of {len(batch)} messages failed, retrying one by one: {e}")
+                for row in batch:
+                    try:
+                        self._write([row])
+                    except Exception as row_error:
+                        db.session.rollback()
+                        print(f"Dropping message {row['id']}: {row_error}")
+                # Если причина - занятые id, следующие сообщения не должны повторить ошибку
+                try:
+                    self._reseed_ids()
+                except Exception as seed_error:
+                    db.session.rollback()
+                    print(f"Cannot reseed message ids: {seed_error}")
+            self.batches += 1
+            self.flushed += len(batch)
+            return len(batch)
+
+    def _write(self, batch):
+        db.session.execute(Message.__table__.insert(), batch)
+
+        # Денормализованные поля чатов: одно обновление на чат (и отправителя) в пачке
+        last_ids = {}
+        last_seqs = {}
+        sent_counts = {}
+        for row in batch:
+            last_ids[row['chat_id']] = max(last_ids.get(row['chat_id'], 0), row['id'])
+            last_seqs[row['chat_id']] = max(last_seqs.get(row['chat_id'], 0), row['seq'] or 0)
+            key = (row['chat_id'], row['sender_id'])
+            sent_counts[key] = sent_counts.get(key, 0) + 1
+        for chat_id, last_id in last_ids.items():
+            Chat.query.filter(Chat.id == chat_id, db.func.coalesce(Chat.last_message_id, 0) < last_id) \
+                .update({Chat.last_message_id: last_id}, synchronize_session=False)
+        for chat_id, last_seq in last_seqs.items():
+            if last_seq:
+                store_chat_seq(chat_id, last_seq)
+        for (chat_id, sender_id), count in sent_counts.items():
+            ChatReadCursor.query.filter(ChatReadCursor.chat_id == chat_id, ChatReadCursor.user_id != sender_id) \
+                .update({ChatReadCursor.unread_count: ChatReadCursor.unread_count + count}, synchronize_session=False)
+
+        members = {chat_id: (user1_id, user2_id) for chat_id, user1_id, user2_id in
+                   db.session.query(Chat.id, Chat.user1_id, Chat.user2_id).filter(Chat.id.in_(last_ids))}
+        changes = []
+        for row in batch:
+            changes += chat_change_rows(row['chat_id'], members.get(row['chat_id'], ()), CHANGE_MESSAGE, row['id'], row['seq'])
+        record_changes(changes)
+
+        # id заданы явно, поэтому последовательность Postgres нужно подтянуть вручную,
+        # иначе прямая запись после отключения write-behind получит уже занятый id
+        if db.engine.dialect.name == 'postgresql':
+            db.session.execute(db.text("SELECT setval(pg_get_serial_sequence('message', 'id'), (SELECT MAX(id) FROM message))"))
+        db.session.commit()
+
+message_writer = MessageWriteBehind(MESSAGE_BATCH_SIZE, MESSAGE_BATCH_INTERVAL)
+
+# Перед чтением истории сбрасываем очередь, чтобы клиент видел только что отправленные сообщения
+def flush_pending_messages():
+    if MESSAGE_WRITE_BEHIND and message_writer.pending():
+        message_writer.flush()
+
+def _flush_on_exit():
+    with app.app_context():
+        message_writer.flush()
+
+atexit.register(_flush_on_exit)
+
+def mark_chat_read(chat_id, user_id, message_id):
+    cursor = ChatReadCursor.query.get((chat_id, user_id))
+    if not cursor:
+        cursor = ChatReadCursor(chat_id=chat_id, user_id=user_id, last_read_message_id=0, unread_count=0)
+        db.session.add(cursor)
+    if message_id <= cursor.last_read_message_id:
+        return
+    cursor.last_read_message_id = message_id
+    # Пересчёт идёт по индексу (chat_id, id) и затрагивает только сообщения после курсора
+    cursor.unread_count = Message.query.filter(
+        Message.chat_id == chat_id,
+        Message.id > message_id,
+        Message.sender_id != user_id
+    ).count()
+    db.session.commit()
 
 @app.route('/')
 def index():
@@ -104,8 +805,11 @@ def register():
     if User.query.filter_by(username=username).first():
         return jsonify({'message': 'Имя пользователя уже занято'}), 400
 
-    hashed_password = generate_password_hash(password, method='pbkdf2:sha256')
-    new_user = User(username=username, password=hashed_password)
+    try:
+        hashed_password = password_hasher.hash(password)
+    except PasswordHasherBusy:
+        return jsonify({'message': 'Сервер перегружен, попробуйте позже'}), 503
+    new_user = User(username=username, username_lower=username.lower(), password=hashed_password)
     db.session.add(new_user)
     db.session.commit()
 
@@ -122,7 +826,12 @@ def login():
 
     user = User.query.filter_by(username=username).first()
 
-    if not user or not check_password_hash(user.password, password):
+    try:
+        password_ok = user is not None and password_hasher.check(user.password, password)
+    except PasswordHasherBusy:
+        return jsonify({'message': 'Сервер перегружен, попробуйте позже'}), 503
+
+    if not password_ok:
         return jsonify({'message': 'Неверное имя пользователя или пароль'}), 401
 
     # Создание токена
@@ -135,17 +844,74 @@ def login():
 
 @app.route('/users/search', methods=['GET'])
 def search_users():
-    username_query = request.args.get('username', '')
+    username_query = request.args.get('username', '').strip().lower()
     if not username_query:
         return jsonify({'message': 'Необходимо указать имя пользователя для поиска'}), 400
-
-    # Поиск пользователей, чье имя содержит поисковый запрос
-    users = User.query.filter(User.username.ilike(f'%{username_query}%')).all()
+    if len(username_query) < SEARCH_MIN_QUERY_LENGTH:
+        return jsonify({'message': f'Запрос должен содержать не менее {SEARCH_MIN_QUERY_LENGTH} символов'}), 400
+
+    limit = request.args.get('limit', SEARCH_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, SEARCH_PAGE_MAX))
+
+    # Курсор: "p:<имя>" - продолжение совпадений по префиксу, "c:<имя>" - совпадений по подстроке
+    cursor = request.args.get('cursor', '')
+    tier, _, after = cursor.partition(':')
+    if cursor and tier not in ('p', 'c'):
+        return jsonify({'message': 'Некорректный курсор'}), 400
+
+    # Сначала совпадения по префиксу (точное совпадение сортируется первым), затем по подстроке.
+    # Префикс ищется диапазоном: LIKE 'q%' с параметром SQLite не применяет к индексу.
+    # LIKE остаётся проверкой на случай сортировки Postgres, не совпадающей с побайтовой.
+    # Обе выборки идут по индексу username_lower в порядке ORDER BY и ограничены limit + 1.
+    is_prefix_match = db.and_(
+        User.username_lower >= username_query,
+        User.username_lower < username_query + SEARCH_PREFIX_UPPER_BOUND,
+        User.username_lower.startswith(username_query, autoescape=True)
+    )
+    users = []
+    if tier != 'c':
+        query = User.query.filter(is_prefix_match)
+        if after:
+            query = query.filter(User.username_lower > after)
+        users = query.order_by(User.username_lower.asc()).limit(limit + 1).all()
+        if len(users) <= limit:
+            after = ''
+    if len(users) <= limit:
+        query = User.query.filter(
+            User.username_lower.contains(username_query, autoescape=True),
+            ~User.username_lower.startswith(username_query, autoescape=True)
+        )
+        if after:
+            query = query.filter(User.username_lower > after)
+        users += query.order_by(User.username_lower.asc()).limit(limit + 1 - len(users)).all()
+
+    has_more = len(users) > limit
+    users = users[:limit]
+    next_cursor = None
+    if has_more:
+        last = users[-1]
+        last_tier = 'p' if last.username_lower.startswith(username_query) else 'c'
+        next_cursor = f'{last_tier}:{last.username_lower}'
 
     # Формирование списка пользователей для ответа
     users_list = [{'id': user.id, 'username': user.username} for user in users]
 
-    return jsonify(users_list), 200
+    return jsonify({'users': users_list, 'next_cursor': next_cursor}), 200
+
+def verify_token(token):
+    user = token_cache.get(token)
+    if user:
+        return user
+    try:
+        data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
+    except jwt.InvalidTokenError:
+        return None
+    row = db.session.query(User.id, User.username).filter(User.id == data.get('user_id')).first()
+    if not row:
+        return None
+    user = AuthenticatedUser(row.id, row.username)
+    token_cache.put(token, user, data['exp'])
+    return user
 
 # Декоратор для проверки токена
 def token_required(f):
@@ -158,10 +924,8 @@ def token_required(f):
         if not token:
             return jsonify({'message': 'Токен отсутствует!'}), 401
 
-        try:
-            data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
-            current_user = User.query.get(data['user_id'])
-        except:
+        current_user = verify_token(token)
+        if not current_user:
             return jsonify({'message': 'Токен недействителен!'}), 401
 
         return f(current_user, *args, **kwargs)
@@ -200,22 +964,19 @@ def add_contact(current_user):
 @app.route('/contacts', methods=['GET'])
 @token_required
 def get_contacts(current_user):
-    contacts = Contact.query.filter_by(user_id=current_user.id).all()
-    contact_list = []
-    for contact in contacts:
-        contact_user = User.query.get(contact.contact_id)
-        if contact_user:
-            contact_list.append({'id': contact_user.id, 'username': contact_user.username})
+    contacts = db.session.query(User.id, User.username).join(Contact, Contact.contact_id == User.id).filter(Contact.user_id == current_user.id).all()
+    contact_list = [{'id': user_id, 'username': username} for user_id, username in contacts]
 
     return jsonify(contact_list), 200
 
 @app.route('/chats/create', methods=['POST'])
 @token_required
 def create_chat(current_user):
-    data = request.get_json()
-    contact_id = data.get('contact_id')
-
-    if not contact_id:
+    data = request.get_json(silent=True) or {}
+    # id приводится к int заранее: chat_pair сравнивает его с id текущего пользователя
+    try:
+        contact_id = int(data.get('contact_id'))
+    except (TypeError, ValueError):
         return jsonify({'message': 'Необходимо указать contact_id'}), 400
 
     # Проверка, есть ли такой контакт у пользователя
@@ -223,18 +984,25 @@ def create_chat(current_user):
     if not contact:
         return jsonify({'message': 'Этого пользователя нет в ваших контактах'}), 403
 
-    # Проверка, существует ли уже чат между этими пользователями
-    # Чтобы избежать дублирования, проверяем обе комбинации user1_id и user2_id
-    chat = Chat.query.filter(
-        ((Chat.user1_id == current_user.id) & (Chat.user2_id == contact_id)) |
-        ((Chat.user1_id == contact_id) & (Chat.user2_id == current_user.id))
-    ).first()
+    # Идемпотентное создание: поиск по уникальной паре, при гонке двух запросов
+    # второй получает IntegrityError и возвращает чат, созданный первым
+    user1_id, user2_id = chat_pair(current_user.id, contact_id)
+    chat = Chat.query.filter_by(user1_id=user1_id, user2_id=user2_id).first()
 
     if chat:
         return jsonify({'message': 'Чат уже существует', 'chat_id': chat.id}), 200
 
-    new_chat = Chat(user1_id=current_user.id, user2_id=contact_id)
+    new_chat = Chat(user1_id=user1_id, user2_id=user2_id)
     db.session.add(new_chat)
+    try:
+        db.session.flush()
+    except IntegrityError:
+        db.session.rollback()
+        chat = Chat.query.filter_by(user1_id=user1_id, user2_id=user2_id).first()
+        return jsonify({'message': 'Чат уже существует', 'chat_id': chat.id}), 200
+    db.session.add(ChatReadCursor(chat_id=new_chat.id, user_id=user1_id))
+    db.session.add(ChatReadCursor(chat_id=new_chat.id, user_id=user2_id))
+    record_changes(chat_change_rows(new_chat.id, (user1_id, user2_id), CHANGE_CHAT_CREATED))
     db.session.commit()
 
     return jsonify({'message': 'Чат успешно создан', 'chat_id': new_chat.id}), 201
@@ -242,49 +1010,185 @@ def create_chat(current_user):
 @app.route('/chats', methods=['GET'])
 @token_required
 def get_chats(current_user):
-    # Находим все чаты, где пользователь является user1 или user2
-    chats = Chat.query.filter((Chat.user1_id == current_user.id) | (Chat.user2_id == current_user.id)).all()
+    flush_pending_messages()
+    # Один запрос: чаты пользователя, собеседник, последнее сообщение и счётчик непрочитанных
+    other_user = db.aliased(User)
+    last_message = db.aliased(Message)
+    other_user_id = db.case((Chat.user1_id == current_user.id, Chat.user2_id), else_=Chat.user1_id)
+    rows = db.session.query(Chat.id, other_user.id, other_user.username, last_message, ChatReadCursor.unread_count) \
+        .join(other_user, other_user.id == other_user_id) \
+        .outerjoin(last_message, last_message.id == Chat.last_message_id) \
+        .outerjoin(ChatReadCursor, (ChatReadCursor.chat_id == Chat.id) & (ChatReadCursor.user_id == current_user.id)) \
+        .filter((Chat.user1_id == current_user.id) | (Chat.user2_id == current_user.id)) \
+        .order_by(db.func.coalesce(Chat.last_message_id, 0).desc(), Chat.id.desc()) \
+        .all()
+
     chat_list = []
-    for chat in chats:
-        # Определяем ID другого участника чата
-        other_user_id = chat.user2_id if chat.user1_id == current_user.id else chat.user1_id
-        other_user = User.query.get(other_user_id)
-        if other_user:
-            chat_list.append({
-                'chat_id': chat.id,
-                'with_user': {
-                    'id': other_user.id,
-                    'username': other_user.username
-                }
-            })
+    for chat_id, user_id, username, msg, unread_count in rows:
+        last_message_preview = None
+        if msg:
+            sender_username = username if msg.sender_id == user_id else current_user.username
+            last_message_preview = serialize_message(msg, sender_username)
+            last_message_preview['content'] = msg.content[:LAST_MESSAGE_PREVIEW_LENGTH]
+            last_message_preview.pop('audio_waveform') # в списке чатов форма волны не нужна
+        chat_list.append({
+            'chat_id': chat_id,
+            'with_user': {
+                'id': user_id,
+                'username': username,
+                'online': online_users.is_online(user_id)
+            },
+            'last_message': last_message_preview,
+            'unread_count': unread_count or 0
+        })
 
     return jsonify(chat_list), 200
 
 @app.route('/chats/<int:chat_id>/messages', methods=['GET'])
 @token_required
 def get_messages(current_user, chat_id):
+    flush_pending_messages()
     chat = Chat.query.get(chat_id)
     if not chat or (current_user.id not in [chat.user1_id, chat.user2_id]):
         return jsonify({'message': 'Чат не найден или у вас нет доступа'}), 404
 
-    messages = Message.query.filter_by(chat_id=chat_id).order_by(Message.timestamp.asc()).all()
-    message_list = []
-    for msg in messages:
-        sender = User.query.get(msg.sender_id)
-        message_list.append({
-            'id': msg.id,
-            'sender': sender.username,
-            'sender_id': msg.sender_id,
-            'content': msg.content,
-            'is_audio': msg.is_audio,
-            'timestamp': msg.timestamp.isoformat()
-        })
-    return jsonify(message_list), 200
+    before_id = request.args.get('before_id', type=int)
+    after_id = request.args.get('after_id', type=int)
+    limit = request.args.get('limit', MESSAGES_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, MESSAGES_PAGE_MAX))
+
+    if before_id is not None and after_id is not None:
+        return jsonify({'message': 'Нельзя указывать before_id и after_id одновременно'}), 400
+
+    # Выбираем на одно сообщение больше, чтобы понять, есть ли следующая страница.
+    # Имя отправителя берём тем же запросом через JOIN, а не отдельным запросом на каждое сообщение.
+    query = db.session.query(Message, User.username).join(User, User.id == Message.sender_id).filter(Message.chat_id == chat_id)
+    if after_id is not None:
+        # Более новые сообщения, начиная с after_id
+        messages = query.filter(Message.id > after_id).order_by(Message.id.asc()).limit(limit + 1).all()
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        next_cursor = messages[-1][0].id if has_more else None
+    else:
+        # По умолчанию - самая новая страница, before_id листает историю назад
+        if before_id is not None:
+            query = query.filter(Message.id < before_id)
+        messages = query.order_by(Message.id.desc()).limit(limit + 1).all()
+        has_more = len(messages) > limit
+        messages = messages[:limit][::-1]
+        next_cursor = messages[0][0].id if has_more else None
+
+    message_list = [serialize_message(msg, sender_username) for msg, sender_username in messages]
+
+    # Открытие самой новой страницы означает, что чат прочитан
+    if before_id is None and not (after_id is not None and has_more) and messages:
+        mark_chat_read(chat_id, current_user.id, messages[-1][0].id)
+    # next_cursor передаётся обратно как before_id (или after_id) для следующей страницы
+    return jsonify({'messages': message_list, 'next_cursor': next_cursor}), 200
+
+@app.route('/chats/<int:chat_id>/read', methods=['POST'])
+@token_required
+def read_chat(current_user, chat_id):
+    flush_pending_messages()
+    chat = Chat.query.get(chat_id)
+    if not chat or (current_user.id not in [chat.user1_id, chat.user2_id]):
+        return jsonify({'message': 'Чат не найден или у вас нет доступа'}), 404
+
+    data = request.get_json(silent=True) or {}
+    message_id = data.get('message_id')
+    if message_id is None:
+        message_id = chat.last_message_id
+    elif not isinstance(message_id, int):
+        return jsonify({'message': 'Некорректный message_id'}), 400
+    else:
+        # Курсор не может уйти дальше последнего сообщения, иначе новые не будут считаться непрочитанными
+        message_id = min(message_id, chat.last_message_id or 0)
+    if message_id:
+        mark_chat_read(chat_id, current_user.id, message_id)
+
+    return jsonify({'message': 'Чат отмечен как прочитанный'}), 200
+
+# --- Догоняющая синхронизация ---
+# GET /sync            -> только текущий курсор (клиент запрашивает его перед полной загрузкой)
+# GET /sync?since=N    -> изменения после курсора N: новые сообщения, удаления, новые чаты.
+# Стоимость пропорциональна числу пропущенных изменений, а не размеру истории.
+# reset=true - часть журнала уже удалена (CHANGE_LOG_TTL), клиенту нужна полная перезагрузка.
+_change_log_pruned_at = [0.0]
+
+def _prune_change_log():
+    if time.time() - _change_log_pruned_at[0] < CHANGE_LOG_PRUNE_INTERVAL:
+        return
+    _change_log_pruned_at[0] = time.time()
+    threshold = datetime.utcnow() - timedelta(seconds=CHANGE_LOG_TTL)
+    ChangeLog.query.filter(ChangeLog.created_at < threshold).delete(synchronize_session=False)
+    db.session.commit()
+
+# Безопасный курсор: наибольший id среди записей старше SYNC_CURSOR_GRACE.
+# При нескольких воркерах транзакция с меньшим id может закоммититься позже транзакции с большим;
+# если отдать клиенту max(id), он перескочит ещё невидимую запись и никогда её не получит.
+# id выдаются по порядку во времени, поэтому все записи с id не больше водяного знака уже видны -
+# при условии, что запись журнала коммитится быстрее SYNC_CURSOR_GRACE (с учётом расхождения часов узлов).
+# Свежие изменения приходят клиенту по сокету, а /sync отдаст их при следующем вызове.
+def sync_watermark():
+    cutoff = datetime.utcnow() - timedelta(seconds=SYNC_CURSOR_GRACE)
+    # Обход по первичному ключу с конца: просматриваются только записи из окна
+    return db.session.query(ChangeLog.id).filter(ChangeLog.created_at <= cutoff) \
+        .order_by(ChangeLog.id.desc()).limit(1).scalar() or 0
+
+@app.route('/sync', methods=['GET'])
+@token_required
+def sync(current_user):
+    flush_pending_messages()
+    _prune_change_log()
+    since = request.args.get('since', type=int)
+    latest = sync_watermark()
+    result = {'cursor': latest, 'has_more': False, 'reset': False, 'messages': [], 'deleted_messages': [], 'chats': []}
+    if since is None:
+        return jsonify(result), 200
+
+    oldest = db.session.query(db.func.min(ChangeLog.id)).scalar()
+    if oldest is not None and since + 1 < oldest:
+        result['reset'] = True
+        return jsonify(result), 200
+
+    changes = ChangeLog.query.filter(ChangeLog.user_id == current_user.id, ChangeLog.id > since,
+                                     ChangeLog.id <= latest) \
+        .order_by(ChangeLog.id).limit(SYNC_PAGE_SIZE + 1).all()
+    result['has_more'] = len(changes) > SYNC_PAGE_SIZE
+    changes = changes[:SYNC_PAGE_SIZE]
+    if result['has_more']:
+        result['cursor'] = changes[-1].id
+    else:
+        # Курсор не откатывается назад, если водяной знак ещё не догнал прошлый ответ
+        result['cursor'] = max(latest, since)
+
+    deleted_ids = {c.message_id for c in changes if c.kind == CHANGE_MESSAGE_DELETED}
+    # Сообщение, удалённое в том же промежутке, не отдаётся вовсе
+    message_ids = [c.message_id for c in changes if c.kind == CHANGE_MESSAGE and c.message_id not in deleted_ids]
+    chat_ids = [c.chat_id for c in changes if c.kind == CHANGE_CHAT_CREATED]
+
+    if message_ids:
+        messages = db.session.query(Message, User.username).join(User, User.id == Message.sender_id) \
+            .filter(Message.id.in_(message_ids)).order_by(Message.id).all()
+        for msg, sender_username in messages:
+            result['messages'].append(serialize_message(msg, sender_username))
+    result['deleted_messages'] = [{'chat_id': c.chat_id, 'message_id': c.message_id}
+                                  for c in changes if c.kind == CHANGE_MESSAGE_DELETED]
+    if chat_ids:
+        other_user_id = db.case((Chat.user1_id == current_user.id, Chat.user2_id), else_=Chat.user1_id)
+        for chat_id, user_id, username in db.session.query(Chat.id, User.id, User.username) \
+                .join(User, User.id == other_user_id).filter(Chat.id.in_(chat_ids)):
+            result['chats'].append({
+                'chat_id': chat_id,
+                'with_user': {'id': user_id, 'username': username, 'online': online_users.is_online(user_id)}
+            })
+
+    return jsonify(result), 200
 
 @app.route('/users/online', methods=['GET'])
 @token_required
 def get_online_users(current_user):
-    return jsonify(list(online_users.keys())), 200
+    return jsonify(online_users.online_user_ids()), 200
 
 @app.route('/upload/audio', methods=['POST'])
 @token_required
@@ -295,14 +1199,301 @@ def upload_audio(current_user):
     if file.filename == '':
         return jsonify({'message': 'Файл не выбран'}), 400
     if file:
-        filename = f"{current_user.id}_{int(datetime.now().timestamp())}.wav"
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(file_path)
-        return jsonify({'file_path': f'/uploads/{filename}'}), 201
+        tmp_path = os.path.join(PARTIAL_UPLOAD_FOLDER, f'{uuid.uuid4().hex}.upload')
+        file.save(tmp_path)
+        upload_bytes_total.inc(os.path.getsize(tmp_path), method='single')
+        blob = store_audio_blob(tmp_path)
+        return jsonify(blob_upload_response(blob)), 201
+
+# Ссылка в сообщении всегда указывает на исходный .wav; после перекодирования
+# WAV удаляется, и по той же ссылке отдаётся сжатая версия.
+# Поддерживаются Range (перемотка, докачка) и If-None-Match (клиент не скачивает файл повторно).
+@app.route('/uploads/<path:filename>', methods=['GET'])
+def serve_upload(filename):
+    directory, filename = resolve_upload(filename)
+    name, ext = os.path.splitext(filename)
+    mimetype = None
+    if ext == '.wav':
+        compressed = name + TRANSCODED_AUDIO_EXT
+        if os.path.exists(os.path.join(directory, compressed)):
+            filename, mimetype = compressed, TRANSCODED_AUDIO_MIMETYPE
+
+    path = safe_join(directory, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+
+    # Для файлов в хранилище ETag - хеш содержимого (строгий, не зависит от mtime и узла);
+    # у сжатой версии свой ETag, т.к. по той же ссылке меняется содержимое
+    etag = True
+    max_age = None
+    if is_blob_hash(name):
+        etag = name + ('-opus' if mimetype else '')
+        # Пока файл не сжат, по ссылке позже придёт другое содержимое - только с перепроверкой
+        max_age = UPLOAD_CACHE_MAX_AGE if mimetype else 0
+
+    if UPLOADS_ACCEL_REDIRECT:
+        return accel_redirect_upload(path, etag, mimetype)
+
+    return send_from_directory(directory, filename, mimetype=mimetype, etag=etag, max_age=max_age, conditional=True)
+
+def accel_redirect_upload(path, etag, mimetype):
+    # Файл (включая Range) отдаёт nginx; в location нужно выключить его собственный etag
+    response = app.response_class(mimetype=mimetype or 'audio/wav')
+    if isinstance(etag, str):
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'public, max-age=%d' % (UPLOAD_CACHE_MAX_AGE if etag.endswith('-opus') else 0)
+        if request.if_none_match.contains(etag):
+            response.status_code = 304
+            return response
+    relative_path = os.path.relpath(path, app.config['UPLOAD_FOLDER']).replace(os.sep, '/')
+    response.headers['X-Accel-Redirect'] = UPLOADS_ACCEL_REDIRECT.rstrip('/') + '/' + relative_path
+    return response
+
+# --- Хранилище загруженных файлов ---
+# Файл лежит в UPLOAD_FOLDER/<h[:2]>/<h[2:4]>/<h>.wav, где h - sha256 содержимого:
+# в одном каталоге не больше нескольких тысяч файлов, одинаковые файлы не дублируются.
+# Ссылка для клиентов плоская (/uploads/<h>.wav), каталог вычисляется по имени.
+# Файлы старого формата ({user_id}_{время}.wav) лежат в корне UPLOAD_FOLDER и отдаются как раньше.
+
+def is_blob_hash(value):
+    return len(value) == 64 and all(c in '0123456789abcdef' for c in value)
+
+def blob_dir(digest):
+    return os.path.join(app.config['UPLOAD_FOLDER'], digest[:2], digest[2:4])
+
+def blob_path(digest, ext='.wav'):
+    return os.path.join(blob_dir(digest), digest + ext)
+
+def blob_url(digest):
+    return f'/uploads/{digest}.wav'
+
+def blob_upload_response(blob):
+    return {
+        'file_path': blob_url(blob.hash),
+        'duration': blob.duration,
+        'waveform': json.loads(blob.waveform) if blob.waveform else None
+    }
+
+def blob_hash_from_url(url):
+    # /uploads/<hash>.wav -> hash, для ссылок старого формата и текста - None
+    if not url or not url.startswith('/uploads/'):
+        return None
+    name, _ = os.path.splitext(os.path.basename(url))
+    return name if is_blob_hash(name) else None
+
+def resolve_upload(filename):
+    name, _ = os.path.splitext(filename)
+    if is_blob_hash(name):
+        return blob_dir(name), filename
+    return app.config['UPLOAD_FOLDER'], filename
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(UPLOAD_STREAM_BUFFER), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Переносит загруженный файл в хранилище. Если такой файл уже есть, копия удаляется.
+def store_audio_blob(tmp_path):
+    # Хеш большого файла считается в потоке ОС, чтобы не блокировать цикл событий
+    digest = tpool.execute(file_sha256, tmp_path)
+    size = os.path.getsize(tmp_path)
+
+    blob = Blob.query.get(digest)
+    if blob:
+        blob.uploaded_at = datetime.utcnow() # не даём удалить как брошенный до отправки сообщения
+        db.session.commit()
+        os.remove(tmp_path)
+        return blob
+
+    # Длительность и пики - до перекодирования, пока файл ещё в PCM
+    try:
+        duration, peaks = tpool.execute(analyze_wav, tmp_path)
+        waveform = json.dumps(peaks)
+    except (wave.Error, EOFError, ValueError) as e:
+        # Файл сохраняется и без метаданных: клиенты просто не покажут длину и форму волны
+        print(f"Cannot analyze uploaded audio: {e}")
+        duration, waveform = None, None
+
+    path = blob_path(digest)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(tmp_path, path)
+    blob = Blob(hash=digest, size=size, duration=duration, waveform=waveform)
+    db.session.add(blob)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Тот же файл параллельно загрузил кто-то ещё, содержимое на диске одинаковое
+        db.session.rollback()
+        return Blob.query.get(digest)
+    except Exception:
+        # Записи о файле нет - возвращаем его на место, чтобы загрузку можно было повторить
+        db.session.rollback()
+        os.replace(path, tmp_path)
+        raise
+    transcoder.submit(path)
+    return blob
+
+def remove_blob_files(digest):
+    for path in (blob_path(digest), blob_path(digest, TRANSCODED_AUDIO_EXT)):
+        if os.path.exists(path):
+            os.remove(path)
+
+# Счётчик ссылок меняется атомарным UPDATE, без чтения строки.
+# Возвращает метаданные файла (длительность, пики), чтобы сохранить их в сообщении.
+def add_blob_ref(url):
+    digest = blob_hash_from_url(url)
+    if not digest:
+        return None, None
+    Blob.query.filter_by(hash=digest).update({Blob.ref_count: Blob.ref_count + 1}, synchronize_session=False)
+    meta = db.session.query(Blob.duration, Blob.waveform).filter_by(hash=digest).first()
+    return meta if meta else (None, None)
+
+def release_blob_ref(url):
+    # Возвращает hash, если на файл больше никто не ссылается и его нужно удалить
+    digest = blob_hash_from_url(url)
+    if not digest:
+        return None
+    Blob.query.filter(Blob.hash == digest, Blob.ref_count > 0) \
+        .update({Blob.ref_count: Blob.ref_count - 1}, synchronize_session=False)
+    deleted = Blob.query.filter(Blob.hash == digest, Blob.ref_count <= 0).delete(synchronize_session=False)
+    return digest if deleted else None
+
+def _remove_orphan_blobs():
+    threshold = datetime.utcnow() - timedelta(seconds=ORPHAN_BLOB_TTL)
+    orphans = [blob.hash for blob in Blob.query.filter(Blob.ref_count == 0, Blob.uploaded_at < threshold)]
+    if not orphans:
+        return
+    Blob.query.filter(Blob.hash.in_(orphans), Blob.ref_count == 0).delete(synchronize_session=False)
+    db.session.commit()
+    for digest in orphans:
+        remove_blob_files(digest)
+
+# --- Загрузка аудио по частям с возобновлением ---
+# 1. POST /upload/audio/init {size}           -> upload_id
+# 2. PUT  /upload/audio/<upload_id>?offset=N  -> тело запроса - очередная часть файла
+#    GET  /upload/audio/<upload_id>           -> сколько байт уже сохранено (после обрыва связи)
+# 3. POST /upload/audio/<upload_id>/complete  -> file_path для отправки сообщения
+
+def _partial_upload_paths(upload_id):
+    return (os.path.join(PARTIAL_UPLOAD_FOLDER, f'{upload_id}.part'),
+            os.path.join(PARTIAL_UPLOAD_FOLDER, f'{upload_id}.json'))
+
+def _load_partial_upload(upload_id, user_id):
+    # upload_id - hex uuid, иначе это попытка выйти за пределы каталога
+    if len(upload_id) != 32 or not all(c in '0123456789abcdef' for c in upload_id):
+        return None
+    data_path, meta_path = _partial_upload_paths(upload_id)
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta['user_id'] != user_id:
+        return None
+    try:
+        meta['offset'] = os.path.getsize(data_path)
+    except OSError:
+        return None
+    return meta
+
+def _remove_stale_partial_uploads():
+    now = time.time()
+    for name in os.listdir(PARTIAL_UPLOAD_FOLDER):
+        path = os.path.join(PARTIAL_UPLOAD_FOLDER, name)
+        try:
+            if now - os.path.getmtime(path) > PARTIAL_UPLOAD_TTL:
+                os.remove(path)
+        except OSError:
+            pass
+
+@app.route('/upload/audio/init', methods=['POST'])
+@token_required
+def init_audio_upload(current_user):
+    data = request.get_json(silent=True) or {}
+    size = data.get('size')
+    if not isinstance(size, int) or size <= 0:
+        return jsonify({'message': 'Необходимо указать размер файла'}), 400
+    if size > MAX_AUDIO_UPLOAD_SIZE:
+        return jsonify({'message': 'Файл слишком большой'}), 413
+
+    _remove_stale_partial_uploads()
+    _remove_orphan_blobs()
+
+    upload_id = uuid.uuid4().hex
+    data_path, meta_path = _partial_upload_paths(upload_id)
+    open(data_path, 'wb').close()
+    with open(meta_path, 'w') as f:
+        json.dump({'user_id': current_user.id, 'size': size}, f)
+
+    return jsonify({'upload_id': upload_id, 'offset': 0, 'chunk_size': UPLOAD_CHUNK_SIZE}), 201
+
+@app.route('/upload/audio/<upload_id>', methods=['GET'])
+@token_required
+def get_audio_upload(current_user, upload_id):
+    upload = _load_partial_upload(upload_id, current_user.id)
+    if not upload:
+        return jsonify({'message': 'Загрузка не найдена'}), 404
+    return jsonify({'upload_id': upload_id, 'offset': upload['offset'], 'size': upload['size']}), 200
+
+@app.route('/upload/audio/<upload_id>', methods=['PUT'])
+@token_required
+def put_audio_upload_chunk(current_user, upload_id):
+    upload = _load_partial_upload(upload_id, current_user.id)
+    if not upload:
+        return jsonify({'message': 'Загрузка не найдена'}), 404
+
+    offset = request.args.get('offset', type=int)
+    if offset != upload['offset']:
+        # Клиент продолжает не с того места - сообщаем, сколько байт уже есть
+        return jsonify({'message': 'Неверное смещение', 'offset': upload['offset']}), 409
+
+    remaining = upload['size'] - offset
+    data_path, _ = _partial_upload_paths(upload_id)
+    written = 0
+    # Часть пишется на диск по мере чтения из сокета
+    with open(data_path, 'r+b') as f:
+        f.seek(offset)
+        while True:
+            block = request.stream.read(UPLOAD_STREAM_BUFFER)
+            if not block:
+                break
+            if written + len(block) > remaining:
+                f.truncate(offset + written)
+                return jsonify({'message': 'Данных больше, чем заявлено', 'offset': offset + written}), 413
+            f.write(block)
+            written += len(block)
+    upload_bytes_total.inc(written, method='chunked')
+
+    return jsonify({'upload_id': upload_id, 'offset': offset + written, 'size': upload['size']}), 200
+
+@app.route('/upload/audio/<upload_id>/complete', methods=['POST'])
+@token_required
+def complete_audio_upload(current_user, upload_id):
+    upload = _load_partial_upload(upload_id, current_user.id)
+    if not upload:
+        return jsonify({'message': 'Загрузка не найдена'}), 404
+    if upload['offset'] != upload['size']:
+        return jsonify({'message': 'Файл загружен не полностью', 'offset': upload['offset']}), 409
+
+    data_path, meta_path = _partial_upload_paths(upload_id)
+    # Описание загрузки удаляется, только когда файл уже в хранилище и записан в БД:
+    # при ошибке обе части остаются, и клиент может повторить /complete
+    try:
+        blob = store_audio_blob(data_path)
+    except Exception as e:
+        db.session.rollback()
+        print(f"Cannot store upload {upload_id}: {e}")
+        return jsonify({'message': 'Не удалось сохранить файл, повторите запрос'}), 503
+    os.remove(meta_path)
+
+    return jsonify(blob_upload_response(blob)), 201
 
 @app.route('/messages/delete/<int:message_id>', methods=['DELETE'])
 @token_required
 def delete_message(current_user, message_id):
+    flush_pending_messages()
     message = Message.query.get(message_id)
     if not message:
         return jsonify({'message': 'Сообщение не найдено'}), 404
@@ -310,22 +1501,46 @@ def delete_message(current_user, message_id):
     if message.sender_id != current_user.id:
         return jsonify({'message': 'Нет прав для удаления этого сообщения'}), 403
 
-    # Если сообщение было аудио, удаляем файл
+    # Файл аудио удаляется, только когда на него не ссылается ни одно сообщение
+    orphan_blob = None
+    legacy_audio_path = None
     if message.is_audio:
-        try:
-            # Path is like /uploads/filename.wav, we need filename.wav
-            filename = os.path.basename(message.content)
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            if os.path.exists(file_path):
-                os.remove(file_path)
-        except Exception as e:
-            print(f"Error deleting audio file: {e}") # Log error, but don't block message deletion
+        orphan_blob = release_blob_ref(message.content)
+        if not blob_hash_from_url(message.content):
+            # Path is like /uploads/filename.wav, we need filename.wav (and its compressed variant)
+            legacy_audio_path = os.path.join(app.config['UPLOAD_FOLDER'], os.path.basename(message.content))
 
+    chat = Chat.query.get(message.chat_id)
     db.session.delete(message)
+    db.session.flush()
+    # Поддерживаем денормализованные поля чата: последнее сообщение и непрочитанные
+    if chat.last_message_id == message_id:
+        chat.last_message_id = db.session.query(db.func.max(Message.id)).filter(Message.chat_id == chat.id).scalar()
+    ChatReadCursor.query.filter(
+        ChatReadCursor.chat_id == chat.id,
+        ChatReadCursor.user_id != message.sender_id,
+        ChatReadCursor.last_read_message_id < message_id,
+        ChatReadCursor.unread_count > 0
+    ).update({ChatReadCursor.unread_count: ChatReadCursor.unread_count - 1}, synchronize_session=False)
+    seq = next_chat_seq(chat.id)
+    store_chat_seq(chat.id, seq)
+    record_changes(chat_change_rows(chat.id, (chat.user1_id, chat.user2_id), CHANGE_MESSAGE_DELETED, message_id, seq))
     db.session.commit()
 
-    # Уведомляем клиентов в чате
-    socketio.emit('message_deleted', {'message_id': message_id}, to=message.chat_id)
+    try:
+        if orphan_blob:
+            remove_blob_files(orphan_blob)
+        elif legacy_audio_path:
+            for path in (legacy_audio_path, os.path.splitext(legacy_audio_path)[0] + TRANSCODED_AUDIO_EXT):
+                if os.path.exists(path):
+                    os.remove(path)
+    except Exception as e:
+        print(f"Error deleting audio file: {e}") # Log error, but don't block message deletion
+
+    # Уведомляем все устройства обоих участников чата
+    payload = {'message_id': message_id, 'chat_id': chat.id, 'seq': seq}
+    replay_ring.append(chat.id, seq, 'message_deleted', payload)
+    socketio.emit('message_deleted', payload, to=[user_room(chat.user1_id), user_room(chat.user2_id)])
 
     return jsonify({'message': 'Сообщение удалено'}), 200
 
@@ -337,272 +1552,391 @@ def get_agora_token(current_user):
     role = data.get('role', 1) # Default to publisher if not provided
     if not channel_name:
         return jsonify({'message': 'channelName is required'}), 400
+    if role not in (1, 2): # 1 - publisher, 2 - subscriber
+        return jsonify({'message': 'role must be 1 or 2'}), 400
 
     user_id = current_user.id
-    token = generate_agora_token(channel_name, user_id, role)
+    token = agora_tokens.get(channel_name, user_id, role)
     
     if token:
         return jsonify({'token': token})
     else:
         return jsonify({'message': 'Failed to generate Agora token'}), 500
 
+@app.route('/stats', methods=['GET'])
+def get_stats():
+    return jsonify({
+        'token_cache': token_cache.stats(),
+        'password_hasher': {'rejected': password_hasher.rejected},
+        'transcoding': transcoder.stats(),
+        'replay': replay_ring.stats(),
+        'agora_tokens': agora_tokens.stats(),
+        'calls': calls.stats(),
+        'rate_limits': socket_limiter.stats(),
+        'sql_profiling': {'enabled': SQL_PROFILING, 'slow_queries': sql_profiler.slow_queries},
+        'event_loop': loop_monitor.stats()
+    }), 200
+
+# Комнаты Socket.IO этого воркера, кроме личных комнат соединений (комната = sid)
+def socketio_room_count():
+    rooms = socketio.server.manager.rooms.get('/', {})
+    return sum(1 for room, members in rooms.items() if room is not None and room not in members)
+
+metrics.gauge('socketio_connected_sockets', 'Открытые соединения Socket.IO этого воркера',
+              lambda: len(socketio.server.eio.sockets))
+metrics.gauge('socketio_rooms', 'Комнаты Socket.IO этого воркера', socketio_room_count)
+metrics.gauge('online_users', 'Пользователи в сети', lambda: len(online_users))
+metrics.gauge('active_calls', 'Звонки в процессе (вызов или разговор)', lambda: len(calls.sessions))
+metrics.gauge('transcode_queue', 'Файлы в очереди на перекодирование', lambda: transcoder.pending())
+metrics.gauge('event_loop_lag_current_seconds', 'Текущая задержка цикла событий', loop_monitor.current_lag)
+metrics.callback_counter('event_loop_blocks_total', 'Сколько раз цикл событий был заблокирован дольше порога',
+                         lambda: loop_monitor.blocked)
+metrics.callback_counter('socketio_events_throttled_total', 'Socket-события, отклонённые ограничением частоты',
+                         lambda: dict(socket_limiter.throttled), label='event')
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+# Проверка готовности для балансировщика: цикл событий не перегружен и база отвечает
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    lag = loop_monitor.current_lag()
+    result = {'loop_lag': round(lag, 4), 'loop_blocks': loop_monitor.blocked, 'database': 'ok'}
+    healthy = lag <= HEALTHZ_MAX_LOOP_LAG
+    try:
+        db.session.execute(db.text('SELECT 1'))
+    except Exception as e:
+        print(f"Health check: database error: {e}")
+        db.session.rollback()
+        result['database'] = 'error'
+        healthy = False
+    result['status'] = 'ok' if healthy else 'unavailable'
+    return jsonify(result), 200 if healthy else 503
+
 # --- SocketIO Events ---
 
+# Декоратор для socket-событий: пользователь проверяется один раз при подключении
+# и хранится в сессии сокета, повторно токен не декодируется
+def socket_auth_required(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        current_user = session.get('user')
+        if not current_user:
+            return
+        return f(current_user, *args, **kwargs)
+
+    return decorated
+
+# Декоратор замера времени, ставится сразу под @socketio.on: в замер входят проверка
+# пользователя и ограничение частоты. Синонимы событий учитываются под основным именем.
+def timed_socket_event(event):
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            started = time.perf_counter()
+            start_sql_profile(f'socket {event}')
+            try:
+                return f(*args, **kwargs)
+            finally:
+                socket_event_duration.observe(time.perf_counter() - started, event=event)
+                finish_sql_profile(f'socket:{event}')
+        return decorated
+    return decorator
+
+socket_limiter = SocketRateLimiter(SOCKET_RATE_LIMITS, SOCKET_USER_RATE_LIMITS)
+
+def is_repeated_join(data):
+    # Соединение уже в комнате чата - повтор ничего не изменит. join в другой чат
+    # или после переподключения (новый sid) так отбрасывать нельзя: клиент останется без сообщений
+    return isinstance(data, dict) and data.get('room') in rooms()
+
+# Событие сверх лимита, для которого проверка вернула True, отбрасывается молча,
+# остальные - с rate_limited, чтобы клиент повторил их позже
+SOCKET_COALESCED_EVENTS = {'join': is_repeated_join}
+
+# Декоратор ограничения частоты, ставится после socket_auth_required.
+# Отклонённое событие не обрабатывается, клиент получает rate_limited с временем до повтора.
+def socket_rate_limit(event):
+    def decorator(f):
+        @wraps(f)
+        def decorated(current_user, *args, **kwargs):
+            retry_after = socket_limiter.check(event, request.sid, current_user.id)
+            if retry_after:
+                if event in SOCKET_COALESCED_EVENTS and SOCKET_COALESCED_EVENTS[event](*args):
+                    socket_limiter.note_coalesced(event)
+                else:
+                    emit('rate_limited', {'event': event, 'retry_after': round(retry_after, 2)})
+                return
+            return f(current_user, *args, **kwargs)
+        return decorated
+    return decorator
+
 @socketio.on('connect')
-def handle_connect():
+@timed_socket_event('connect')
+def handle_connect(auth=None):
     token = request.args.get('token')
     if not token:
         return False # Отклоняем соединение
-    try:
-        data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
-        user_id = data['user_id']
-        online_users[user_id] = request.sid
-        print(f"User {user_id} connected with sid {request.sid}")
-        # Уведомляем контакты, что пользователь в сети
-        # (Это можно будет добавить позже для полной реализации)
-    except Exception as e:
-        print(f"Socket auth error: {e}")
+    user = verify_token(token)
+    if not user:
+        print("Socket auth error: invalid token")
         return False
+    loop_monitor.start()
+    session['user'] = user
+    user_id = user.id
+    online_users.add(user_id, request.sid)
+    join_room(user_room(user_id))
+    print(f"User {user_id} connected with sid {request.sid}")
+    # Уведомляем контакты, что пользователь в сети
+    # (Это можно будет добавить позже для полной реализации)
 
 @socketio.on('disconnect')
-def handle_disconnect():
-    user_id_to_remove = None
-    for user_id, sid in online_users.items():
-        if sid == request.sid:
-            user_id_to_remove = user_id
-            break
-    if user_id_to_remove:
-        del online_users[user_id_to_remove]
-        print(f"User {user_id_to_remove} disconnected")
+@timed_socket_event('disconnect')
+def handle_disconnect(reason=None):
+    user_id, went_offline = online_users.remove(request.sid)
+    socket_limiter.forget_sid(request.sid)
+    if user_id is not None:
+        print(f"User {user_id} disconnected sid {request.sid}")
+        # Звонок на отключившемся устройстве завершается, собеседник получает call_hangup
+        call, other_user_id = calls.disconnect(user_id, request.sid, went_offline)
+        if call:
+            emit('call_hangup', {'callId': call['call_id'], 'otherUserId': user_id, 'reason': 'disconnected'},
+                 to=user_room(other_user_id))
+    if went_offline:
+        print(f"User {user_id} is offline")
         # Уведомляем контакты, что пользователь вышел из сети
         # (Это можно будет добавить позже)
 
 
 @socketio.on('join')
-def on_join(data):
-    # Здесь нужна проверка токена, но для простоты пока опустим
-    # В реальном приложении токен нужно передавать при подключении
-    username = data.get('username') # Предполагается, что клиент передает имя
+@timed_socket_event('join')
+@socket_auth_required
+@socket_rate_limit('join')
+def on_join(current_user, data):
     room = data.get('room') # room - это chat_id
+    chat = Chat.query.get(room)
+    if not chat or current_user.id not in [chat.user1_id, chat.user2_id]:
+        return
     join_room(room)
-    send(f'{username} присоединился к чату.', to=room)
+    # Клиент переподключился: досылаем события после last_seq только ему
+    last_seq = data.get('last_seq')
+    if isinstance(last_seq, int):
+        replay_missed_events(current_user.id, chat.id, last_seq)
+    send(f'{current_user.username} присоединился к чату.', to=room)
+
+def replay_missed_events(user_id, chat_id, last_seq):
+    current_seq = current_chat_seq(chat_id)
+    if last_seq >= current_seq:
+        return
+    events = replay_ring.since(chat_id, last_seq, current_seq)
+    if events is None:
+        events = load_missed_events(user_id, chat_id, last_seq, current_seq)
+    if events is None:
+        # Промежуток уже не восстановить (журнал обрезан) или он слишком длинный - клиент перезагружает историю чата
+        emit('resync', {'room': chat_id})
+        return
+    for event, payload in events:
+        emit(event, payload)
+
+def load_missed_events(user_id, chat_id, last_seq, current_seq):
+    if current_seq - last_seq > REPLAY_MAX_GAP:
+        return None
+    flush_pending_messages()
+    changes = ChangeLog.query.filter(ChangeLog.user_id == user_id, ChangeLog.chat_id == chat_id,
+                                     ChangeLog.seq > last_seq, ChangeLog.seq <= current_seq) \
+        .order_by(ChangeLog.seq).all()
+    if [change.seq for change in changes] != list(range(last_seq + 1, current_seq + 1)):
+        return None
+    message_ids = [change.message_id for change in changes if change.kind == CHANGE_MESSAGE]
+    messages = {}
+    if message_ids:
+        messages = {msg.id: serialize_message(msg, sender_username) for msg, sender_username in
+                    db.session.query(Message, User.username).join(User, User.id == Message.sender_id)
+                    .filter(Message.id.in_(message_ids))}
+    events = []
+    for change in changes:
+        if change.kind == CHANGE_MESSAGE and change.message_id in messages:
+            events.append(('message', messages[change.message_id]))
+        elif change.kind == CHANGE_MESSAGE_DELETED:
+            events.append(('message_deleted', {'message_id': change.message_id, 'chat_id': chat_id, 'seq': change.seq}))
+    return events
 
 @socketio.on('send_message')
-def handle_send_message(data):
-    token = data.get('token')
+@timed_socket_event('send_message')
+@socket_auth_required
+@socket_rate_limit('send_message')
+def handle_send_message(current_user, data):
     room = data.get('room')
     content = data.get('content')
     is_audio = data.get('is_audio', False)
+    sender_id = current_user.id
 
-    if not token:
-        # В реальном приложении здесь можно отправить ошибку клиенту
+    chat = Chat.query.get(room)
+    if not chat or sender_id not in [chat.user1_id, chat.user2_id]:
         return
 
-    try:
-        token_data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
-        sender_id = token_data['user_id']
-    except:
-        return # Ошибка токена
-
-    # Сохранение сообщения в БД
-    new_message = Message(chat_id=room, sender_id=sender_id, content=content, is_audio=is_audio)
-    db.session.add(new_message)
-    db.session.commit()
-
-    sender = User.query.get(sender_id)
-    message_to_send = {
-        'id': new_message.id,
-        'sender': sender.username,
-        'sender_id': sender_id,
-        'content': content,
-        'timestamp': new_message.timestamp.isoformat(),
-        'is_audio': is_audio
-    }
-    send(message_to_send, to=room)
+    # Аудио ссылается на загруженный файл: учитываем ссылку, чтобы удаление
+    # одного из сообщений (в том числе пересланного) не удалило файл у остальных
+    audio_duration, audio_waveform = None, None
+    if is_audio:
+        audio_duration, audio_waveform = add_blob_ref(content)
+        db.session.commit()
+
+    # Сохранение сообщения в БД вместе с денормализованными полями чата
+    seq = next_chat_seq(chat.id)
+    if MESSAGE_WRITE_BEHIND:
+        new_message = message_writer.enqueue(chat.id, sender_id, content, is_audio, audio_duration, audio_waveform, seq)
+    else:
+        new_message = persist_message(chat, sender_id, content, is_audio, audio_duration, audio_waveform, seq)
+
+    payload = serialize_message(new_message, current_user.username)
+    replay_ring.append(chat.id, seq, 'message', payload)
+    send(payload, to=room)
+
+# --- Звонки ---
+# Все события сигнализации проходят через CallManager (pc_app/calls.py).
+# Старые имена событий (call_user/answer_call/hang_up) - синонимы call_request/call_accepted/call_ended.
+# Клиенты присылают ключи в camelCase, ответы содержат оба варианта имён.
+calls = CallManager(
+    state.mapping('call_sessions'),
+    state.mapping('calls_by_user'),
+    state.lock('calls'),
+    notify=lambda user_id, event, payload: socketio.emit(event, payload, to=user_room(user_id)),
+    spawn_after=eventlet.spawn_after,
+    ring_timeout=CALL_RING_TIMEOUT,
+    max_duration=CALL_MAX_DURATION
+)
+
+def _call_arg(data, *names):
+    for name in names:
+        if data.get(name) is not None:
+            return data[name]
+    return None
 
 @socketio.on('call_user')
-def handle_call_user(data):
-    target_user_id = data.get('targetUserId')
-    channel_name = data.get('channelName')
-    token = data.get('token')
-
-    caller_id = None
-    for user_id, sid in online_users.items():
-        if sid == request.sid:
-            caller_id = user_id
-            break
-    
-    if not caller_id:
-        return
-
-    caller = User.query.get(caller_id)
-    if not caller:
-        return
-
-    target_sid = online_users.get(int(target_user_id))
-    if target_sid:
-        emit('incoming_call', {
-            'callerId': caller_id,
-            'callerUsername': caller.username,
-            'channelName': channel_name,
-            'token': token
-        }, to=target_sid)
-
-@socketio.on('answer_call')
-def handle_answer_call(data):
-    caller_id = data.get('callerId')
-    caller_sid = online_users.get(int(caller_id))
-    if caller_sid:
-        emit('call_answered', {}, to=caller_sid)
-
-@socketio.on('hang_up')
-def handle_hang_up(data):
-    other_user_id = data.get('otherUserId')
-    other_user_sid = online_users.get(int(other_user_id))
-    if other_user_sid:
-        emit('call_ended', {}, to=other_user_sid)
-
-# Call related SocketIO events
-active_calls = {} # {caller_id: {callee_id: sid, channel_name: channel, token: token}}
-
 @socketio.on('call_request')
-def handle_call_request(data):
-    token = data.get('token')
-    callee_id = data.get('callee_id')
-    channel_name = data.get('channelName')
-
-    if not token or not callee_id or not channel_name:
+@timed_socket_event('call_request')
+@socket_auth_required
+@socket_rate_limit('call_request')
+def handle_call_request(caller_user, data):
+    callee_id = _call_arg(data, 'targetUserId', 'callee_id')
+    channel_name = _call_arg(data, 'channelName', 'channel_name')
+
+    if not callee_id or not channel_name:
         emit('call_error', {'message': 'Missing call data'})
         return
-
     try:
-        token_data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
-        caller_id = token_data['user_id']
-    except:
-        emit('call_error', {'message': 'Invalid token'})
+        callee_id = int(callee_id)
+    except (TypeError, ValueError):
+        emit('call_error', {'message': 'Invalid callee id'})
         return
+    if not isinstance(channel_name, str):
+        emit('call_error', {'message': 'Invalid channel name'})
+        return
+    caller_id = caller_user.id
 
-    if callee_id in online_users:
-        callee_sid = online_users[callee_id]
-        caller_user = User.query.get(caller_id)
-        if caller_user:
-            # Generate Agora token for the caller
-            caller_agora_token = generate_agora_token(channel_name, caller_id)
-            if not caller_agora_token:
-                emit('call_error', {'message': 'Failed to generate Agora token for caller'})
-                return
-
-            # Generate Agora token for the callee
-            callee_agora_token = generate_agora_token(channel_name, callee_id)
-            if not callee_agora_token:
-                emit('call_error', {'message': 'Failed to generate Agora token for callee'})
-                return
-
-            active_calls[caller_id] = {
-                'callee_id': callee_id,
-                'channel_name': channel_name,
-                'caller_token': caller_agora_token,
-                'callee_token': callee_agora_token
-            }
-
-            emit('incoming_call', {
-                'caller_id': caller_id,
-                'caller_username': caller_user.username,
-                'channel_name': channel_name,
-                'token': callee_agora_token # Callee receives their token
-            }, to=callee_sid)
-            emit('call_initiated', {
-                'callee_id': callee_id,
-                'channel_name': channel_name,
-                'token': caller_agora_token # Caller receives their token
-            })
-        else:
-            emit('call_error', {'message': 'Caller user not found'})
-    else:
+    if not online_users.is_online(callee_id):
         emit('call_error', {'message': 'Callee is offline'})
+        return
 
-@socketio.on('call_accepted')
-def handle_call_accepted(data):
-    token = data.get('token')
-    caller_id = data.get('caller_id')
-    channel_name = data.get('channelName')
-
-    if not token or not caller_id or not channel_name:
-        emit('call_error', {'message': 'Missing call data'})
+    caller_agora_token = agora_tokens.get(channel_name, caller_id)
+    callee_agora_token = agora_tokens.get(channel_name, callee_id)
+    if not caller_agora_token or not callee_agora_token:
+        emit('call_error', {'message': 'Failed to generate Agora token'})
         return
 
+    callee = User.query.get(callee_id)
     try:
-        token_data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
-        callee_id = token_data['user_id']
-    except:
-        emit('call_error', {'message': 'Invalid token'})
+        call = calls.start(caller_id, request.sid, callee_id, channel_name,
+                           caller_username=caller_user.username,
+                           callee_username=callee.username if callee else None,
+                           caller_token=caller_agora_token, callee_token=callee_agora_token)
+    except CallError as e:
+        emit('call_error', {'message': str(e)})
         return
 
-    if caller_id in active_calls and active_calls[caller_id]['callee_id'] == callee_id:
-        caller_sid = online_users.get(caller_id)
-        if caller_sid:
-            emit('call_answered', {
-                'callee_id': callee_id,
-                'channel_name': channel_name
-            }, to=caller_sid)
-    else:
-        emit('call_error', {'message': 'No active call from this caller'})
-
-@socketio.on('call_declined')
-def handle_call_declined(data):
-    token = data.get('token')
-    caller_id = data.get('caller_id')
+    emit('incoming_call', {
+        'callId': call['call_id'],
+        'callerId': caller_id,
+        'callerUsername': caller_user.username,
+        'channelName': channel_name,
+        'token': callee_agora_token, # Callee receives their token
+        'caller_id': caller_id,
+        'caller_username': caller_user.username,
+        'channel_name': channel_name
+    }, to=user_room(callee_id))
+    emit('call_initiated', {
+        'callId': call['call_id'],
+        'targetUserId': callee_id,
+        'targetUsername': call['callee_username'],
+        'otherUserId': callee_id,
+        'channelName': channel_name,
+        'token': caller_agora_token, # Caller receives their token
+        'callee_id': callee_id,
+        'channel_name': channel_name
+    })
 
-    if not token or not caller_id:
-        emit('call_error', {'message': 'Missing call data'})
+@socketio.on('answer_call')
+@socketio.on('call_accepted')
+@timed_socket_event('call_accepted')
+@socket_auth_required
+@socket_rate_limit('call_accepted')
+def handle_call_accepted(current_user, data):
+    try:
+        call = calls.accept(current_user.id, request.sid)
+    except CallError as e:
+        emit('call_error', {'message': str(e)})
         return
 
+    emit('call_answered', {
+        'callId': call['call_id'],
+        'otherUserId': current_user.id,
+        'channelName': call['channel_name'],
+        'token': call['caller_token'],
+        'callee_id': current_user.id,
+        'channel_name': call['channel_name']
+    }, to=user_room(call['caller_id']))
+    # incoming_call приходил на все устройства вызываемого - убираем его на остальных
+    emit('call_hangup', {'callId': call['call_id'], 'reason': 'answered_elsewhere'},
+         to=user_room(current_user.id), include_self=False)
+
+@socketio.on('call_declined')
+@timed_socket_event('call_declined')
+@socket_auth_required
+@socket_rate_limit('call_declined')
+def handle_call_declined(current_user, data):
     try:
-        token_data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
-        callee_id = token_data['user_id']
-    except:
-        emit('call_error', {'message': 'Invalid token'})
+        call = calls.decline(current_user.id)
+    except CallError as e:
+        emit('call_error', {'message': str(e)})
         return
 
-    if caller_id in active_calls and active_calls[caller_id]['callee_id'] == callee_id:
-        caller_sid = online_users.get(caller_id)
-        if caller_sid:
-            emit('call_rejected', {'callee_id': callee_id}, to=caller_sid)
-        del active_calls[caller_id]
-    else:
-        emit('call_error', {'message': 'No active call from this caller'})
+    emit('call_rejected', {
+        'callId': call['call_id'],
+        'rejectorUsername': current_user.username,
+        'callee_id': current_user.id
+    }, to=user_room(call['caller_id']))
+    emit('call_hangup', {'callId': call['call_id'], 'reason': 'declined'},
+         to=user_room(current_user.id), include_self=False)
 
+@socketio.on('hang_up')
 @socketio.on('call_ended')
-def handle_call_ended(data):
-    token = data.get('token')
-    other_user_id = data.get('other_user_id') # The ID of the person you were calling or who called you
-
-    if not token or not other_user_id:
-        emit('call_error', {'message': 'Missing call data'})
-        return
-
+@timed_socket_event('call_ended')
+@socket_auth_required
+@socket_rate_limit('call_ended')
+def handle_call_ended(current_user, data):
     try:
-        token_data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
-        current_user_id = token_data['user_id']
-    except:
-        emit('call_error', {'message': 'Invalid token'})
+        call, other_user_id = calls.end(current_user.id)
+    except CallError:
+        # Звонок уже завершён другой стороной или по таймауту
         return
 
-    # Determine if current user was the caller or callee in the active_calls dict
-    if current_user_id in active_calls and active_calls[current_user_id]['callee_id'] == other_user_id:
-        # Current user was the caller
-        callee_sid = online_users.get(other_user_id)
-        if callee_sid:
-            emit('call_hangup', {'caller_id': current_user_id}, to=callee_sid)
-        del active_calls[current_user_id]
-    elif other_user_id in active_calls and active_calls[other_user_id]['callee_id'] == current_user_id:
-        # Current user was the callee, and the other_user_id was the caller
-        caller_sid = online_users.get(other_user_id)
-        if caller_sid:
-            emit('call_hangup', {'callee_id': current_user_id}, to=caller_sid)
-        del active_calls[other_user_id]
-    else:
-        emit('call_error', {'message': 'No active call with this user'})
+    emit('call_hangup', {
+        'callId': call['call_id'],
+        'otherUserId': current_user.id,
+        'reason': 'hangup'
+    }, to=user_room(other_user_id))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,42 @@
+# Профилирование SQL: время каждого запроса через события Engine SQLAlchemy.
+# Число запросов и время в БД копятся в словаре текущего REST-запроса или socket-события
+# (его возвращает current_stats), медленные запросы печатаются вместе с маршрутом.
+import time
+
+from sqlalchemy import event as sa_event
+
+
+class QueryProfiler:
+    def __init__(self, slow_threshold, current_stats, describe):
+        self.slow_threshold = slow_threshold # секунды
+        self.current_stats = current_stats # () -> {'count', 'time'} или None вне запроса
+        self.describe = describe # () -> маршрут или имя события для лога
+        self.slow_queries = 0
+
+    def install(self, target):
+        sa_event.listen(target, 'before_cursor_execute', self._before_execute)
+        sa_event.listen(target, 'after_cursor_execute', self._after_execute)
+        sa_event.listen(target, 'handle_error', self._on_error)
+
+    @staticmethod
+    def new_stats():
+        return {'count': 0, 'time': 0.0}
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        # Стек, а не одно значение: на одном соединении запросы могут быть вложенными
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_started'].pop()
+        stats = self.current_stats()
+        if stats is not None:
+            stats['count'] += 1
+            stats['time'] += elapsed
+        if elapsed >= self.slow_threshold:
+            self.slow_queries += 1
+            print(f"Slow query {elapsed * 1000:.1f} ms [{self.describe()}]: {' '.join(statement.split())}")
+
+    def _on_error(self, exception_context):
+        started = exception_context.connection.info.get('query_started') if exception_context.connection else None
+        if started:
+            started.pop()
@@ -0,0 +1,315 @@
+# Общее состояние сервера (присутствие, активные звонки), которое должно быть видно всем воркерам.
+#
+# STATE_BACKEND_URL:
+#   не задан       - состояние в памяти процесса (один воркер, как раньше)
+#   redis://...    - состояние в Redis, можно запускать несколько воркеров/узлов
+#   fakeredis://   - Redis-совместимая заглушка в памяти, для тестов и локальной отладки.
+#                    Нужен пакет fakeredis[lua]: без lupa Lua-скрипты присутствия не выполняются
+import json
+import threading
+
+
+# Блокировку не удалось получить за отведённое время (её держит другой воркер)
+class LockTimeout(Exception):
+    pass
+
+
+# --- Состояние в памяти процесса ---
+
+# Реестр присутствия: у пользователя может быть несколько устройств (sid) одновременно.
+# Оба индекса (user -> sids и sid -> user) дают поиск за O(1).
+class PresenceRegistry:
+    def __init__(self):
+        self._sids_by_user = {} # {user_id: set(sid)}
+        self._user_by_sid = {} # {sid: user_id}
+        self._lock = threading.Lock()
+
+    def add(self, user_id, sid):
+        # Возвращает True, если это первое устройство пользователя
+        with self._lock:
+            sids = self._sids_by_user.setdefault(user_id, set())
+            sids.add(sid)
+            self._user_by_sid[sid] = user_id
+            return len(sids) == 1
+
+    def remove(self, sid):
+        # Возвращает (user_id, True если у пользователя не осталось устройств)
+        with self._lock:
+            user_id = self._user_by_sid.pop(sid, None)
+            if user_id is None:
+                return None, False
+            sids = self._sids_by_user.get(user_id, set())
+            sids.discard(sid)
+            if not sids:
+                self._sids_by_user.pop(user_id, None)
+                return user_id, True
+            return user_id, False
+
+    def user_for_sid(self, sid):
+        return self._user_by_sid.get(sid)
+
+    def sids(self, user_id):
+        return set(self._sids_by_user.get(user_id, ()))
+
+    def is_online(self, user_id):
+        return user_id in self._sids_by_user
+
+    def online_user_ids(self):
+        return list(self._sids_by_user.keys())
+
+    def connection_count(self):
+        return len(self._user_by_sid)
+
+    def __len__(self):
+        return len(self._sids_by_user)
+
+
+# Монотонный счётчик. seed() вызывается один раз, чтобы продолжить нумерацию с текущего значения в БД.
+class Counter:
+    def __init__(self):
+        self._value = None
+        self._lock = threading.Lock()
+
+    def next(self, seed):
+        with self._lock:
+            if self._value is None:
+                self._value = seed()
+            self._value += 1
+            return self._value
+
+    def current(self, seed):
+        with self._lock:
+            if self._value is None:
+                self._value = seed()
+            return self._value
+
+    def advance_to(self, value):
+        # Не даёт счётчику отставать от значения, выданного в обход него
+        with self._lock:
+            if self._value is None or self._value < value:
+                self._value = value
+            return self._value
+
+
+class InMemoryStateBackend:
+    def __init__(self):
+        self._counters = {}
+        self._locks = {}
+
+    def presence(self):
+        return PresenceRegistry()
+
+    def mapping(self, name):
+        return {}
+
+    def counter(self, name):
+        return self._counters.setdefault(name, Counter())
+
+    def lock(self, name, timeout=10, blocking_timeout=5):
+        # Один процесс - хватает обычной блокировки
+        return self._locks.setdefault(name, threading.Lock())
+
+
+# --- Состояние в Redis ---
+
+# Добавление и удаление устройства выполняются атомарно скриптами,
+# иначе параллельные подключения могут неверно посчитать "последнее устройство"
+_PRESENCE_ADD = """
+local sids_key = ARGV[3] .. 'sids:' .. ARGV[2]
+redis.call('SET', ARGV[3] .. 'sid:' .. ARGV[1], ARGV[2])
+redis.call('SADD', sids_key, ARGV[1])
+redis.call('SADD', ARGV[3] .. 'online', ARGV[2])
+return redis.call('SCARD', sids_key)
+"""
+
+_PRESENCE_REMOVE = """
+local sid_key = ARGV[2] .. 'sid:' .. ARGV[1]
+local user_id = redis.call('GET', sid_key)
+if not user_id then
+    return false
+end
+redis.call('DEL', sid_key)
+local sids_key = ARGV[2] .. 'sids:' .. user_id
+redis.call('SREM', sids_key, ARGV[1])
+if redis.call('SCARD', sids_key) == 0 then
+    redis.call('SREM', ARGV[2] .. 'online', user_id)
+    return {user_id, 1}
+end
+return {user_id, 0}
+"""
+
+
+_COUNTER_ADVANCE = """
+local current = tonumber(redis.call('GET', KEYS[1]))
+local value = tonumber(ARGV[1])
+if not current or current < value then
+    redis.call('SET', KEYS[1], value)
+    return value
+end
+return current
+"""
+
+
+# Тот же интерфейс, что у PresenceRegistry, но данные общие для всех воркеров.
+# Если узел упал, не отключив свои sid, они останутся в Redis до удаления вручную.
+class RedisPresenceRegistry:
+    def __init__(self, client, prefix='presence:'):
+        self.client = client
+        self.prefix = prefix
+        self._add = client.register_script(_PRESENCE_ADD)
+        self._remove = client.register_script(_PRESENCE_REMOVE)
+
+    def add(self, user_id, sid):
+        return self._add(args=[sid, user_id, self.prefix]) == 1
+
+    def remove(self, sid):
+        result = self._remove(args=[sid, self.prefix])
+        if not result:
+            return None, False
+        user_id, went_offline = result
+        return int(user_id), went_offline == 1
+
+    def user_for_sid(self, sid):
+        user_id = self.client.get(f'{self.prefix}sid:{sid}')
+        return int(user_id) if user_id is not None else None
+
+    def sids(self, user_id):
+        return {sid.decode() for sid in self.client.smembers(f'{self.prefix}sids:{user_id}')}
+
+    def is_online(self, user_id):
+        return bool(self.client.sismember(f'{self.prefix}online', user_id))
+
+    def online_user_ids(self):
+        return [int(user_id) for user_id in self.client.smembers(f'{self.prefix}online')]
+
+    def connection_count(self):
+        return sum(1 for _ in self.client.scan_iter(match=f'{self.prefix}sid:*'))
+
+    def __len__(self):
+        return self.client.scard(f'{self.prefix}online')
+
+
+# Словарь поверх хеша Redis: ключи и значения хранятся в JSON.
+# Значения копируются при чтении, поэтому изменять их нужно присваиванием целиком.
+class RedisDict:
+    def __init__(self, client, name):
+        self.client = client
+        self.key = f'state:{name}'
+
+    def __getitem__(self, key):
+        value = self.client.hget(self.key, json.dumps(key))
+        if value is None:
+            raise KeyError(key)
+        return json.loads(value)
+
+    def __setitem__(self, key, value):
+        self.client.hset(self.key, json.dumps(key), json.dumps(value))
+
+    def __delitem__(self, key):
+        if not self.client.hdel(self.key, json.dumps(key)):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return bool(self.client.hexists(self.key, json.dumps(key)))
+
+    def __iter__(self):
+        return (json.loads(field) for field in self.client.hkeys(self.key))
+
+    def __len__(self):
+        return self.client.hlen(self.key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, *default):
+        field = json.dumps(key)
+        with self.client.pipeline() as pipe:
+            pipe.hget(self.key, field)
+            pipe.hdel(self.key, field)
+            value, _ = pipe.execute()
+        if value is None:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        return json.loads(value)
+
+    def items(self):
+        return [(json.loads(field), json.loads(value)) for field, value in self.client.hgetall(self.key).items()]
+
+    def values(self):
+        return [json.loads(value) for value in self.client.hvals(self.key)]
+
+
+# Общий для всех воркеров счётчик на INCR. Начальное значение выставляется через SET NX,
+# поэтому при одновременной инициализации побеждает только один воркер.
+class RedisCounter:
+    def __init__(self, client, name):
+        self.client = client
+        self.key = f'counter:{name}'
+        self._advance = client.register_script(_COUNTER_ADVANCE)
+
+    def next(self, seed):
+        if not self.client.exists(self.key):
+            self.client.set(self.key, seed(), nx=True)
+        return self.client.incr(self.key)
+
+    def current(self, seed):
+        if not self.client.exists(self.key):
+            self.client.set(self.key, seed(), nx=True)
+        return int(self.client.get(self.key))
+
+    def advance_to(self, value):
+        # Ключ переживает перезапуск сервера, а БД могла уйти вперёд без счётчика
+        return int(self._advance(keys=[self.key], args=[value]))
+
+
+# Блокировка, общая для всех воркеров: ключ с уникальным токеном (SET NX PX), снимает её только владелец.
+# timeout - через сколько секунд ключ исчезнет, если воркер упал, не сняв блокировку;
+# поэтому под ней выполняются только короткие операции с состоянием.
+class RedisLock:
+    def __init__(self, client, name, timeout, blocking_timeout):
+        self.name = name
+        self._lock = client.lock(f'lock:{name}', timeout=timeout, blocking_timeout=blocking_timeout)
+
+    def __enter__(self):
+        if not self._lock.acquire():
+            raise LockTimeout(self.name)
+        return self
+
+    def __exit__(self, *exc_info):
+        from redis.exceptions import LockError
+        try:
+            self._lock.release()
+        except LockError:
+            # Ключ истёк по timeout, пока блокировка была занята
+            print(f"State lock {self.name} expired before release")
+
+
+class RedisStateBackend:
+    def __init__(self, client):
+        self.client = client
+
+    def presence(self):
+        return RedisPresenceRegistry(self.client)
+
+    def mapping(self, name):
+        return RedisDict(self.client, name)
+
+    def counter(self, name):
+        return RedisCounter(self.client, name)
+
+    def lock(self, name, timeout=10, blocking_timeout=5):
+        return RedisLock(self.client, name, timeout, blocking_timeout)
+
+
+def create_state_backend(url=None):
+    if not url:
+        return InMemoryStateBackend()
+    if url.startswith('fakeredis://'):
+        import fakeredis
+        return RedisStateBackend(fakeredis.FakeRedis())
+    import redis
+    return RedisStateBackend(redis.Redis.from_url(url))
@@ -0,0 +1,72 @@
+# Общие фикстуры: сервер импортируется один раз на временной SQLite, схема создаётся миграциями,
+# как при деплое. Общее состояние - fakeredis (нужен пакет fakeredis[lua], см. tests/requirements.txt),
+# чтобы тесты проходили через те же Lua-скрипты, что и с настоящим Redis.
+import itertools
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+import jwt
+import pytest
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'test.db')
+os.environ['STATE_BACKEND_URL'] = 'fakeredis://'
+os.environ.pop('SOCKETIO_MESSAGE_QUEUE', None)
+# Токены Agora генерируются локально, подойдут любые значения нужного формата
+os.environ['AGORA_APP_ID'] = '0' * 32
+os.environ['AGORA_APP_CERTIFICATE'] = '1' * 32
+
+
+@pytest.fixture(scope='session')
+def server():
+    from flask_migrate import upgrade
+    from pc_app import server
+
+    # Загруженные файлы - во временные каталоги, а не в pc_app/uploads
+    server.app.config['UPLOAD_FOLDER'] = tempfile.mkdtemp()
+    server.PARTIAL_UPLOAD_FOLDER = tempfile.mkdtemp()
+    with server.app.app_context():
+        upgrade(directory=os.path.join(ROOT, 'migrations'))
+    return server
+
+
+@pytest.fixture
+def app_context(server):
+    with server.app.app_context():
+        yield
+
+
+user_numbers = itertools.count()
+
+
+@pytest.fixture
+def create_user(server, app_context):
+    # Возвращает (id пользователя, токен для x-access-token / ?token=).
+    # База общая для всех тестов, поэтому к имени добавляется номер.
+    def create(username):
+        username = f'{username}_{next(user_numbers)}'
+        user = server.User(username=username, username_lower=username.lower(), password='x')
+        server.db.session.add(user)
+        server.db.session.commit()
+        token = jwt.encode({'user_id': user.id, 'exp': datetime.utcnow() + timedelta(hours=1)},
+                           server.app.config['SECRET_KEY'], algorithm='HS256')
+        return user.id, token
+    return create
+
+
+@pytest.fixture
+def create_chat(server, app_context):
+    def create(user_id, other_id):
+        user1_id, user2_id = server.chat_pair(user_id, other_id)
+        chat = server.Chat(user1_id=user1_id, user2_id=user2_id)
+        server.db.session.add(chat)
+        server.db.session.flush()
+        server.db.session.add_all([server.ChatReadCursor(chat_id=chat.id, user_id=user_id),
+                                   server.ChatReadCursor(chat_id=chat.id, user_id=other_id)])
+        server.db.session.commit()
+        return chat.id
+    return create
@@ -0,0 +1,53 @@
+# Анализ загруженного WAV: обрезанный файл (данные кончаются посреди кадра) не ломает загрузку.
+import io
+import struct
+import wave
+
+import pytest
+
+
+def wav_bytes(frames, channels=1, width=2, rate=8000):
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(width)
+        wav.setframerate(rate)
+        wav.writeframes(struct.pack(f'<{frames * channels}h', *([1000, -2000] * frames)[:frames * channels]))
+    return buffer.getvalue()
+
+
+def truncated_wav(frames, cut):
+    # Заголовок обещает frames кадров, а данных на cut байт меньше
+    return wav_bytes(frames)[:-cut]
+
+
+def test_analyze_truncated_wav(server, tmp_path):
+    path = tmp_path / 'cut.wav'
+    path.write_bytes(truncated_wav(100, 3))
+
+    duration, peaks = server.analyze_wav(str(path))
+    assert duration == pytest.approx(98 / 8000)
+    assert len(peaks) == 64 and max(peaks) == 255
+
+
+def test_upload_truncated_wav(server, create_user):
+    _, token = create_user('audio_user')
+    response = server.app.test_client().post(
+        '/upload/audio', headers={'x-access-token': token},
+        data={'file': (io.BytesIO(truncated_wav(101, 1)), 'voice.wav')})
+
+    assert response.status_code == 201
+    assert response.get_json()['waveform']
+
+
+def test_upload_unreadable_wav_is_stored_without_metadata(server, create_user, monkeypatch):
+    def broken(path):
+        raise ValueError('buffer size must be a multiple of element size')
+    monkeypatch.setattr(server, 'analyze_wav', broken)
+    _, token = create_user('audio_user')
+    response = server.app.test_client().post(
+        '/upload/audio', headers={'x-access-token': token},
+        data={'file': (io.BytesIO(b'RIFF-not-really-audio'), 'voice.wav')})
+
+    assert response.status_code == 201
+    assert response.get_json()['duration'] is None
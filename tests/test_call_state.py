@@ -0,0 +1,87 @@
+# Сессии звонков в общем состоянии: воркеры меняют их под общей блокировкой,
+# зависшие сессии удаляются по возрасту, даже если на них не указывает индекс by_user.
+import time
+import uuid
+
+import eventlet
+import pytest
+
+from pc_app.calls import ACTIVE, CallError, CallManager
+
+
+# Обёртка над общим словарём: при первом чтении сессии передаёт управление другому "воркеру"
+class PausingMapping:
+    def __init__(self, inner):
+        self.inner = inner
+        self.pause = None
+
+    def get(self, key, default=None):
+        value = self.inner.get(key, default)
+        if self.pause:
+            pause, self.pause = self.pause, None
+            pause()
+        return value
+
+    def __setitem__(self, key, value):
+        self.inner[key] = value
+
+    def __len__(self):
+        return len(self.inner)
+
+    def pop(self, key, *default):
+        return self.inner.pop(key, *default)
+
+    def items(self):
+        return self.inner.items()
+
+
+@pytest.fixture
+def shared(server):
+    # Отдельные имена ключей, чтобы не мешать звонкам самого сервера
+    name = uuid.uuid4().hex
+    return server.state, server.state.mapping(f'{name}_sessions'), server.state.mapping(f'{name}_by_user'), name
+
+
+def worker(shared, sessions=None, blocking_timeout=5):
+    state, shared_sessions, by_user, name = shared
+    return CallManager(sessions if sessions is not None else shared_sessions, by_user,
+                       state.lock(name, blocking_timeout=blocking_timeout),
+                       notify=lambda *args: None, spawn_after=lambda *args: None,
+                       ring_timeout=45, max_duration=3600)
+
+
+def test_ring_timeout_waits_for_accept_on_other_worker(shared):
+    _, sessions, by_user, _ = shared
+    worker_a = worker(shared, PausingMapping(sessions))
+    worker_b = worker(shared)
+    call_id = worker_a.start(1, 'caller-sid', 2, 'channel')['call_id']
+
+    # Пока воркер A принимает звонок, на воркере B срабатывает таймер вызова
+    timers = []
+    def ring_timeout_elsewhere():
+        timers.append(eventlet.spawn(worker_b._ring_timeout, call_id))
+        eventlet.sleep(0.3)
+    worker_a.sessions.pause = ring_timeout_elsewhere
+    worker_a.accept(2, 'callee-sid')
+    timers[0].wait()
+
+    assert sessions[call_id]['state'] == ACTIVE
+    assert by_user.get(2) == call_id
+
+
+def test_busy_worker_lock(shared):
+    state, _, _, name = shared
+    with state.lock(name):
+        with pytest.raises(CallError):
+            worker(shared, blocking_timeout=0.2).start(1, 'caller-sid', 2, 'channel')
+
+
+def test_sweep_removes_unindexed_sessions(shared):
+    _, sessions, by_user, _ = shared
+    sessions['orphan'] = {'call_id': 'orphan', 'caller_id': 10, 'callee_id': 11, 'state': ACTIVE,
+                          'created_at': time.time() - 7200}
+    sessions['stuck'] = {'call_id': 'stuck', 'caller_id': 12, 'callee_id': 13, 'state': 'ringing',
+                         'created_at': time.time() - 600}
+
+    call_id = worker(shared).start(1, 'caller-sid', 2, 'channel')['call_id']
+    assert sorted(sessions) == [call_id]
@@ -0,0 +1,39 @@
+# Сигнализация звонков при нескольких устройствах вызываемого: incoming_call приходит на все,
+# после ответа или отказа на одном остальные получают call_hangup.
+import pytest
+
+from test_shared_state import connect, events
+
+
+@pytest.fixture
+def call_setup(server, create_user):
+    caller_id, caller_token = create_user('caller')
+    callee_id, callee_token = create_user('callee')
+    caller = connect(server, caller_token)
+    callee_phone = connect(server, callee_token)
+    callee_desktop = connect(server, callee_token)
+    caller.emit('call_request', {'targetUserId': callee_id, 'channelName': f'channel_{caller_id}'})
+    assert events(callee_phone, 'incoming_call')
+    assert events(callee_desktop, 'incoming_call')
+    yield caller, callee_phone, callee_desktop
+    for client in (caller, callee_phone, callee_desktop):
+        client.disconnect()
+
+
+@pytest.mark.parametrize('event, reason', [('call_accepted', 'answered_elsewhere'), ('call_declined', 'declined')])
+def test_other_callee_devices_stop_ringing(call_setup, event, reason):
+    caller, callee_phone, callee_desktop = call_setup
+    callee_phone.emit(event, {})
+
+    assert [data['reason'] for data in events(callee_desktop, 'call_hangup')] == [reason]
+    assert not events(callee_phone, 'call_hangup')
+
+
+@pytest.mark.parametrize('target', ['abc', ['1'], {'id': 1}])
+def test_invalid_callee_id_is_rejected(server, create_user, target):
+    _, token = create_user('bad_caller')
+    caller = connect(server, token)
+    caller.emit('call_request', {'targetUserId': target, 'channelName': 'channel'})
+
+    assert [data['message'] for data in events(caller, 'call_error')] == ['Invalid callee id']
+    caller.disconnect()
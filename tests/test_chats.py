@@ -0,0 +1,55 @@
+# Чаты: contact_id при создании может прийти строкой, message_id при прочтении - только целое;
+# некорректные значения - 400, а не 500.
+import pytest
+
+
+@pytest.fixture
+def users_with_contact(server, create_user, app_context):
+    alice_id, alice_token = create_user('chat_alice')
+    bob_id, _ = create_user('chat_bob')
+    server.db.session.add(server.Contact(user_id=alice_id, contact_id=bob_id))
+    server.db.session.commit()
+    return bob_id, {'x-access-token': alice_token}
+
+
+def test_contact_id_as_string(server, users_with_contact):
+    bob_id, headers = users_with_contact
+    client = server.app.test_client()
+
+    created = client.post('/chats/create', json={'contact_id': str(bob_id)}, headers=headers)
+    assert created.status_code == 201
+    again = client.post('/chats/create', json={'contact_id': bob_id}, headers=headers)
+    assert again.status_code == 200
+    assert again.get_json()['chat_id'] == created.get_json()['chat_id']
+
+
+@pytest.mark.parametrize('body', [{}, {'contact_id': 'abc'}, {'contact_id': [1]}, None])
+def test_invalid_contact_id(server, users_with_contact, body):
+    _, headers = users_with_contact
+    response = server.app.test_client().post('/chats/create', json=body, headers=headers)
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize('message_id', ['x', '5', 1.5, [1]])
+def test_read_with_invalid_message_id(server, create_user, create_chat, message_id):
+    alice_id, alice_token = create_user('read_alice')
+    bob_id, _ = create_user('read_bob')
+    chat_id = create_chat(alice_id, bob_id)
+    response = server.app.test_client().post(f'/chats/{chat_id}/read', json={'message_id': message_id},
+                                              headers={'x-access-token': alice_token})
+    assert response.status_code == 400
+
+
+def test_read_cursor_is_clamped_to_last_message(server, create_user, create_chat):
+    alice_id, alice_token = create_user('read_alice')
+    bob_id, _ = create_user('read_bob')
+    chat_id = create_chat(alice_id, bob_id)
+    chat = server.Chat.query.get(chat_id)
+    last = server.persist_message(chat, bob_id, 'hello', False)
+
+    response = server.app.test_client().post(f'/chats/{chat_id}/read', json={'message_id': last.id + 1000},
+                                              headers={'x-access-token': alice_token})
+    assert response.status_code == 200
+    cursor = server.db.session.get(server.ChatReadCursor, (chat_id, alice_id))
+    server.db.session.refresh(cursor)
+    assert cursor.last_read_message_id == last.id
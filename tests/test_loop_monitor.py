@@ -0,0 +1,27 @@
+# Блокировка цикла событий: стек пишется в лог, но не попадает в /stats.
+import time
+
+import eventlet
+from eventlet import patcher
+
+from pc_app.loopmonitor import LoopLagMonitor
+
+real_sleep = patcher.original('time').sleep
+
+
+def block_loop(seconds):
+    real_sleep(seconds)
+
+
+def test_block_is_logged_but_stack_not_exposed(capsys):
+    monitor = LoopLagMonitor(interval=0.01, block_threshold=0.1)
+    monitor.start()
+    eventlet.sleep(0.05)
+    block_loop(0.4)
+    eventlet.sleep(0.05)
+
+    assert monitor.blocked == 1
+    assert 'block_loop' in capsys.readouterr().out
+    stats = monitor.stats()
+    assert set(stats['last_block']) == {'at', 'stalled'}
+    assert stats['last_block']['at'] <= time.time()
@@ -0,0 +1,54 @@
+# История чата загружается фиксированным числом SQL-запросов, независимо от числа сообщений
+# (имя отправителя приходит тем же запросом через JOIN, без запроса на каждое сообщение).
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+@contextmanager
+def count_queries():
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(Engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def seed_messages(server, chat_id, sender_ids, count):
+    server.db.session.add_all([
+        server.Message(chat_id=chat_id, sender_id=sender_ids[i % len(sender_ids)], content=f'message {i}')
+        for i in range(count)
+    ])
+    server.db.session.commit()
+
+
+def test_history_query_count_does_not_depend_on_length(server, create_user, create_chat):
+    alice_id, alice_token = create_user('history_alice')
+    bob_id, _ = create_user('history_bob')
+    carol_id, _ = create_user('history_carol')
+    short_chat = create_chat(alice_id, bob_id)
+    long_chat = create_chat(alice_id, carol_id)
+    seed_messages(server, short_chat, (alice_id, bob_id), 5)
+    seed_messages(server, long_chat, (alice_id, carol_id), 500)
+
+    client = server.app.test_client()
+    headers = {'x-access-token': alice_token}
+    # Первый запрос кладёт пользователя в кэш токенов, дальше токен не обращается к базе
+    assert client.get('/chats', headers=headers).status_code == 200
+
+    counts = {}
+    for chat_id, expected in ((short_chat, 5), (long_chat, server.MESSAGES_PAGE_MAX)):
+        with count_queries() as statements:
+            response = client.get(f'/chats/{chat_id}/messages', query_string={'limit': server.MESSAGES_PAGE_MAX},
+                                  headers=headers)
+        assert response.status_code == 200
+        assert len(response.get_json()['messages']) == expected
+        counts[chat_id] = len(statements)
+
+    assert counts[short_chat] == counts[long_chat]
@@ -0,0 +1,61 @@
+# Метрики /metrics: каждое socket-событие учитывается в гистограмме задержки ровно один раз,
+# REST-запрос - в том числе завершившийся необработанным исключением.
+import pytest
+
+from test_shared_state import connect
+
+
+def event_count(server, event):
+    for labels, entry in server.socket_event_duration._values.items():
+        if dict(labels) == {'event': event}:
+            return entry[-1]
+    return 0
+
+
+def test_connect_and_disconnect_are_counted_once(server, create_user):
+    _, token = create_user('metrics_user')
+    connects, disconnects = event_count(server, 'connect'), event_count(server, 'disconnect')
+
+    client = connect(server, token)
+    client.disconnect()
+
+    assert event_count(server, 'connect') == connects + 1
+    assert event_count(server, 'disconnect') == disconnects + 1
+
+
+def test_metrics_endpoint(server):
+    response = server.app.test_client().get('/metrics')
+    assert response.status_code == 200
+    assert response.content_type.startswith('text/plain')
+    assert b'# TYPE http_request_duration_seconds histogram' in response.data
+
+
+def test_monotonic_totals_are_counters(server):
+    text = server.app.test_client().get('/metrics').get_data(as_text=True)
+    assert '# TYPE event_loop_blocks_total counter' in text
+    assert '# TYPE socketio_events_throttled_total counter' in text
+
+
+def request_count(server, endpoint, status):
+    for labels, entry in server.http_request_duration._values.items():
+        labels = dict(labels)
+        if labels['endpoint'] == endpoint and labels['status'] == status:
+            return entry[-1]
+    return 0
+
+
+@pytest.mark.parametrize('propagate', [True, False])
+def test_unhandled_exception_is_counted_once_as_500(server, monkeypatch, propagate):
+    def crash():
+        raise RuntimeError('boom')
+    monkeypatch.setitem(server.app.view_functions, 'index', crash)
+    monkeypatch.setitem(server.app.config, 'PROPAGATE_EXCEPTIONS', propagate)
+    before = request_count(server, '/', 500)
+
+    client = server.app.test_client()
+    if propagate:
+        with pytest.raises(RuntimeError):
+            client.get('/')
+    else:
+        assert client.get('/').status_code == 500
+    assert request_count(server, '/', 500) == before + 1
@@ -0,0 +1,21 @@
+# Ограничение частоты join: повтор в уже подключённый чат отбрасывается молча,
+# join в другой чат сверх лимита получает rate_limited, чтобы клиент мог повторить.
+from test_shared_state import connect, events
+
+
+def test_over_limit_join(server, create_user, create_chat):
+    alice_id, alice_token = create_user('join_alice')
+    bob_id, _ = create_user('join_bob')
+    carol_id, _ = create_user('join_carol')
+    first_chat = create_chat(alice_id, bob_id)
+    second_chat = create_chat(alice_id, carol_id)
+    alice = connect(server, alice_token)
+
+    _, burst = server.SOCKET_RATE_LIMITS['join']
+    for _ in range(int(burst) + 1):
+        alice.emit('join', {'room': first_chat})
+    assert not events(alice, 'rate_limited')
+
+    alice.emit('join', {'room': second_chat})
+    assert [data['event'] for data in events(alice, 'rate_limited')] == ['join']
+    alice.disconnect()
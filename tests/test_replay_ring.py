@@ -0,0 +1,64 @@
+# Буфер повтора событий комнат ограничен общим бюджетом памяти, а не числом комнат;
+# досылка из журнала ограничена REPLAY_MAX_GAP событиями.
+from test_shared_state import connect, events
+
+
+def payload(seq, text='hi'):
+    return {'id': seq, 'seq': seq, 'content': text}
+
+
+def test_budget_evicts_least_recent_rooms(server):
+    cost = server.ReplayRing.ENTRY_OVERHEAD + 2 * len('hi')
+    ring = server.ReplayRing(size=10, max_bytes=cost * 25)
+    for chat_id in range(1, 4):
+        for seq in range(1, 11):
+            ring.append(chat_id, seq, 'message', payload(seq))
+
+    # Третья комната не влезла в бюджет вместе с первой - первая вытеснена целиком
+    assert ring.bytes <= ring.max_bytes
+    assert ring.stats()['rooms'] == 2
+    assert ring.since(1, 0, 10) is None
+    assert [p['seq'] for _, p in ring.since(3, 5, 10)] == [6, 7, 8, 9, 10]
+
+
+def test_room_keeps_last_events_only(server):
+    ring = server.ReplayRing(size=3, max_bytes=10 ** 6)
+    for seq in range(1, 6):
+        ring.append(1, seq, 'message', payload(seq))
+
+    assert ring.entries == 3
+    assert ring.since(1, 1, 5) is None
+    assert [p['seq'] for _, p in ring.since(1, 2, 5)] == [3, 4, 5]
+
+
+def test_long_text_counts_against_budget(server):
+    ring = server.ReplayRing(size=100, max_bytes=100000)
+    for seq in range(1, 11):
+        ring.append(1, seq, 'message', payload(seq, 'я' * 20000))
+
+    assert ring.bytes <= ring.max_bytes
+    assert ring.entries == 2
+
+
+def test_long_gap_from_change_log_asks_for_resync(server, create_user, create_chat, monkeypatch):
+    alice_id, alice_token = create_user('replay_alice')
+    bob_id, bob_token = create_user('replay_bob')
+    chat_id = create_chat(alice_id, bob_id)
+    alice = connect(server, alice_token)
+    alice.emit('join', {'room': chat_id})
+    for i in range(3):
+        alice.emit('send_message', {'room': chat_id, 'content': f'm{i}'})
+    alice.disconnect()
+
+    # Буфер в памяти пуст (например, после перезапуска) - события берутся из журнала
+    monkeypatch.setattr(server, 'replay_ring', server.ReplayRing(server.REPLAY_RING_SIZE, server.REPLAY_MAX_BYTES))
+    monkeypatch.setattr(server, 'REPLAY_MAX_GAP', 2)
+    bob = connect(server, bob_token)
+    bob.emit('join', {'room': chat_id, 'last_seq': 1})
+    assert [m['content'] for m in events(bob, 'message') if isinstance(m, dict)] == ['m1', 'm2']
+
+    bob.emit('join', {'room': chat_id, 'last_seq': 0})
+    received = bob.get_received()
+    assert not [e for e in received if e['name'] == 'message' and isinstance(e['args'], list)]
+    assert [e['args'][0] for e in received if e['name'] == 'resync'] == [{'room': chat_id}]
+    bob.disconnect()
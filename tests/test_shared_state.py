@@ -0,0 +1,60 @@
+# Присутствие и рассылки при общем состоянии в Redis (fakeredis://, см. conftest.py):
+# несколько устройств одного пользователя, доставка сообщения собеседнику в комнату чата.
+from pc_app.state import RedisStateBackend
+
+
+def connect(server, token):
+    client = server.socketio.test_client(server.app, query_string=f'token={token}')
+    assert client.is_connected()
+    return client
+
+
+# Данные полученных событий: send() передаёт словарь, emit() - список аргументов
+def events(client, name):
+    return [event['args'][0] if isinstance(event['args'], list) else event['args']
+            for event in client.get_received() if event['name'] == name]
+
+
+def test_state_backend_is_redis(server):
+    assert isinstance(server.state, RedisStateBackend)
+
+
+def test_presence_with_several_devices(server, create_user):
+    user_id, token = create_user('presence_alice')
+    phone = connect(server, token)
+    desktop = connect(server, token)
+
+    assert server.online_users.is_online(user_id)
+    assert len(server.online_users.sids(user_id)) == 2
+
+    # Пользователь остаётся в сети, пока подключено хотя бы одно устройство
+    phone.disconnect()
+    assert server.online_users.is_online(user_id)
+    assert len(server.online_users.sids(user_id)) == 1
+
+    desktop.disconnect()
+    assert not server.online_users.is_online(user_id)
+    assert user_id not in server.online_users.online_user_ids()
+
+
+def test_message_reaches_other_member(server, create_user, create_chat):
+    alice_id, alice_token = create_user('emit_alice')
+    bob_id, bob_token = create_user('emit_bob')
+    chat_id = create_chat(alice_id, bob_id)
+    alice = connect(server, alice_token)
+    bob = connect(server, bob_token)
+
+    alice.emit('join', {'room': chat_id})
+    bob.emit('join', {'room': chat_id})
+    bob.get_received()
+    alice.emit('send_message', {'room': chat_id, 'content': 'hello'})
+
+    received = events(bob, 'message')
+    assert len(received) == 1
+    message = received[0]
+    assert message['content'] == 'hello'
+    assert message['sender_id'] == alice_id
+    assert message['chat_id'] == chat_id
+
+    alice.disconnect()
+    bob.disconnect()
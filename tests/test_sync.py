@@ -0,0 +1,39 @@
+# Курсор /sync не заходит за свежие записи журнала: при нескольких воркерах запись с меньшим id
+# может стать видимой позже записи с большим, и клиент не должен её перескочить.
+from datetime import datetime, timedelta
+
+
+def add_chat_change(server, chat_id, member_ids, age):
+    server.record_changes(server.chat_change_rows(chat_id, member_ids, server.CHANGE_CHAT_CREATED))
+    server.db.session.commit()
+    change_ids = [row.id for row in server.ChangeLog.query.filter_by(chat_id=chat_id)]
+    server.ChangeLog.query.filter(server.ChangeLog.id.in_(change_ids)) \
+        .update({server.ChangeLog.created_at: datetime.utcnow() - age}, synchronize_session=False)
+    server.db.session.commit()
+    return change_ids
+
+
+def test_cursor_holds_back_recent_changes(server, create_user, create_chat):
+    alice_id, alice_token = create_user('sync_alice')
+    bob_id, _ = create_user('sync_bob')
+    carol_id, _ = create_user('sync_carol')
+    client = server.app.test_client()
+    headers = {'x-access-token': alice_token}
+    since = client.get('/sync', headers=headers).get_json()['cursor']
+
+    old_chat = create_chat(alice_id, bob_id)
+    recent_chat = create_chat(alice_id, carol_id)
+    add_chat_change(server, old_chat, (alice_id, bob_id), timedelta(minutes=1))
+    recent_ids = add_chat_change(server, recent_chat, (alice_id, carol_id), timedelta(0))
+
+    first = client.get('/sync', query_string={'since': since}, headers=headers).get_json()
+    assert [chat['chat_id'] for chat in first['chats']] == [old_chat]
+    assert first['cursor'] < min(recent_ids)
+
+    # Окно прошло - запись отдаётся со следующим вызовом
+    server.ChangeLog.query.filter(server.ChangeLog.id.in_(recent_ids)) \
+        .update({server.ChangeLog.created_at: datetime.utcnow() - timedelta(minutes=1)}, synchronize_session=False)
+    server.db.session.commit()
+    second = client.get('/sync', query_string={'since': first['cursor']}, headers=headers).get_json()
+    assert [chat['chat_id'] for chat in second['chats']] == [recent_chat]
+    assert second['cursor'] >= max(recent_ids)
@@ -0,0 +1,45 @@
+# Докачиваемая загрузка: если сохранить файл не удалось, загрузка не теряется и /complete можно повторить.
+import pytest
+from sqlalchemy.exc import OperationalError
+
+from test_audio import wav_bytes
+
+
+def upload(client, headers, data):
+    init = client.post('/upload/audio/init', json={'size': len(data)}, headers=headers).get_json()
+    url = f"/upload/audio/{init['upload_id']}"
+    client.put(url, query_string={'offset': 0}, data=data, headers=headers)
+    return url
+
+
+def fail_once(func, exception):
+    calls = []
+    def wrapper(*args, **kwargs):
+        if not calls:
+            calls.append(1)
+            raise exception
+        return func(*args, **kwargs)
+    return wrapper
+
+
+@pytest.mark.parametrize('failure', ['hash', 'commit'])
+def test_complete_can_be_retried(server, create_user, monkeypatch, failure):
+    _, token = create_user('uploader')
+    headers = {'x-access-token': token}
+    client = server.app.test_client()
+    data = wav_bytes(200 + len(failure))
+    url = upload(client, headers, data)
+
+    if failure == 'hash':
+        monkeypatch.setattr(server, 'file_sha256', fail_once(server.file_sha256, OSError('disk error')))
+    else:
+        monkeypatch.setattr(server.db.session, 'commit',
+                            fail_once(server.db.session.commit, OperationalError('COMMIT', {}, Exception('locked'))))
+
+    assert client.post(url + '/complete', headers=headers).status_code == 503
+    assert client.get(url, headers=headers).get_json()['offset'] == len(data)
+
+    completed = client.post(url + '/complete', headers=headers)
+    assert completed.status_code == 201
+    assert client.get(completed.get_json()['file_path']).data == data
+    assert client.get(url, headers=headers).status_code == 404
@@ -0,0 +1,27 @@
+# Write-behind после прямых вставок: счётчик id в Redis пережил перезапуск и отстал от MAX(id).
+from pc_app.state import Counter
+
+
+def test_stale_counter_is_reseeded(server, create_user, create_chat):
+    alice_id, _ = create_user('writer_alice')
+    bob_id, _ = create_user('writer_bob')
+    chat_id = create_chat(alice_id, bob_id)
+    # Пока write-behind был выключен, сообщения писались напрямую
+    chat = server.Chat.query.get(chat_id)
+    direct = server.persist_message(chat, alice_id, 'direct', False)
+    counter = server.state.counter('message_id')
+    server.state.client.set(counter.key, direct.id - 1)
+
+    writer = server.MessageWriteBehind(batch_size=10, interval=60)
+    message = writer.enqueue(chat_id, bob_id, 'batched', False)
+    writer.flush()
+
+    assert message.id > direct.id
+    assert server.Message.query.get(message.id).content == 'batched'
+
+
+def test_in_memory_counter_advance():
+    counter = Counter()
+    assert counter.advance_to(10) == 10
+    assert counter.advance_to(5) == 10
+    assert counter.next(lambda: 0) == 11